@@ -0,0 +1,34 @@
+-- Migration: packed mip level vectors (see MipVectorsTable), for databases
+-- created before the mip_vectors table was added to my_image_db.sql.
+-- Run by midb_tool --migrate-mips, which then fills the table from the
+-- mip_level0..2 columns.
+
+--
+-- Table structure for table `mip_vectors`
+--
+
+CREATE TABLE IF NOT EXISTS `mip_vectors` (
+  `mip_vectorsID` int(11) unsigned NOT NULL,
+  `imageID` int(11) unsigned NOT NULL,
+  `level` tinyint(3) unsigned NOT NULL,
+  `vector` blob NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=ascii;
+
+--
+-- Indexes for table `mip_vectors`
+--
+ALTER TABLE `mip_vectors`
+  ADD PRIMARY KEY (`mip_vectorsID`),
+  ADD UNIQUE KEY `imageID_level_UNIQUE` (`imageID`,`level`);
+
+--
+-- AUTO_INCREMENT for table `mip_vectors`
+--
+ALTER TABLE `mip_vectors`
+  MODIFY `mip_vectorsID` int(11) unsigned NOT NULL AUTO_INCREMENT;
+
+--
+-- Constraints for table `mip_vectors`
+--
+ALTER TABLE `mip_vectors`
+  ADD CONSTRAINT `mip_vectors_ibfk_1` FOREIGN KEY (`imageID`) REFERENCES `image_files` (`imageID`) ON DELETE CASCADE ON UPDATE CASCADE;
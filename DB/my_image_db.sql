@@ -45,98 +45,44 @@ CREATE TABLE IF NOT EXISTS `image_files` (
 -- --------------------------------------------------------
 
 --
--- Table structure for table `mip_level0`
+-- Table structure for table `file_stats`
 --
 
-CREATE TABLE IF NOT EXISTS `mip_level0` (
-  `mip_level0ID` int(11) unsigned NOT NULL,
-  `red` float NOT NULL DEFAULT '0',
-  `green` float NOT NULL DEFAULT '0',
-  `blue` float NOT NULL DEFAULT '0',
+CREATE TABLE IF NOT EXISTS `file_stats` (
+  `file_statsID` int(11) unsigned NOT NULL,
+  `size` bigint(20) unsigned NOT NULL DEFAULT '0',
+  `mtime` double NOT NULL DEFAULT '0',
+  `inode` bigint(20) unsigned NOT NULL DEFAULT '0',
+  `fingerprint` char(40) CHARACTER SET ascii DEFAULT NULL,
   `imageID` int(11) unsigned NOT NULL
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
 -- --------------------------------------------------------
 
 --
--- Table structure for table `mip_level1`
+-- Table structure for table `mip_level0`
 --
 
-CREATE TABLE IF NOT EXISTS `mip_level1` (
-  `mip_level1ID` int(11) unsigned NOT NULL,
-  `red0` float NOT NULL DEFAULT '0',
-  `green0` float NOT NULL DEFAULT '0',
-  `blue0` float NOT NULL DEFAULT '0',
-  `red1` float NOT NULL DEFAULT '0',
-  `green1` float NOT NULL DEFAULT '0',
-  `blue1` float NOT NULL DEFAULT '0',
-  `red2` float NOT NULL DEFAULT '0',
-  `green2` float NOT NULL DEFAULT '0',
-  `blue2` float NOT NULL DEFAULT '0',
-  `red3` float NOT NULL DEFAULT '0',
-  `green3` float NOT NULL DEFAULT '0',
-  `blue3` float NOT NULL DEFAULT '0',
+CREATE TABLE IF NOT EXISTS `mip_level0` (
+  `mip_level0ID` int(11) unsigned NOT NULL,
+  `red` float NOT NULL DEFAULT '0',
+  `green` float NOT NULL DEFAULT '0',
+  `blue` float NOT NULL DEFAULT '0',
   `imageID` int(11) unsigned NOT NULL
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
 -- --------------------------------------------------------
 
 --
--- Table structure for table `mip_level2`
---
-
-CREATE TABLE IF NOT EXISTS `mip_level2` (
-  `mip_level2ID` int(11) unsigned NOT NULL,
-  `red00` float NOT NULL DEFAULT '0',
-  `green00` float NOT NULL DEFAULT '0',
-  `blue00` float NOT NULL DEFAULT '0',
-  `red01` float NOT NULL DEFAULT '0',
-  `green01` float NOT NULL DEFAULT '0',
-  `blue01` float NOT NULL DEFAULT '0',
-  `red02` float NOT NULL DEFAULT '0',
-  `green02` float NOT NULL DEFAULT '0',
-  `blue02` float NOT NULL DEFAULT '0',
-  `red03` float NOT NULL DEFAULT '0',
-  `green03` float NOT NULL DEFAULT '0',
-  `blue03` float NOT NULL DEFAULT '0',
-  `red04` float NOT NULL DEFAULT '0',
-  `green04` float NOT NULL DEFAULT '0',
-  `blue04` float NOT NULL DEFAULT '0',
-  `red05` float NOT NULL DEFAULT '0',
-  `green05` float NOT NULL DEFAULT '0',
-  `blue05` float NOT NULL DEFAULT '0',
-  `red06` float NOT NULL DEFAULT '0',
-  `green06` float NOT NULL DEFAULT '0',
-  `blue06` float NOT NULL DEFAULT '0',
-  `red07` float NOT NULL DEFAULT '0',
-  `green07` float NOT NULL DEFAULT '0',
-  `blue07` float NOT NULL DEFAULT '0',
-  `red08` float NOT NULL DEFAULT '0',
-  `green08` float NOT NULL DEFAULT '0',
-  `blue08` float NOT NULL DEFAULT '0',
-  `red09` float NOT NULL DEFAULT '0',
-  `green09` float NOT NULL DEFAULT '0',
-  `blue09` float NOT NULL DEFAULT '0',
-  `red10` float NOT NULL DEFAULT '0',
-  `green10` float NOT NULL DEFAULT '0',
-  `blue10` float NOT NULL DEFAULT '0',
-  `red11` float NOT NULL DEFAULT '0',
-  `green11` float NOT NULL DEFAULT '0',
-  `blue11` float NOT NULL DEFAULT '0',
-  `red12` float NOT NULL DEFAULT '0',
-  `green12` float NOT NULL DEFAULT '0',
-  `blue12` float NOT NULL DEFAULT '0',
-  `red13` float NOT NULL DEFAULT '0',
-  `green13` float NOT NULL DEFAULT '0',
-  `blue13` float NOT NULL DEFAULT '0',
-  `red14` float NOT NULL DEFAULT '0',
-  `green14` float NOT NULL DEFAULT '0',
-  `blue14` float NOT NULL DEFAULT '0',
-  `red15` float NOT NULL DEFAULT '0',
-  `green15` float NOT NULL DEFAULT '0',
-  `blue15` float NOT NULL DEFAULT '0',
-  `imageID` int(11) unsigned NOT NULL
-) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+-- Table structure for table `mip_vectors`
+--
+
+CREATE TABLE IF NOT EXISTS `mip_vectors` (
+  `mip_vectorsID` int(11) unsigned NOT NULL,
+  `imageID` int(11) unsigned NOT NULL,
+  `level` tinyint(3) unsigned NOT NULL,
+  `vector` blob NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=ascii;
 
 -- --------------------------------------------------------
 
@@ -171,6 +117,14 @@ ALTER TABLE `image_files`
   ADD KEY `num_channels_idx` (`num_channels`),
   ADD KEY `active_idx` (`active`);
 
+--
+-- Indexes for table `file_stats`
+--
+ALTER TABLE `file_stats`
+  ADD PRIMARY KEY (`file_statsID`),
+  ADD UNIQUE KEY `imageID_UNIQUE` (`imageID`),
+  ADD KEY `fingerprint_idx` (`fingerprint`);
+
 --
 -- Indexes for table `mip_level0`
 --
@@ -181,24 +135,11 @@ ALTER TABLE `mip_level0`
   ADD KEY `imageID` (`imageID`) USING BTREE;
 
 --
--- Indexes for table `mip_level1`
+-- Indexes for table `mip_vectors`
 --
-ALTER TABLE `mip_level1`
-  ADD PRIMARY KEY (`mip_level1ID`),
-  ADD UNIQUE KEY `imageID_UNIQUE` (`imageID`),
-  ADD KEY `rgb_idx` (`red0`,`green0`,`blue0`,`red1`,`green1`,`blue1`,`red2`,`green2`,`blue2`,`red3`,`green3`,`blue3`),
-  ADD KEY `imageID_idx` (`imageID`),
-  ADD KEY `imageID` (`imageID`);
-
---
--- Indexes for table `mip_level2`
---
-ALTER TABLE `mip_level2`
-  ADD PRIMARY KEY (`mip_level2ID`),
-  ADD UNIQUE KEY `imageID_UNIQUE` (`imageID`),
-  ADD KEY `rgb_idx0` (`red00`,`green00`,`blue00`,`red01`,`green01`,`blue01`,`red02`,`green02`,`blue02`,`red03`,`green03`,`blue03`,`red04`,`green04`,`blue04`,`red05`,`green05`,`blue05`,`red06`,`green06`,`blue06`,`red07`,`green07`,`blue07`),
-  ADD KEY `rgb_idx1` (`red08`,`green08`,`blue08`,`red09`,`green09`,`blue09`,`red10`,`green10`,`blue10`,`red11`,`green11`,`blue11`,`red12`,`green12`,`blue12`,`red13`,`green13`,`blue13`,`red14`,`green14`,`blue14`,`red15`,`green15`,`blue15`),
-  ADD KEY `mip_level2_ibfk_1` (`imageID`);
+ALTER TABLE `mip_vectors`
+  ADD PRIMARY KEY (`mip_vectorsID`),
+  ADD UNIQUE KEY `imageID_level_UNIQUE` (`imageID`,`level`);
 
 --
 -- Indexes for table `thumbnails`
@@ -218,20 +159,20 @@ ALTER TABLE `thumbnails`
 ALTER TABLE `image_files`
   MODIFY `imageID` int(11) unsigned NOT NULL AUTO_INCREMENT;
 --
+-- AUTO_INCREMENT for table `file_stats`
+--
+ALTER TABLE `file_stats`
+  MODIFY `file_statsID` int(11) unsigned NOT NULL AUTO_INCREMENT;
+--
 -- AUTO_INCREMENT for table `mip_level0`
 --
 ALTER TABLE `mip_level0`
   MODIFY `mip_level0ID` int(11) unsigned NOT NULL AUTO_INCREMENT;
 --
--- AUTO_INCREMENT for table `mip_level1`
---
-ALTER TABLE `mip_level1`
-  MODIFY `mip_level1ID` int(11) unsigned NOT NULL AUTO_INCREMENT;
---
--- AUTO_INCREMENT for table `mip_level2`
+-- AUTO_INCREMENT for table `mip_vectors`
 --
-ALTER TABLE `mip_level2`
-  MODIFY `mip_level2ID` int(11) unsigned NOT NULL AUTO_INCREMENT;
+ALTER TABLE `mip_vectors`
+  MODIFY `mip_vectorsID` int(11) unsigned NOT NULL AUTO_INCREMENT;
 --
 -- AUTO_INCREMENT for table `thumbnails`
 --
@@ -242,22 +183,22 @@ ALTER TABLE `thumbnails`
 --
 
 --
--- Constraints for table `mip_level0`
+-- Constraints for table `file_stats`
 --
-ALTER TABLE `mip_level0`
-  ADD CONSTRAINT `mip_level0_ibfk_1` FOREIGN KEY (`imageID`) REFERENCES `image_files` (`imageID`) ON DELETE CASCADE ON UPDATE CASCADE;
+ALTER TABLE `file_stats`
+  ADD CONSTRAINT `file_stats_ibfk_1` FOREIGN KEY (`imageID`) REFERENCES `image_files` (`imageID`) ON DELETE CASCADE ON UPDATE CASCADE;
 
 --
--- Constraints for table `mip_level1`
+-- Constraints for table `mip_level0`
 --
-ALTER TABLE `mip_level1`
-  ADD CONSTRAINT `mip_level1_ibfk_1` FOREIGN KEY (`imageID`) REFERENCES `image_files` (`imageID`) ON DELETE CASCADE ON UPDATE CASCADE;
+ALTER TABLE `mip_level0`
+  ADD CONSTRAINT `mip_level0_ibfk_1` FOREIGN KEY (`imageID`) REFERENCES `image_files` (`imageID`) ON DELETE CASCADE ON UPDATE CASCADE;
 
 --
--- Constraints for table `mip_level2`
+-- Constraints for table `mip_vectors`
 --
-ALTER TABLE `mip_level2`
-  ADD CONSTRAINT `mip_level2_ibfk_1` FOREIGN KEY (`imageID`) REFERENCES `image_files` (`imageID`) ON DELETE CASCADE ON UPDATE CASCADE;
+ALTER TABLE `mip_vectors`
+  ADD CONSTRAINT `mip_vectors_ibfk_1` FOREIGN KEY (`imageID`) REFERENCES `image_files` (`imageID`) ON DELETE CASCADE ON UPDATE CASCADE;
 
 --
 -- Constraints for table `thumbnails`
@@ -4,14 +4,20 @@
 """
 import os
 import sys
-import subprocess
-import tempfile
 import logging
 import logging.handlers as handlers
 
-from db import ImageFilesTable
+from db import ImageFilesTable, MipVectorsTable
 from images import ImageInfo
+from index import ColorIndex
+from snapshot import IndexSnapshot
+from matcher import BatchMatcher, LookupCache
+from assign import assignTiles
+from compositor import composeMosaic
+from tilecache import TileCache
+from thumbstore import ThumbnailStore
 from config import Config
+import profiling
 
 log = logging.getLogger('midb')
 
@@ -25,21 +31,103 @@ h.setFormatter(logging.Formatter('%(asctime)s %(name)s [%(levelname)s]: %(messag
 log.addHandler(h)
 log.setLevel(logging.DEBUG)
 
-def processImageDir(root=None, forceUpdateExisting=False):
+def processImageDir(root=None, forceUpdateExisting=False, jobs=1,
+                    incremental=False, batchSize=64, dedup=True, journal=True,
+                    resume=False):
     """Process all images in all subdirectories of the specified root,
     or Config.IMG_ROOT if root is None.
     Store their info in the database.
     If forceUpdateExisting is True, re-process images that are already in the
     database; otherwise skip them.
+    If jobs > 1, read the images with a pool of that many worker processes.
+    If incremental is True, only store images that are new or changed since
+    they were stored last time, judging by their size, mtime and inode.
+    Images are written to the database in transactions of batchSize images.
+    If dedup is True, identical copies of images already stored are not
+    sampled again, see ImageFilesTable.traverseAndStore.
+    If journal is True, progress is checkpointed, and if resume is True too,
+    an interrupted run of the same root is resumed where it stopped;
+    otherwise it starts over.
     """
     log.info('*** Process Image Directory: session begin ***')
     log.info('Log file: %s' % Config.LOGFILE)
-    ImageFilesTable.traverseAndStore(root, forceUpdateExisting=forceUpdateExisting)
+    ImageFilesTable.traverseAndStore(root, forceUpdateExisting=forceUpdateExisting,
+                                     jobs=jobs, incremental=incremental,
+                                     batchSize=batchSize, dedup=dedup,
+                                     journal=journal, resume=resume)
+    log.info('Done')
+
+def migrateMipVectors(dropColumns=False):
+    """Copy the mip levels of all images to the packed vectors of the
+    MipVectorsTable (creating it if needed). If dropColumns is True, drop the
+    mip_level1 and mip_level2 tables afterwards: mosaics are then looked up
+    in a ColorIndex.
+    """
+    log.info('*** Migrate Mip Levels: session begin ***')
+    log.info('Log file: %s' % Config.LOGFILE)
+    MipVectorsTable.migrate(dropColumns=dropColumns)
     log.info('Done')
     
+def exportIndexSnapshot():
+    """Export the mip levels of all images to a new IndexSnapshot (see
+    Config.INDEX_SNAPSHOT_DIR), from scratch
+    """
+    log.info('*** Export Index Snapshot: session begin ***')
+    log.info('Log file: %s' % Config.LOGFILE)
+    IndexSnapshot().export()
+    log.info('Done')
+    
+def serveMosaics(socketPath, snapshot=False):
+    """Run a MosaicServer on the Unix socket at socketPath until interrupted:
+    the library stays loaded in memory for all the mosaics asked.
+    If snapshot is True, the color index is mapped from the IndexSnapshot,
+    see makeMosaicImage.
+    """
+    from server import MosaicServer
+    log.info('*** Mosaic Server: session begin ***')
+    log.info('Log file: %s' % Config.LOGFILE)
+    MosaicServer(socketPath, snapshot=snapshot).serve()
+    
 def makeMosaicImage(filename, tilesInXorY, outputResInX, outfile,
-                    noRepeatCount=200, imageQueryLimit=16):
+                    noRepeatCount=200, imageQueryLimit=16, useIndex=False,
+                    batch=False, resizeJobs=4, tileCache=True,
+                    useThumbnails=True, dedup=True, cascade=False,
+                    assign=False, noRepeatRadius=4, index=None, cache=None,
+                    thumbnails=None, snapshot=False, lookupCache=False,
+                    copies=None):
     """Create the mosaic matching the input image.
+    If useIndex is True, the mip levels of all images are loaded into an
+    in-memory ColorIndex up front, and tiles are looked up in it rather than
+    with a database query each.
+    If batch is True (implies useIndex), the candidates of all the tiles are
+    ranked up front by a BatchMatcher, with a few array operations.
+    resizeJobs is the number of threads resizing the tile images, see
+    composeMosaic.
+    If tileCache is True, resized tiles are reused across runs from a
+    TileCache (see Config.TILE_CACHE_DIR and Config.TILE_CACHE_BYTES).
+    If useThumbnails is True, tiles are made from the thumbnails stored at
+    ingest time (see ThumbnailStore) whenever they are large enough.
+    If dedup is True, identical copies of an image (same pixel hash) count as
+    one image: using one of them excludes the others too.
+    If cascade is True (implies useIndex, overrides batch), each tile is
+    looked up with a single coarse to fine search across the mip levels (see
+    ColorIndex.findCascade) instead of a full search at each of them.
+    If assign is True (implies useIndex, overrides batch and cascade), the
+    images of all the tiles are picked at once to minimize their total
+    distance (see TileAssigner), no image being used twice within
+    noRepeatRadius tiles of itself; noRepeatCount is then ignored.
+    index, cache and thumbnails are a ColorIndex, TileCache and
+    ThumbnailStore already loaded (e.g. kept by a MosaicServer), used instead
+    of loading new ones if given; a ColorIndex given implies useIndex.
+    copies is a dictionary of the identical copies of the images (imageIDs
+    by pixel hash) filled by dedup, e.g. kept by a MosaicServer along with
+    its ColorIndex so they are queried once rather than for each mosaic.
+    If snapshot is True (implies useIndex), the ColorIndex is memory-mapped
+    from the IndexSnapshot, brought up to date with the images updated since
+    it was written, rather than read from the database.
+    If lookupCache is True (ignored with batch, cascade and assign), tiles of
+    nearly the same colors share their lookups (see LookupCache): much fewer
+    queries on flat areas, at the cost of approximate rankings within them.
     NOTE: For now we only use mipLevel0
     """
     log.info('*** Make Mosaic Image: session begin ***')
@@ -50,110 +138,195 @@ def makeMosaicImage(filename, tilesInXorY, outputResInX, outfile,
                    (tilesInXorY*2,tilesInXorY*2),
                    (tilesInXorY*4,tilesInXorY*4)]
     
-    imageInfo = ImageInfo(filename, resolutions, thumbSize=tilesInXorY)
+    with profiling.timed('mosaic.read_input'):
+        imageInfo = ImageInfo(filename, resolutions, thumbSize=tilesInXorY)
+
+    cascade = cascade and not assign
+    batch = batch and not cascade and not assign
+    if index is None and not useIndex and \
+       not all([x.exists() for x in ColorIndex.mipTables]):
+        log.info('Mip level tables migrated to packed vectors: using the index')
+        useIndex = True
+
+    if index is None:
+        with profiling.timed('mosaic.load_index'):
+            if snapshot:
+                index = IndexSnapshot().load()
+            elif useIndex or batch or cascade or assign:
+                index = ColorIndex.load()
+    finder = index if index else ImageFilesTable
+    lookups = None
+    if lookupCache and not (batch or cascade or assign):
+        finder = lookups = LookupCache(finder)
 
     frameAspect = imageInfo['frame_aspect']
+
+    if batch:
+        with profiling.timed('mosaic.rank'):
+            tileVectors = [imageInfo.getTilePixels(res, tilesInXorY, tilesInXorY) \
+                           for res in resolutions]
+            candidates = BatchMatcher(index).rank(tileVectors, frameAspect,
+                                                  aspectTolerance=0.1)
     
     infiles = []
+    images = []
     usedImageIDClusters = {}
     allUsedImageIDs = []
+    # imageIDs of the identical copies of each used image, itself included:
+    copiesByID = {}
+    copiesByHash = {} if copies is None else copies
+
+    def resolveCopies(candidates):
+        """Look up the identical copies of the candidates not known yet, with
+        one query at most (none if the index has them already)
+        """
+        missing = set([x.hash for x in candidates \
+                       if x.hash and x.hash not in copiesByHash])
+        if not dedup or not missing:
+            return
+        if index:
+            found = index.duplicateIDs(missing)
+        else:
+            found = ImageFilesTable.findDuplicateIDsByHashes(missing)
+        copiesByHash.update(found)
 
-    n = 0
+    def copiesOf(ift):
+        if not dedup or not ift.hash:
+            return [ift.id]
+        resolveCopies([ift])
+        return sorted(set(copiesByHash[ift.hash] + [ift.id]))
+
+    if assign:
+        with profiling.timed('mosaic.assign'):
+            vectors = imageInfo.getTilePixels(resolutions[-1], tilesInXorY,
+                                              tilesInXorY)
+            images = assignTiles(index, vectors, tilesInXorY, tilesInXorY,
+                                 frameAspect, aspectTolerance=0.1,
+                                 radius=noRepeatRadius, dedup=dedup)
+        infiles = [x.abspath() for x in images]
+    else:
+        n = 0
     
-    for y in range(tilesInXorY):
-        for x in range(tilesInXorY):
-            n += 1
-            pixelsForRes = []
+        for y in range(tilesInXorY):
+            for x in range(tilesInXorY):
+                n += 1
+                pixelsForRes = []
             
-            log.info('Target Pixel: (%d, %d)' % (x, y))
+                log.info('Target Pixel: (%d, %d)' % (x, y))
             
-            for w, h in resolutions:
-                scale = w / tilesInXorY
-                pixelsForRes.append(imageInfo.getPixels((w, h),
-                                                        x*scale,
-                                                        y*scale,
-                                                        (x+1)*scale,
-                                                        (y+1)*scale))
-                log.debug('Resolution: (%d, %d), %d pixels' % \
-                          (w, h, len(pixelsForRes[-1])))
+                for i, (w, h) in enumerate(resolutions):
+                    if batch:
+                        pixelsForRes.append(tileVectors[i][n-1].tolist())
+                        continue
+                    scale = w / tilesInXorY
+                    pixelsForRes.append(imageInfo.getPixels((w, h),
+                                                            x*scale,
+                                                            y*scale,
+                                                            (x+1)*scale,
+                                                            (y+1)*scale))
+                    log.debug('Resolution: (%d, %d), %d pixels' % \
+                              (w, h, len(pixelsForRes[-1])))
                                     
-            rgbCluster = tuple([int(x * 24 + 0.5) for x in pixelsForRes[0]])
+                rgbCluster = tuple([int(x * 24 + 0.5) for x in pixelsForRes[0]])
 
-            log.info('Looking up image %d of %d matching color %s...' % \
-                     (n, tilesInXorY*tilesInXorY, `pixelsForRes[0]`))
+                log.info('Looking up image %d of %d matching color %s...' % \
+                         (n, tilesInXorY*tilesInXorY, `pixelsForRes[0]`))
         
-            if noRepeatCount > 0:
-                excludeIDs = allUsedImageIDs[-noRepeatCount:]
-                imageQueryLimit = 1
-            else:
-                excludeIDs = usedImageIDClusters.get(rgbCluster)
+                if noRepeatCount > 0:
+                    excludeIDs = [x for imageID in allUsedImageIDs[-noRepeatCount:] \
+                                  for x in copiesByID[imageID]]
+                    imageQueryLimit = 1
+                else:
+                    excludeIDs = usedImageIDClusters.get(rgbCluster)
         
-            distsAndImages = []
-            
-            for pixels in pixelsForRes:
-                i = 0
-                for ift in ImageFilesTable.findByClosestColors(pixels,
-                                                            frameAspect,
-                                                            aspectTolerance=0.1,
-                                                            limit=imageQueryLimit,
-                                                            excludeImageIDs=excludeIDs):
-                    dist = ift.distance(pixels)
-                    distsAndImages.append((dist, ift))
-                    if i == 0:
+                distsAndImages = []
+
+                if cascade:
+                    with profiling.timed('mosaic.lookup_cascade'):
+                        distsAndImages = index.findCascade(pixelsForRes, frameAspect,
+                                                           aspectTolerance=0.1,
+                                                           limit=imageQueryLimit,
+                                                           excludeImageIDs=excludeIDs)
+                    if distsAndImages:
+                        log.info('Distance: %g for the best match by %d sample(s)' % \
+                                 (distsAndImages[0][0], len(pixelsForRes[-1]) / 3))
+
+                for level, pixels in enumerate([] if cascade else pixelsForRes):
+                    with profiling.timed('mosaic.lookup_level%d' % level):
+                        if batch:
+                            found = candidates.closest(n-1, level, imageQueryLimit,
+                                                       excludeIDs)
+                        else:
+                            found = finder.findClosestWithDistances(pixels,
+                                                                    frameAspect,
+                                                                    aspectTolerance=0.1,
+                                                                    limit=imageQueryLimit,
+                                                                    excludeImageIDs=excludeIDs)
+                    if found:
                         log.info('Distance: %g for the best match by %d sample(s)' % \
-                                 (dist, len(pixels) / 3))
-                    i += 1
+                                 (found[0][0], len(pixels) / 3))
+                    distsAndImages.extend(found)
                 
-            distsAndImages.sort(cmp=lambda *arg: cmp(arg[0][0], arg[1][0]))
-            bestImageCandidates = [b for a, b in distsAndImages]
+                distsAndImages.sort(cmp=lambda *arg: cmp(arg[0][0], arg[1][0]))
+                bestImageCandidates = [b for a, b in distsAndImages]
             
-            # Try to pick an image that was not yet used:
-            for ift in bestImageCandidates:
-                if ift.id not in allUsedImageIDs:
-                    break
-            else:
-                # All images returned by the query have been already used. Let's pick
-                # one of them anyways. Use random but deterministic selection:
-                randIdx = hash(str(n)) % len(bestImageCandidates)
-                ift = bestImageCandidates[randIdx]
-                log.warning('Re-using image %s' % ift.path)
+                # Try to pick an image that was not yet used:
+                resolveCopies(bestImageCandidates)
+                for ift in bestImageCandidates:
+                    if not [x for x in copiesOf(ift) if x in copiesByID]:
+                        break
+                else:
+                    # All images returned by the query have been already used. Let's pick
+                    # one of them anyways. Use random but deterministic selection:
+                    randIdx = hash(str(n)) % len(bestImageCandidates)
+                    ift = bestImageCandidates[randIdx]
+                    log.warning('Re-using image %s' % ift.path)
             
-            infiles.append(ift.abspath())
-            log.info('Image found: id: %d, %s' % (ift.id, ift.abspath()))
+                infiles.append(ift.abspath())
+                images.append(ift)
+                log.info('Image found: id: %d, %s' % (ift.id, ift.abspath()))
             
-            if rgbCluster in usedImageIDClusters:
-                usedImageIDClusters[rgbCluster].add(ift.id)
-            else:
-                usedImageIDClusters[rgbCluster] = set([ift.id])
+                sameImageIDs = copiesOf(ift)
+                if len(sameImageIDs) > 1:
+                    log.info('%d identical copies of the image excluded' % \
+                             (len(sameImageIDs) - 1))
+
+                if rgbCluster in usedImageIDClusters:
+                    usedImageIDClusters[rgbCluster].update(sameImageIDs)
+                else:
+                    usedImageIDClusters[rgbCluster] = set(sameImageIDs)
             
-            allUsedImageIDs.append(ift.id)
+                allUsedImageIDs.append(ift.id)
+                copiesByID[ift.id] = sameImageIDs
             
     #return ifniles
     outputResInY = int(outputResInX / frameAspect + 0.5)
     tileSizeX = outputResInX / tilesInXorY
     tileSizeY = outputResInY / tilesInXorY
     
-    tfiles = []
+    if not tileCache:
+        cache = None
+    elif cache is None:
+        cache = TileCache()
+    tileKeys = [tuple([TileCache.key(x.hash, tileSizeX, tileSizeY, x.colorspace,
+                                     source) \
+                       for source in ('original', 'thumbnail')]) \
+                for x in images]
 
-    for i, infile in enumerate(infiles):
-        log.info('Resizing image %d of %d...' % (i+1, len(infiles)))
-        
-        tfile = tempfile.mktemp(prefix='myImgDBMosaicIn',
-                                suffix=os.path.splitext(outfile)[-1])
-        tfiles.append(tfile)
-        cmd = ['oiiotool', infile, '--resize', '%dx%d' % (tileSizeX, tileSizeY),
-               '-o', tfile]
-        subprocess.check_call(cmd)
-        
-    log.info('Building mosaic...')
-    
-    cmd = ['oiiotool'] + \
-           tfiles + \
-           ['--mosaic', '%dx%d' % (tilesInXorY, tilesInXorY), '-o', outfile]
-    subprocess.check_call(cmd)
+    if not useThumbnails:
+        thumbnails = None
+    elif thumbnails is None:
+        thumbnails = ThumbnailStore()
+
+    with profiling.timed('mosaic.compose'):
+        composeMosaic(infiles, tilesInXorY, tilesInXorY, tileSizeX, tileSizeY,
+                      outfile, jobs=resizeJobs, tileKeys=tileKeys, cache=cache,
+                      imageIDs=[x.id for x in images], thumbnails=thumbnails)
+
+    if lookups is not None:
+        lookups.logStats()
+    if cache is not None:
+        cache.logStats()
     
-    log.info('Cleaning up...')
-    for f in tfiles:
-        os.unlink(f)
     log.info('Done: %s' % outfile)
     
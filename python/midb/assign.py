@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+
+"""Global assignment of images to mosaic tiles: all the tiles are placed at
+once from their ranked candidates, rather than greedily in raster order, so
+late tiles do not get the leftovers of early ones.
+"""
+import time
+import logging
+import itertools
+import collections
+import numpy
+
+from matcher import BatchMatcher
+
+log = logging.getLogger('midb.assign')
+
+
+def auction(objects, benefits, numObjects, epsilon=1e-3, depth=None):
+    """Assign each bidder to a distinct object, maximizing the total benefit
+    within numBidders * epsilon * (range of the benefits), by Bertsekas'
+    auction. objects and benefits are lists
+    of an array per bidder: its candidate objects (numbered from 0 to
+    numObjects - 1) and their benefits; candidates of benefit -inf are never
+    picked. Only the depth best candidates of each bidder are bid on: a bidder
+    never gets one beyond the number of bidders its objects are shared with
+    in an optimal assignment, the default depth.
+    Return (assigned, bids): the candidate chosen for each bidder (its
+    position in the bidder's arrays), or -1 for bidders left out (when their
+    candidates are all taken), and the number of bids made.
+    """
+    numBidders = len(objects)
+    positions = [numpy.argsort(-x, kind='mergesort')[:depth or numBidders] \
+                 for x in benefits]
+    positions = [x[numpy.isfinite(b[x])] for x, b in zip(positions, benefits)]
+    objects = [x[p] for x, p in zip(objects, positions)]
+    benefits = [x[p] for x, p in zip(benefits, positions)]
+
+    allBenefits = numpy.concatenate(benefits) if numBidders else numpy.zeros(0)
+    allBenefits = allBenefits[numpy.isfinite(allBenefits)]
+    if not len(allBenefits):
+        return [-1] * numBidders, 0
+    benefitRange = max(allBenefits.max() - allBenefits.min(), 1e-6)
+    # Value of being left out: worse than any candidate
+    dummy = allBenefits.min() - 10 * benefitRange - 1.0
+
+    # No epsilon scaling: with more objects than bidders, objects left over
+    # must keep the lowest price (0) for the result to be optimal
+    eps = epsilon * benefitRange
+    prices = numpy.zeros(numObjects)
+    owners = numpy.empty(numObjects, dtype=numpy.int64)
+    owners.fill(-1)
+    assigned = [-1] * numBidders
+    queue = collections.deque(range(numBidders))
+    bids = 0
+
+    while queue:
+        bidder = queue.popleft()
+        values = benefits[bidder] - prices[objects[bidder]]
+        best = int(values.argmax())
+        if values[best] <= dummy:
+            continue
+        bestValue = values[best]
+        values[best] = dummy
+        second = max(dummy, values.max())
+
+        obj = objects[bidder][best]
+        prices[obj] += bestValue - second + eps
+        if owners[obj] >= 0:
+            assigned[owners[obj]] = -1
+            queue.append(owners[obj])
+        owners[obj] = bidder
+        assigned[bidder] = best
+        bids += 1
+
+    return [positions[i][x] if x >= 0 else -1 \
+            for i, x in enumerate(assigned)], bids
+
+
+class TileAssigner(object):
+    """Assigns images to the tilesInX by tilesInY tiles of a mosaic so the
+    total distance of the tiles to their images is (close to) minimal, with
+    no image used twice within radius tiles (in X or Y) of itself.
+    The candidates of every tile are its closest images (a sparse cost
+    matrix). The mosaic is split in blocks of radius + 1 tiles in X and Y,
+    all within radius of each other:
+    - the tiles of every block are assigned distinct images, all the blocks
+      at once, by an auction;
+    - the images still too close to themselves across blocks are repaired,
+      best fitting tiles first, with their next candidates;
+    - each block is then solved again, given the tiles around it, by an
+      auction too, over shifted block grids, as long as the total distance
+      goes down.
+    Images are given as keys: numbers from 0, each key may stand for several
+    identical copies of an image.
+    """
+    # Auction epsilon, relative to the range of the costs: the total cost of
+    # each block is within its tiles * epsilon of the optimum
+    epsilon = 1e-2
+
+    def __init__(self, tilesInX, tilesInY, radius=4):
+        self.tilesInX = tilesInX
+        self.tilesInY = tilesInY
+        self.radius = radius
+        self.stats = collections.defaultdict(int)
+
+    def depth(self, minimum=32):
+        """Return the number of candidates to rank per tile: enough for all
+        the tiles within radius to use a different one
+        """
+        return max(minimum, 2 * (2 * self.radius + 1) ** 2)
+
+    def blocks(self, offsetX=0, offsetY=0):
+        """Return a list of the blocks of tiles, each a list of tile numbers
+        (raster order), the block grid being shifted by the given offsets
+        """
+        step = self.radius + 1
+        result = []
+        for y in range(-offsetY, self.tilesInY, step):
+            for x in range(-offsetX, self.tilesInX, step):
+                result.append([j * self.tilesInX + i \
+                               for j in range(max(0, y), min(y + step, self.tilesInY)) \
+                               for i in range(max(0, x), min(x + step, self.tilesInX))])
+        return result
+
+    @staticmethod
+    def _objects(keysByBidder, groups=None):
+        """Return (objects, numObjects): the keys of each bidder numbered from
+        0, the same key being a distinct object in each group of bidders if
+        groups (a group number per bidder) is given
+        """
+        if groups is not None:
+            keysByBidder = [keys * (len(groups) + 1) + group \
+                            for keys, group in zip(keysByBidder, groups)]
+        unique, objects = numpy.unique(numpy.concatenate(keysByBidder),
+                                       return_inverse=True)
+        bounds = numpy.cumsum([0] + [len(x) for x in keysByBidder])
+        return [objects[bounds[i]:bounds[i + 1]] for i in range(len(keysByBidder))], \
+               len(unique)
+
+    def auction(self, candidates, costs):
+        """Assign distinct candidates to the tiles of every block, given for
+        each tile an array of its candidate keys and one of their costs.
+        Return a list of the candidate chosen for each tile (its position in
+        the tile's arrays), or -1 for tiles left out.
+        """
+        groups = [0] * len(candidates)
+        for i, block in enumerate(self.blocks()):
+            for tile in block:
+                groups[tile] = i
+        objects, numObjects = self._objects(candidates, groups)
+        assigned, bids = auction(objects, [-x for x in costs], numObjects,
+                                 self.epsilon, (self.radius + 1) ** 2)
+        self.stats['bids'] += bids
+        return assigned
+
+    def neighbours(self, grid, tile):
+        """Return the keys placed within radius of the tile in the grid
+        (-1 for none)
+        """
+        x = tile % self.tilesInX
+        y = tile / self.tilesInX
+        r = self.radius
+        return grid[max(0, y - r):y + r + 1, max(0, x - r):x + r + 1]
+
+    def repair(self, candidates, costs, assigned, fallback=None):
+        """Return a list of the keys placed on each tile: the auction result
+        (see auction), unless the key is within radius of the same key on a
+        better fitting tile; then the tile's next candidate that is not, or
+        the key fallback(tile, keys within radius) returns, if any.
+        """
+        numTiles = len(candidates)
+        grid = numpy.empty((self.tilesInY, self.tilesInX), dtype=numpy.int64)
+        grid.fill(-1)
+        placed = [None] * numTiles
+        order = sorted(range(numTiles),
+                       key=lambda i: costs[i][assigned[i]] if assigned[i] >= 0 \
+                                     else numpy.inf)
+
+        for tile in order:
+            near = self.neighbours(grid, tile)
+            keys = candidates[tile]
+            ranked = ([assigned[tile]] if assigned[tile] >= 0 else []) + \
+                     numpy.argsort(costs[tile], kind='mergesort').tolist()
+            for i in ranked:
+                if not (near == keys[i]).any():
+                    key = keys[i]
+                    self.stats['moved'] += i != assigned[tile]
+                    break
+            else:
+                key = fallback(tile, set(near[near >= 0].tolist())) \
+                      if fallback is not None else None
+                if key is not None:
+                    self.stats['fallbacks'] += 1
+                elif len(keys):
+                    # Nothing else to use: repeat the best candidate
+                    key = keys[int(numpy.argmin(costs[tile]))]
+                    self.stats['repeats'] += 1
+            placed[tile] = key
+            if key is not None:
+                grid[tile / self.tilesInX, tile % self.tilesInX] = key
+
+        return placed
+
+    def improve(self, candidates, costs, placed, sweeps=4):
+        """Solve each block again, given the keys placed around it: the tiles
+        of the block get the distinct candidates of least total cost that are
+        not within radius of the same key outside the block. Blocks whose
+        tiles were placed a key outside their candidates are left alone.
+        The block grid is shifted by half a block from one sweep to the next.
+        Candidates must be in increasing order of cost. Update placed (see
+        repair) in place.
+        """
+        grid = numpy.array([-1 if x is None else x for x in placed],
+                           dtype=numpy.int64).reshape(self.tilesInY,
+                                                      self.tilesInX)
+        keys = [x.tolist() for x in candidates]
+        positions = [dict([(k, i) for i, k in reversed(list(enumerate(x)))]) \
+                     for x in keys]
+        half = (self.radius + 1) / 2
+        offsets = [(0, 0), (half, half), (half, 0), (0, half)]
+
+        for sweep in range(sweeps):
+            improved = 0
+            for block in self.blocks(*offsets[sweep % len(offsets)]):
+                current = [positions[t].get(placed[t]) for t in block]
+                if None in current:
+                    continue
+                before = sum([costs[t][i] for t, i in zip(block, current)])
+
+                for t in block:
+                    grid[t / self.tilesInX, t % self.tilesInX] = -1
+                # The len(block) best candidates of each tile allowed by the
+                # ones around the block (see auction)
+                allowed = []
+                for t in block:
+                    near = set(self.neighbours(grid, t).ravel().tolist())
+                    allowed.append(numpy.fromiter(itertools.islice(
+                        (i for i, k in enumerate(keys[t]) if k not in near),
+                        len(block)), dtype=numpy.int64))
+                objects, numObjects = self._objects([candidates[t][x] for t, x in \
+                                                     zip(block, allowed)])
+                assigned, bids = auction(objects, [-costs[t][x] for t, x in \
+                                                   zip(block, allowed)],
+                                         numObjects, self.epsilon)
+                assigned = [x[i] if i >= 0 else -1 for x, i in zip(allowed, assigned)]
+                self.stats['bids'] += bids
+
+                if -1 not in assigned and \
+                   sum([costs[t][i] for t, i in zip(block, assigned)]) < before:
+                    current = assigned
+                    improved += 1
+                for t, i in zip(block, current):
+                    placed[t] = candidates[t][i]
+                    grid[t / self.tilesInX, t % self.tilesInX] = placed[t]
+
+            self.stats['improved'] += improved
+            if not improved and sweep >= len(offsets) - 1:
+                break
+
+        return placed
+
+    def assign(self, candidates, costs, fallback=None, sweeps=4):
+        """Return a list of the keys placed on each tile (None if none could
+        be), see auction, repair and improve
+        """
+        order = [numpy.argsort(x, kind='mergesort') for x in costs]
+        candidates = [x[i] for x, i in zip(candidates, order)]
+        costs = [x[i] for x, i in zip(costs, order)]
+        assigned = self.auction(candidates, costs)
+        placed = self.repair(candidates, costs, assigned, fallback)
+        return self.improve(candidates, costs, placed, sweeps)
+
+
+def assignTiles(index, tileVectors, tilesInX, tilesInY, frameAspect,
+                aspectTolerance=0.1, radius=4, depth=32, dedup=True):
+    """Pick the images of all the mosaic tiles at once with a TileAssigner,
+    given the ColorIndex and the (tiles x values) array of the tile vectors
+    at the finest mip level, tiles in raster order. At least depth candidates
+    are ranked per tile. Identical copies of an image (same pixel hash) count
+    as one image if dedup is True.
+    Return a list of the ImageFilesTable instances of the tiles.
+    Raise ValueError if no image of the library matches the frame aspect.
+    """
+    start = time.time()
+    assigner = TileAssigner(tilesInX, tilesInY, radius)
+    depth = assigner.depth(depth)
+    mipIndex = index.level(tileVectors[0])
+    imageIDs, distances, complete = \
+        BatchMatcher(index, depth=depth).rankLevel(tileVectors, frameAspect,
+                                                   aspectTolerance)
+    images = dict([(x.id, x) for x in \
+                   index.imagesByIDs(numpy.unique(imageIDs).tolist())])
+
+    # Keys: images, or sets of identical copies of images
+    keyByName = {}
+    keyIDs = []
+
+    def keyOf(imageID):
+        ift = images.get(imageID)
+        name = ift.hash if dedup and ift is not None and ift.hash else imageID
+        if name not in keyByName:
+            keyByName[name] = len(keyIDs)
+            keyIDs.append(imageID)
+        return keyByName[name]
+
+    uniqueIDs, inverse = numpy.unique(imageIDs, return_inverse=True)
+    keys = numpy.array([keyOf(x) if x in images else -1 \
+                        for x in uniqueIDs.tolist()],
+                       dtype=numpy.int64)[inverse].reshape(imageIDs.shape)
+    # Tiles with several copies of an image among their candidates (or
+    # images gone from the database) keep the first (closest) one only
+    ordered = numpy.sort(keys, axis=1)
+    clean = ~((ordered[:, 1:] == ordered[:, :-1]).any(axis=1) | \
+              (ordered[:, 0] < 0))
+    candidates = []
+    costs = []
+    for tile in range(len(keys)):
+        if clean[tile]:
+            candidates.append(keys[tile])
+            costs.append(distances[tile])
+        else:
+            unique, first = numpy.unique(keys[tile], return_index=True)
+            first = numpy.sort(first[unique >= 0])
+            candidates.append(keys[tile][first])
+            costs.append(distances[tile][first])
+
+    def fallback(tile, nearKeys):
+        exclude = [keyIDs[x] for x in nearKeys]
+        found = mipIndex.findClosest(tileVectors[tile], frameAspect,
+                                     aspectTolerance, len(exclude) + depth,
+                                     exclude)
+        for ift in index.imagesByIDs(found):
+            images[ift.id] = ift
+            if keyOf(ift.id) not in nearKeys:
+                return keyOf(ift.id)
+        return None
+
+    placed = assigner.assign(candidates, costs, fallback)
+    if None in placed:
+        raise ValueError('No image found for %d tile(s) within aspect %g +/- %g' % \
+                         (placed.count(None), frameAspect, aspectTolerance))
+    result = [images[keyIDs[x]] for x in placed]
+
+    total = sum([mipIndex.distance(x.id, v) for x, v in \
+                 zip(result, tileVectors)])
+    log.info('%d tiles assigned in %.2fs (%d bids; %d moved, %d looked up '
+             'again, %d repeated to keep them apart, %d blocks improved), '
+             'mean distance %g' % \
+             (len(result), time.time() - start, assigner.stats['bids'],
+              assigner.stats['moved'], assigner.stats['fallbacks'],
+              assigner.stats['repeats'], assigner.stats['improved'],
+              total / max(1, len(result))))
+    return result
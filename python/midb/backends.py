@@ -0,0 +1,587 @@
+#!/usr/bin/env python
+
+"""Storage backends under db.Connection: the MySQL server of the image
+database, or an embedded SQLite database file for single-node use.
+Table classes write MySQL flavoured SQL (%s placeholders, ON DUPLICATE KEY
+UPDATE, DESCRIBE); the SQLite backend translates it.
+"""
+import os
+import re
+import math
+import logging
+import sqlite3
+import threading
+import contextlib
+
+try:
+    import MySQLdb
+    import MySQLdb.cursors
+except ImportError:
+    MySQLdb = None
+
+from config import Config
+
+log = logging.getLogger('midb.backends')
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '..', '..', 'DB', 'my_image_db.sql')
+
+
+def openBackend(name=None):
+    """Return a new backend instance for the name ('mysql' or 'sqlite'),
+    Config.DB_BACKEND by default
+    """
+    name = name or Config.DB_BACKEND
+    if name == 'mysql':
+        return MySQLBackend()
+    if name == 'sqlite':
+        return SQLiteBackend()
+    raise ValueError('%s: unknown database backend' % name)
+
+
+class BackendBase(object):
+    """Connection pool and per-thread connection and cursor of a backend.
+    Each thread gets a connection of its own from the pool and keeps reusing
+    it, and its cursor, for the short queries; streaming cursors are opened
+    on pooled connections, returned to the pool afterwards.
+    """
+    name = None
+    # Idle connections kept in the pool
+    poolSize = 4
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = []
+        self._local = threading.local()
+        # Per-thread connections, closed by close()
+        self._owned = []
+
+    def _connect(self):
+        """Return a new connection. Subclasses must re-implement.
+        """
+        raise NotImplementedError('%s._connect' % type(self).__name__)
+
+    def _usable(self, connection):
+        """Return True if the idle pooled connection can still be used
+        """
+        return True
+
+    def _newCursor(self, connection, asDict=True, streaming=False):
+        """Return a new cursor on the connection. Subclasses must re-implement.
+        """
+        raise NotImplementedError('%s._newCursor' % type(self).__name__)
+
+    def acquire(self):
+        """Return a connection from the pool, or a new one if none is idle
+        """
+        while True:
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                return self._connect()
+            if self._usable(connection):
+                return connection
+
+    def release(self, connection):
+        """Return the connection to the pool (closing it if the pool is full)
+        """
+        with self._lock:
+            if len(self._idle) < self.poolSize:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def connection(self):
+        """Return the connection of the calling thread
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self.acquire()
+            self._local.connection = connection
+            self._local.cursor = None
+            with self._lock:
+                self._owned.append(connection)
+        return connection
+
+    def cursor(self):
+        """Return the (reused) dictionary cursor of the calling thread
+        """
+        connection = self.connection()
+        if self._local.cursor is None:
+            self._local.cursor = self._newCursor(connection)
+        return self._local.cursor
+
+    @contextlib.contextmanager
+    def streaming(self, asDict=True):
+        """Context manager returning a cursor fetching the rows as they are
+        read (see Connection.streaming), on a pooled connection
+        """
+        connection = self.acquire()
+        cursor = self._newCursor(connection, asDict, streaming=True)
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+            self.release(connection)
+
+    def describe(self, table):
+        """Return the rows of the MySQL DESCRIBE <table> query (see
+        DBTableBase._schema). Subclasses must re-implement.
+        """
+        raise NotImplementedError('%s.describe' % type(self).__name__)
+
+    def tables(self):
+        """Return a list of the names of the tables in the database.
+        Subclasses must re-implement.
+        """
+        raise NotImplementedError('%s.tables' % type(self).__name__)
+
+    def executeSchema(self, schema):
+        """Run the statements of a MySQL schema dump (see DB/my_image_db.sql).
+        Subclasses must re-implement.
+        """
+        raise NotImplementedError('%s.executeSchema' % type(self).__name__)
+
+    def binary(self, value):
+        """Return the byte string value as a bound parameter for a BLOB column
+        """
+        return value
+
+    def close(self):
+        with self._lock:
+            connections, self._idle = self._idle + self._owned, []
+            self._owned = []
+        for x in connections:
+            try:
+                x.close()
+            except Exception, e:
+                log.debug('Closing a %s connection: %s' % (self.name, e))
+        self._local = threading.local()
+
+
+class MySQLBackend(BackendBase):
+    """The MySQL (or MariaDB) server at Config.DB_HOST. The database is
+    selected when connecting, not with a USE statement per cursor.
+    """
+    name = 'mysql'
+
+    def __init__(self, host=None, db=None, user=None, passwd=None):
+        BackendBase.__init__(self)
+        if MySQLdb is None:
+            raise ImportError('The MySQLdb module is needed for the mysql '
+                              'database backend')
+        self.host = host or Config.DB_HOST
+        self.db = db or Config.DB_NAME
+        self.user = user or Config.USERNAME
+        self.passwd = passwd if passwd is not None else Config.PASSWD
+
+    def _connect(self):
+        connection = MySQLdb.connect(host=self.host, user=self.user,
+                                     passwd=self.passwd, db=self.db)
+        connection.autocommit(True)
+        return connection
+
+    def _usable(self, connection):
+        try:
+            connection.ping()
+            return True
+        except MySQLdb.Error, e:
+            log.info('Dropping a stale pooled connection: %s' % e)
+            try:
+                connection.close()
+            except MySQLdb.Error:
+                pass
+            return False
+
+    def _newCursor(self, connection, asDict=True, streaming=False):
+        if streaming:
+            cursorClass = MySQLdb.cursors.SSDictCursor if asDict \
+                          else MySQLdb.cursors.SSCursor
+        else:
+            cursorClass = MySQLdb.cursors.DictCursor if asDict \
+                          else MySQLdb.cursors.Cursor
+        return connection.cursor(cursorClass)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        connection = self.connection()
+        cursor = self.cursor()
+        connection.autocommit(False)
+        try:
+            yield cursor
+            connection.commit()
+        except:
+            connection.rollback()
+            raise
+        finally:
+            connection.autocommit(True)
+
+    def describe(self, table):
+        cursor = self._newCursor(self.connection())
+        try:
+            cursor.execute('DESCRIBE %s' % table)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def tables(self):
+        cursor = self._newCursor(self.connection(), asDict=False)
+        try:
+            cursor.execute('SHOW TABLES')
+            return [x[0] for x in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    def executeSchema(self, schema):
+        lines = [x for x in schema.splitlines() if not x.startswith('--')]
+        cursor = self._newCursor(self.connection(), asDict=False)
+        try:
+            for sql in '\n'.join(lines).split(';\n'):
+                if sql.strip():
+                    cursor.execute(sql)
+        finally:
+            cursor.close()
+
+
+class SQLiteBackend(BackendBase):
+    """Embedded SQLite database in the file at Config.DB_PATH, created from
+    the MySQL schema file (see sqliteSchema) if it has no tables yet.
+    The database is in WAL mode, so readers do not block the writer (and
+    other processes can read while images are stored). Statements are
+    prepared once per connection and cached by the sqlite3 module.
+    """
+    name = 'sqlite'
+    # Prepared statements cached per connection
+    cachedStatements = 256
+    # Statement translations cached
+    maxTranslated = 1024
+
+    def __init__(self, path=None, schemaFile=None):
+        BackendBase.__init__(self)
+        self.path = path or Config.DB_PATH
+        self.schemaFile = schemaFile or SCHEMA_FILE
+        # table: conflict target columns of its ON DUPLICATE KEY UPDATE
+        self._uniqueKeys = {}
+        # (MySQL statement, has arguments): SQLite statement
+        self._translated = {}
+        self._created = False
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=60,
+                                     isolation_level=None,
+                                     detect_types=sqlite3.PARSE_DECLTYPES,
+                                     check_same_thread=False,
+                                     cached_statements=self.cachedStatements)
+        connection.text_factory = str
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = NORMAL')
+        connection.execute('PRAGMA foreign_keys = ON')
+        try:
+            connection.execute('SELECT POW(2, 2)')
+        except sqlite3.OperationalError:
+            # Not built with the math functions
+            connection.create_function('POW', 2, math.pow)
+
+        if not self._created:
+            self._createSchema(connection)
+            self._created = True
+        return connection
+
+    def _createSchema(self, connection):
+        """Create the tables, unless the database has some already
+        """
+        tables = connection.execute("SELECT COUNT(*) FROM sqlite_master "
+                                    "WHERE type = 'table'").fetchone()[0]
+        if tables:
+            return
+        log.info('%s: creating the database tables' % self.path)
+        f = file(self.schemaFile)
+        try:
+            statements = sqliteSchema(f.read())
+        finally:
+            f.close()
+        connection.executescript(';\n'.join(statements) + ';')
+
+    def tables(self):
+        return [x[0] for x in self.connection().execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' "
+                    "AND name NOT LIKE 'sqlite_%'").fetchall()]
+
+    def executeSchema(self, schema):
+        self.connection().executescript(';\n'.join(sqliteSchema(schema)) + ';')
+
+    def binary(self, value):
+        # Byte strings would be bound as TEXT
+        return buffer(value)
+
+    def _newCursor(self, connection, asDict=True, streaming=False):
+        return SQLiteCursor(self, connection.cursor(), asDict)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        cursor = self.cursor()
+        # Take the write lock right away, rather than failing to upgrade a
+        # read lock later on
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            yield cursor
+            cursor.execute('COMMIT')
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+
+    def _sql(self, statement, table):
+        return self.connection().execute(statement % table).fetchall()
+
+    def _indexes(self, table):
+        """Return (name, unique, origin) tuples of the indexes of the table
+        (origin is 'pk' for the primary key one)
+        """
+        # Older SQLite versions only return the first three columns
+        return [(x[1], x[2], x[3] if len(x) > 3 else 'c') \
+                for x in self._sql('PRAGMA index_list(%s)', table)]
+
+    def uniqueKey(self, table):
+        """Return the columns of the (first) unique key of the table, other
+        than its primary key: the conflict target of upserts into it
+        """
+        if table not in self._uniqueKeys:
+            key = None
+            for name, unique, origin in sorted(self._indexes(table)):
+                if unique and origin != 'pk':
+                    key = [x[2] for x in self._sql('PRAGMA index_info(%s)', name)]
+                    break
+            if key is None:
+                key = [x[1] for x in self._sql('PRAGMA table_info(%s)', table) \
+                       if x[5]]
+            self._uniqueKeys[table] = key
+        return self._uniqueKeys[table]
+
+    def describe(self, table):
+        unique = set()
+        for name, isUnique, origin in self._indexes(table):
+            columns = [x[2] for x in self._sql('PRAGMA index_info(%s)', name)]
+            if isUnique and origin != 'pk' and len(columns) == 1:
+                unique.add(columns[0])
+
+        rows = self.connection().execute("SELECT sql FROM sqlite_master "
+                                         "WHERE type = 'table' AND name = ?",
+                                         (table,)).fetchall()
+        enums = dict(_enumCheckRegex.findall(rows[0][0])) if rows else {}
+
+        result = []
+        for cid, name, type_, notnull, default, pk in \
+            self._sql('PRAGMA table_info(%s)', table):
+            if default is not None and default[:1] == "'":
+                default = default[1:-1]
+            result.append({'Field': name,
+                           'Type': 'enum(%s)' % enums[name] if name in enums \
+                                   else type_.lower(),
+                           'Null': 'NO' if notnull or pk else 'YES',
+                           'Key': 'PRI' if pk else 'UNI' if name in unique else '',
+                           'Default': default,
+                           'Extra': 'auto_increment' if pk and \
+                                    type_.upper() == 'INTEGER' else ''})
+        return result
+
+    def translate(self, sql, hasArgs):
+        """Return the SQLite version of the MySQL statement: %s placeholders
+        (and %% escapes) replaced if hasArgs is True (as MySQLdb only formats
+        statements given arguments), ON DUPLICATE KEY UPDATE replaced by an
+        ON CONFLICT clause on the unique key of the table
+        """
+        key = (sql, hasArgs)
+        translated = self._translated.get(key)
+        if translated is not None:
+            return translated
+
+        translated = sql
+        if hasArgs:
+            translated = _placeholderRegex.sub(
+                lambda m: m.group(1) or ('?' if m.group(2) == 's' else '%'),
+                translated)
+        m = _upsertRegex.match(translated)
+        if m:
+            translated = '%s ON CONFLICT(%s) DO UPDATE SET %s' % \
+                         (m.group(1),
+                          ','.join(self.uniqueKey(m.group(2))),
+                          _valuesRegex.sub(r'excluded.\1', m.group(3)))
+
+        # Statements with literal values in them are one-offs: do not let
+        # them pile up
+        if len(self._translated) >= self.maxTranslated:
+            self._translated.clear()
+        self._translated[key] = translated
+        return translated
+
+
+# Placeholders (and escaped %) outside of string literals
+_placeholderRegex = re.compile(r"('(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\")|%(s|%)")
+_upsertRegex = re.compile(r'^(\s*INSERT\s+INTO\s+(\w+).*?)\s+'
+                          r'ON\s+DUPLICATE\s+KEY\s+UPDATE\s+(.*)$', re.S | re.I)
+_valuesRegex = re.compile(r'\bVALUES\((\w+)\)', re.I)
+
+
+class SQLiteCursor(object):
+    """sqlite3 cursor taking the MySQL flavoured SQL of the table classes
+    (see SQLiteBackend.translate). Rows are fetched as dictionaries if asDict
+    is True.
+    """
+    def __init__(self, backend, cursor, asDict=True):
+        self._backend = backend
+        self._cursor = cursor
+        if asDict:
+            cursor.row_factory = _dictRow
+        self._last_executed = None
+
+    def execute(self, sql, args=None):
+        self._last_executed = sql
+        if args is None:
+            return self._cursor.execute(self._backend.translate(sql, False))
+        return self._cursor.execute(self._backend.translate(sql, True),
+                                    tuple(args))
+
+    def executemany(self, sql, args):
+        self._last_executed = sql
+        return self._cursor.executemany(self._backend.translate(sql, True),
+                                        [tuple(x) for x in args])
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def _dictRow(cursor, row):
+    return dict(zip([x[0] for x in cursor.description], row))
+
+
+_enumCheckRegex = re.compile(r'CHECK \((\w+) IN \(([^)]*)\)\)')
+
+_createRegex = re.compile(r'^CREATE TABLE (?:IF NOT EXISTS )?`?(\w+)`?\s*\((.*)\)[^)]*$',
+                          re.S | re.I)
+_columnRegex = re.compile(r'^`?(\w+)`?\s+(\w+)(\([^)]*\))?(.*)$')
+_alterRegex = re.compile(r'^ALTER TABLE `?(\w+)`?\s+(.*)$', re.S | re.I)
+_keyRegex = re.compile(r'^ADD (PRIMARY|UNIQUE)?\s*KEY\s*`?(\w*)`?\s*\(([^)]*(?:\)[^)]*)*)\)'
+                       r'(?: USING \w+)?$', re.I)
+_foreignKeyRegex = re.compile(r'^ADD CONSTRAINT `?\w+`? FOREIGN KEY \(([^)]*)\) '
+                              r'REFERENCES `?(\w+)`? \(([^)]*)\)(.*)$', re.I)
+_modifyRegex = re.compile(r'^MODIFY `?(\w+)`?.*\bAUTO_INCREMENT\b', re.I)
+
+_sqliteTypes = {'tinyint': 'INTEGER', 'smallint': 'INTEGER', 'mediumint': 'INTEGER',
+                'int': 'INTEGER', 'integer': 'INTEGER', 'bigint': 'INTEGER',
+                'float': 'REAL', 'double': 'REAL', 'decimal': 'REAL',
+                'char': 'TEXT', 'varchar': 'TEXT', 'tinytext': 'TEXT',
+                'text': 'TEXT', 'mediumtext': 'TEXT', 'longtext': 'TEXT',
+                'enum': 'TEXT',
+                'date': 'DATE', 'datetime': 'TIMESTAMP', 'timestamp': 'TIMESTAMP',
+                'tinyblob': 'BLOB', 'blob': 'BLOB', 'mediumblob': 'BLOB',
+                'longblob': 'BLOB'}
+
+
+def _keyColumns(columns):
+    """Return the column names of a MySQL key definition, without the
+    backquotes and index prefix lengths
+    """
+    return [re.sub(r'\(\d+\)', '', x).strip().strip('`') for x in columns.split(',')]
+
+
+def sqliteSchema(mysqlSchema):
+    """Translate the MySQL dump of the database schema (see DB/my_image_db.sql)
+    into a list of SQLite statements: the tables with their primary and
+    foreign keys, indexes, and triggers for the ON UPDATE CURRENT_TIMESTAMP
+    columns.
+    """
+    lines = [x for x in mysqlSchema.splitlines() if not x.strip().startswith('--')]
+    text = re.sub(r'/\*!.*?\*/', '', '\n'.join(lines), flags=re.S)
+    statements = [x.strip() for x in text.split(';') if x.strip()]
+
+    tables = []
+    columns = {}
+    primaryKeys = {}
+    autoIncrements = {}
+    foreignKeys = {}
+    indexes = []
+    onUpdate = []
+
+    for statement in statements:
+        m = _createRegex.match(statement)
+        if m:
+            table = m.group(1)
+            tables.append(table)
+            columns[table] = []
+            for line in m.group(2).splitlines():
+                line = line.strip().rstrip(',')
+                cm = _columnRegex.match(line)
+                if not line or not cm:
+                    continue
+                name, type_, size, rest = cm.groups()
+                columns[table].append((name, type_.lower(), size, rest))
+            continue
+
+        m = _alterRegex.match(statement)
+        if not m:
+            continue
+        table = m.group(1)
+        for clause in m.group(2).splitlines():
+            clause = clause.strip().rstrip(',')
+            km = _keyRegex.match(clause)
+            fm = _foreignKeyRegex.match(clause)
+            mm = _modifyRegex.match(clause)
+            if km:
+                kind, name, keyColumns = km.groups()
+                if kind and kind.upper() == 'PRIMARY':
+                    primaryKeys[table] = _keyColumns(keyColumns)
+                else:
+                    indexes.append((table, name, bool(kind), _keyColumns(keyColumns)))
+            elif fm:
+                foreignKeys.setdefault(table, []).append(
+                    'FOREIGN KEY (%s) REFERENCES %s (%s)%s' % \
+                    (','.join(_keyColumns(fm.group(1))), fm.group(2),
+                     ','.join(_keyColumns(fm.group(3))), fm.group(4).rstrip()))
+            elif mm:
+                autoIncrements[table] = mm.group(1)
+
+    result = []
+    for table in tables:
+        primaryKey = primaryKeys.get(table, [])
+        definitions = []
+        for name, type_, size, rest in columns[table]:
+            sqliteType = _sqliteTypes.get(type_, 'TEXT')
+            if primaryKey == [name] and sqliteType == 'INTEGER':
+                definitions.append('%s INTEGER PRIMARY KEY%s' % \
+                                   (name, ' AUTOINCREMENT' \
+                                          if autoIncrements.get(table) == name else ''))
+                continue
+            definition = [name, sqliteType]
+            if re.search(r'\bNOT NULL\b', rest, re.I):
+                definition.append('NOT NULL')
+            default = re.search(r"\bDEFAULT ('[^']*'|[\w.-]+)", rest, re.I)
+            if default:
+                definition.append('DEFAULT %s' % default.group(1))
+            if type_ == 'enum':
+                definition.append('CHECK (%s IN %s)' % (name, size))
+            if re.search(r'\bON UPDATE CURRENT_TIMESTAMP\b', rest, re.I):
+                onUpdate.append((table, name))
+            definitions.append(' '.join(definition))
+        if primaryKey and not any([x.endswith('PRIMARY KEY') or \
+                                   x.endswith('AUTOINCREMENT') for x in definitions]):
+            definitions.append('PRIMARY KEY (%s)' % ','.join(primaryKey))
+        definitions.extend(foreignKeys.get(table, []))
+        result.append('CREATE TABLE IF NOT EXISTS %s (\n  %s\n)' % \
+                      (table, ',\n  '.join(definitions)))
+
+    for table, name, unique, keyColumns in indexes:
+        result.append('CREATE %sINDEX IF NOT EXISTS %s_%s ON %s (%s)' % \
+                      ('UNIQUE ' if unique else '', table, name, table,
+                       ','.join(keyColumns)))
+
+    for table, name in onUpdate:
+        primaryKey = primaryKeys.get(table, ['rowid'])
+        result.append('CREATE TRIGGER IF NOT EXISTS %s_%s AFTER UPDATE ON %s '
+                      'FOR EACH ROW WHEN NEW.%s IS OLD.%s BEGIN '
+                      'UPDATE %s SET %s = CURRENT_TIMESTAMP WHERE %s; END' % \
+                      (table, name, table, name, name, table, name,
+                       ' AND '.join(['%s = NEW.%s' % (x, x) for x in primaryKey])))
+    return result
@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+
+"""Benchmarks of the ingest, query and mosaic stages, run against a synthetic
+image corpus and a scratch database. Results are JSON documents, so runs can
+be stored and compared against each other, see midb_bench.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import logging
+import platform
+import subprocess
+
+from config import Config
+from profiling import durationStats
+from backends import SCHEMA_FILE
+
+log = logging.getLogger('midb.benchmark')
+
+# Version of the results document layout
+RESULTS_VERSION = 1
+
+# Frame aspects and file formats of the corpus images, used round robin
+CORPUS_ASPECTS = ((4, 3), (3, 2), (1, 1), (2, 3), (16, 9), (3, 4))
+CORPUS_FORMATS = ('jpg', 'png', 'tif')
+
+
+class Corpus(object):
+    """Synthetic image corpus: count small images in subdirectories of root,
+    each a gradient between two random colors, with the frame aspects and
+    file formats of CORPUS_ASPECTS and CORPUS_FORMATS. Images are generated
+    with oiiotool, deterministically for a given seed; an existing corpus
+    made with the same parameters is reused.
+    """
+    imagesPerDir = 200
+    # Images generated per oiiotool command
+    imagesPerCommand = 50
+
+    def __init__(self, root, count=2000, seed=1, width=192):
+        self.root = root
+        self.count = count
+        self.seed = seed
+        self.width = width
+
+    def params(self):
+        return {'count': self.count, 'seed': self.seed, 'width': self.width,
+                'aspects': ['%d:%d' % x for x in CORPUS_ASPECTS],
+                'formats': list(CORPUS_FORMATS)}
+
+    def images(self):
+        """Return a list of (path, width, height, top color, bottom color)
+        tuples, one per image of the corpus
+        """
+        rand = random.Random(self.seed)
+        result = []
+        for i in range(self.count):
+            aw, ah = CORPUS_ASPECTS[i % len(CORPUS_ASPECTS)]
+            fmt = CORPUS_FORMATS[i % len(CORPUS_FORMATS)]
+            w = self.width
+            h = max(1, int(self.width * ah / float(aw) + 0.5))
+            top = tuple([rand.random() for c in range(3)])
+            bottom = tuple([rand.random() for c in range(3)])
+            path = os.path.join(self.root, 'd%03d' % (i / self.imagesPerDir),
+                                'img%06d.%s' % (i, fmt))
+            result.append((path, w, h, top, bottom))
+        return result
+
+    def generate(self):
+        """Generate the corpus images, unless they are there already.
+        Return the time spent, in seconds.
+        """
+        manifest = os.path.join(self.root, 'corpus.json')
+        if os.path.exists(manifest):
+            f = file(manifest)
+            try:
+                if json.load(f) == self.params():
+                    log.info('Reusing the corpus in %s' % self.root)
+                    return 0.0
+            finally:
+                f.close()
+            log.info('Corpus parameters changed, regenerating %s' % self.root)
+            shutil.rmtree(self.root)
+
+        start = time.time()
+        images = self.images()
+        for path, w, h, top, bottom in images:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+
+        for begin in range(0, len(images), self.imagesPerCommand):
+            log.info('Generating corpus images %d to %d of %d...' % \
+                     (begin + 1, min(len(images), begin + self.imagesPerCommand),
+                      len(images)))
+            cmd = ['oiiotool']
+            for path, w, h, top, bottom in images[begin:begin + self.imagesPerCommand]:
+                cmd.extend(['--pattern',
+                            'fill:top=%.4f,%.4f,%.4f:bottom=%.4f,%.4f,%.4f' % \
+                            (top + bottom),
+                            '%dx%d' % (w, h), '3',
+                            '-d', 'uint8', '-o', path])
+            subprocess.check_call(cmd)
+
+        f = file(manifest, 'w')
+        try:
+            json.dump(self.params(), f)
+        finally:
+            f.close()
+        return time.time() - start
+
+
+class ScratchDatabase(object):
+    """A database of its own for the benchmarks, created from the schema file:
+    Config is pointed at it, so all of midb uses it.
+    """
+    def __init__(self, host='localhost', name='my_image_db_bench', user=None,
+                 passwd=None):
+        if name == Config.DB_NAME and host == Config.DB_HOST:
+            raise ValueError('%s@%s is the image database, not a scratch one' % \
+                             (name, host))
+        self.host = host
+        self.name = name
+        self.user = user or Config.USERNAME
+        self.passwd = passwd if passwd is not None else Config.PASSWD
+
+    def use(self):
+        """Point Config (and the midb connections) at the scratch database
+        """
+        from db import Connection
+        Connection.disconnect()
+        Config.DB_BACKEND = 'mysql'
+        Config.DB_HOST = self.host
+        Config.DB_NAME = self.name
+        Config.USERNAME = self.user
+        Config.PASSWD = self.passwd
+
+    def reset(self):
+        """(Re)create the scratch database, empty
+        """
+        import MySQLdb
+        from db import Connection
+        Connection.disconnect()
+
+        f = file(SCHEMA_FILE)
+        try:
+            lines = [x for x in f.read().splitlines() if not x.startswith('--')]
+        finally:
+            f.close()
+        statements = [x.strip() for x in '\n'.join(lines).split(';\n') if x.strip()]
+
+        log.info('Creating the scratch database %s@%s' % (self.name, self.host))
+        connection = MySQLdb.connect(host=self.host, user=self.user,
+                                     passwd=self.passwd)
+        try:
+            cursor = connection.cursor()
+            cursor.execute('DROP DATABASE IF EXISTS `%s`' % self.name)
+            cursor.execute('CREATE DATABASE `%s`' % self.name)
+            cursor.execute('USE `%s`' % self.name)
+            for sql in statements:
+                cursor.execute(sql)
+            connection.commit()
+        finally:
+            connection.close()
+        self.use()
+
+
+class ScratchSQLiteDatabase(object):
+    """An embedded SQLite database file for the benchmarks, see
+    ScratchDatabase
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def use(self):
+        from db import Connection
+        Connection.disconnect()
+        Config.DB_BACKEND = 'sqlite'
+        Config.DB_PATH = self.path
+
+    def reset(self):
+        """Remove the database file: it is created again, empty, on first use
+        """
+        from db import Connection
+        Connection.disconnect()
+        log.info('Creating the scratch database %s' % self.path)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.unlink(self.path + suffix)
+        self.use()
+
+
+class Benchmark(object):
+    """Runs the benchmark stages and collects their results
+    """
+    def __init__(self, workDir, corpus, database, jobs=1, batchSize=64,
+                 queries=200, tileCounts=(8, 16, 32), resolution=1024, seed=1):
+        self.workDir = workDir
+        self.corpus = corpus
+        self.database = database
+        self.jobs = jobs
+        self.batchSize = batchSize
+        self.queries = queries
+        self.tileCounts = tileCounts
+        self.resolution = resolution
+        self.seed = seed
+
+    def params(self):
+        return {'corpus': self.corpus.params(), 'jobs': self.jobs,
+                'batch_size': self.batchSize, 'queries': self.queries,
+                'backend': 'sqlite' if isinstance(self.database,
+                                                  ScratchSQLiteDatabase) \
+                           else 'mysql',
+                'tile_counts': list(self.tileCounts),
+                'resolution': self.resolution, 'seed': self.seed}
+
+    def _useScratchDirs(self):
+        """Keep the image root, thumbnails and tile cache of the runs in the
+        work directory
+        """
+        Config.IMG_ROOT = self.corpus.root
+        Config.THUMBNAIL_DIR = os.path.join(self.workDir, 'thumbnails')
+        Config.TILE_CACHE_DIR = os.path.join(self.workDir, 'tiles')
+
+    @staticmethod
+    def _clearScratchDir(path):
+        """Remove the scratch directory at path (see _useScratchDirs), if any
+        """
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+    def runIngest(self):
+        """Store the whole corpus in an empty database. Return the results.
+        """
+        import midb
+        from db import ImageFilesTable
+
+        self.database.reset()
+        self._useScratchDirs()
+        # The thumbnails of the images of the previous database
+        self._clearScratchDir(Config.THUMBNAIL_DIR)
+
+        start = time.time()
+        midb.processImageDir(self.corpus.root, jobs=self.jobs,
+                             batchSize=self.batchSize, journal=False)
+        elapsed = time.time() - start
+
+        stored = ImageFilesTable._findSQL(asCount=True)
+        return {'images': stored,
+                'seconds': elapsed,
+                'images_per_second': stored / elapsed if elapsed > 0 else 0.0}
+
+    def _queryVectors(self, values):
+        rand = random.Random(self.seed * 1000 + values)
+        return [([rand.random() for i in range(values)],
+                 float(aw) / ah) for aw, ah in \
+                [CORPUS_ASPECTS[rand.randrange(len(CORPUS_ASPECTS))] \
+                 for n in range(self.queries)]]
+
+    def runQueries(self):
+        """Time findByClosestColors at each mip level, both with the database
+        queries and the in-memory ColorIndex. Return the results.
+        """
+        from db import ImageFilesTable
+        from index import ColorIndex
+
+        start = time.time()
+        index = ColorIndex.load()
+        result = {'index_load_ms': (time.time() - start) * 1000.0}
+
+        for level, values in enumerate((3, 12, 48)):
+            vectors = self._queryVectors(values)
+            for name, finder in (('sql', ImageFilesTable), ('index', index)):
+                log.info('Timing %d %s queries by %d sample(s)...' % \
+                         (len(vectors), name, values / 3))
+                samples = []
+                for pixels, aspect in vectors:
+                    start = time.time()
+                    finder.findByClosestColors(pixels, aspect, limit=16)
+                    samples.append(time.time() - start)
+                result['level%d_%s' % (level, name)] = durationStats(samples)
+
+        result['cascade'] = self.runCascade(index)
+        return result
+
+    def _pyramidVectors(self):
+        """Return a list of ([1x1, 2x2, 4x4 pixel values], frame aspect) query
+        tuples: random 4x4 pixels and their averages
+        """
+        import numpy
+        result = []
+        for pixels, aspect in self._queryVectors(48):
+            fine = numpy.asarray(pixels).reshape(4, 4, 3)
+            medium = fine.reshape(2, 2, 2, 2, 3).mean(axis=(1, 3))
+            result.append(([fine.mean(axis=(0, 1)).tolist(),
+                            medium.ravel().tolist(),
+                            fine.ravel().tolist()], aspect))
+        return result
+
+    def runCascade(self, index, limit=16):
+        """Time ColorIndex.findCascade against the full search by 16 samples
+        of the index, and measure its recall: the fraction of the limit
+        closest images of the full search it finds too. Return the results.
+        """
+        vectors = self._pyramidVectors()
+        log.info('Timing %d cascade queries...' % len(vectors))
+        samples = []
+        found = 0
+        expected = 0
+        for pixelsByLevel, aspect in vectors:
+            start = time.time()
+            cascade = index.findCascade(pixelsByLevel, aspect, limit=limit)
+            samples.append(time.time() - start)
+            full = index.findByClosestColors(pixelsByLevel[-1], aspect,
+                                             limit=limit)
+            expected += len(full)
+            found += len(set([x.id for x in full]) & \
+                         set([x.id for d, x in cascade]))
+        result = durationStats(samples)
+        result['recall'] = found / float(expected) if expected else 1.0
+        return result
+
+    def runMosaics(self):
+        """Time makeMosaicImage for each of the tile counts. Return the results.
+        """
+        import midb
+
+        infile = os.path.join(self.workDir, 'mosaic_in.png')
+        subprocess.check_call(['oiiotool', '--pattern',
+                               'fill:topleft=0.9,0.1,0.1:topright=0.1,0.9,0.1:'
+                               'bottomleft=0.1,0.1,0.9:bottomright=0.9,0.9,0.1',
+                               '640x480', '3', '-d', 'uint8', '-o', infile])
+        self._useScratchDirs()
+        result = {}
+        for tiles in self.tileCounts:
+            # The thumbnails stored at ingest time are kept: they are used
+            # by default
+            self._clearScratchDir(Config.TILE_CACHE_DIR)
+            outfile = os.path.join(self.workDir, 'mosaic_%d.png' % tiles)
+            start = time.time()
+            midb.makeMosaicImage(infile, tiles, self.resolution, outfile,
+                                 tileCache=False)
+            result['tiles%d' % tiles] = {'seconds': time.time() - start}
+        return result
+
+    def run(self, stages=('ingest', 'query', 'mosaic')):
+        """Run the given stages, return the results document
+        """
+        if not os.path.isdir(self.workDir):
+            os.makedirs(self.workDir)
+
+        results = {'version': RESULTS_VERSION,
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'host': socket.gethostname(),
+                   'platform': platform.platform(),
+                   'python': sys.version.split()[0],
+                   'revision': gitRevision(),
+                   'params': self.params(),
+                   'results': {}}
+
+        results['results']['corpus_seconds'] = self.corpus.generate()
+
+        if 'ingest' in stages:
+            results['results']['ingest'] = self.runIngest()
+        else:
+            self.database.use()
+            self._useScratchDirs()
+        if 'query' in stages:
+            results['results']['query'] = self.runQueries()
+        if 'mosaic' in stages:
+            results['results']['mosaic'] = self.runMosaics()
+        return results
+
+
+def gitRevision():
+    """Return the git revision of the source tree, or None if unknown
+    """
+    try:
+        p = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out = p.communicate()[0].strip()
+    except OSError:
+        return None
+    return out if p.returncode == 0 else None
+
+
+def flatten(results, prefix=''):
+    """Return a dictionary of the numeric leaves of the results, keyed by
+    their dotted paths
+    """
+    flat = {}
+    for k, v in results.items():
+        if isinstance(v, dict):
+            flat.update(flatten(v, prefix + k + '.'))
+        elif isinstance(v, (int, long, float)) and not isinstance(v, bool):
+            flat[prefix + k] = v
+    return flat
+
+
+# Metrics where larger values are better; for all the others (durations),
+# smaller ones are
+HIGHER_IS_BETTER = ('images_per_second', 'recall')
+
+
+def compare(baseline, current, threshold=0.1):
+    """Compare two results documents. Return a list of (metric, baseline value,
+    current value, relative change, regression) tuples for the metrics both
+    have, regression being True if the metric got worse by more than threshold.
+    Counts and the corpus generation time are not compared.
+    """
+    old = flatten(baseline['results'])
+    new = flatten(current['results'])
+    result = []
+    for metric in sorted(set(old) & set(new)):
+        if metric.endswith('.count') or metric.endswith('.images') or \
+           metric == 'corpus_seconds':
+            continue
+        if old[metric] == 0:
+            continue
+        change = (new[metric] - old[metric]) / float(old[metric])
+        if metric.split('.')[-1] in HIGHER_IS_BETTER:
+            regression = change < -threshold
+        else:
+            regression = change > threshold
+        result.append((metric, old[metric], new[metric], change, regression))
+    return result
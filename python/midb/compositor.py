@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+"""Mosaic image compositing: resize the source images of the mosaic tiles and
+put them together into the output image.
+"""
+import os
+import shutil
+import logging
+import tempfile
+import subprocess
+import collections
+import multiprocessing.pool
+import numpy
+
+import profiling
+
+try:
+    import OpenImageIO as oiio
+except ImportError:
+    oiio = None
+
+log = logging.getLogger('midb.compositor')
+
+
+def rgbPixels(pixels):
+    """Return the (height, width, channels) float pixels array as a (height,
+    width, 3) one: grayscale is replicated, extra channels (alpha) dropped.
+    """
+    if pixels.shape[-1] < 3:
+        return pixels[:, :, [0, 0, 0]]
+    return pixels[:, :, :3]
+
+
+class MosaicCompositor(object):
+    """Builds the mosaic in memory, with the OpenImageIO python module: every
+    distinct source image is read and resized once, on a pool of threads, and
+    copied straight into each of its tiles of a preallocated output canvas.
+    The canvas is written out once.
+    If a TileCache is given, resized tiles are looked up in it (and added to
+    it) by the tile keys passed to compose, the ones of the source resized.
+    If a ThumbnailStore is given, the stored thumbnails of the images are
+    resized instead of the original image files, whenever they are at least
+    as large as the tiles.
+    """
+    # Output file extensions the canvas is written as floats for; 8 bits
+    # per channel otherwise
+    floatFormats = ('.exr', '.hdr', '.pfm')
+
+    def __init__(self, tilesInX, tilesInY, tileSizeX, tileSizeY, jobs=4,
+                 cache=None, thumbnails=None):
+        self.tilesInX = tilesInX
+        self.tilesInY = tilesInY
+        self.tileSizeX = tileSizeX
+        self.tileSizeY = tileSizeY
+        self.jobs = max(1, jobs)
+        self.cache = cache
+        self.thumbnails = thumbnails
+        self.thumbnailsUsed = 0
+
+    def resize(self, path):
+        """Return the image file at path resized to the tile size, as a
+        (tileSizeY, tileSizeX, 3) float32 array
+        """
+        return self._resizeBuf(oiio.ImageBuf(path), path)
+
+    def resizePixels(self, pixels):
+        """Return the (height, width, 3) uint8 pixels array (e.g. a stored
+        thumbnail) resized to the tile size, as a (tileSizeY, tileSizeX, 3)
+        float32 array
+        """
+        h, w = pixels.shape[:2]
+        buf = oiio.ImageBuf(oiio.ImageSpec(w, h, 3, oiio.UINT8))
+        buf.set_pixels(oiio.ROI(0, w, 0, h, 0, 1, 0, 3), pixels)
+        return self._resizeBuf(buf, 'thumbnail')
+
+    def _resizeBuf(self, buf, name):
+        nchannels = buf.spec().nchannels
+        with profiling.timed('mosaic.resize'):
+            buf = oiio.ImageBufAlgo.resize(buf, roi=oiio.ROI(0, self.tileSizeX,
+                                                             0, self.tileSizeY,
+                                                             0, 1, 0, nchannels))
+        if buf.has_error:
+            raise RuntimeError('%s: %s' % (name, buf.geterror()))
+        pixels = buf.get_pixels(oiio.FLOAT).reshape(self.tileSizeY,
+                                                    self.tileSizeX, nchannels)
+        return rgbPixels(pixels)
+
+    def _thumbnail(self, imageID):
+        """Return the stored thumbnail of imageID if it is large enough to
+        make a tile of, None otherwise
+        """
+        if self.thumbnails is None or imageID is None:
+            return None
+        size = self.thumbnails.size(imageID)
+        if size is None or size[0] < self.tileSizeX or size[1] < self.tileSizeY:
+            return None
+        return self.thumbnails.get(imageID)
+
+    def _resizeJob(self, job):
+        """Thread pool job: return ((path, tile keys, imageID), resized
+        pixels), from the cache if possible, else from the thumbnail (if not
+        None)
+        """
+        source, thumbnail = job
+        path, keys, imageID = source
+        key = keys[thumbnail is not None] if keys else None
+
+        with profiling.timed('mosaic.tile_cache_get'):
+            pixels = self.cache.get(key) if self.cache and key else None
+        if pixels is None:
+            if thumbnail is not None:
+                pixels = self.resizePixels(thumbnail)
+            else:
+                pixels = self.resize(path)
+            if self.cache and key:
+                self.cache.put(key, pixels)
+        return source, pixels
+
+    def compose(self, infiles, outfile, tileKeys=None, imageIDs=None):
+        """Build the mosaic out of the infiles, one per tile in the raster
+        order of tiles, and save it to outfile. tileKeys are the TileCache
+        keys of the tiles, as (original, thumbnail) pairs (see TileCache.key),
+        imageIDs the ones of the infiles, if any.
+        """
+        if tileKeys is None:
+            tileKeys = [None] * len(infiles)
+        if imageIDs is None:
+            imageIDs = [None] * len(infiles)
+
+        tilesBySource = collections.OrderedDict()
+        for i, source in enumerate(zip(infiles, tileKeys, imageIDs)):
+            tilesBySource.setdefault(source, []).append(i)
+
+        # Thumbnails are looked up here, the store is not thread safe. They
+        # are memory mapped, so this reads nothing yet:
+        jobs = [(x, self._thumbnail(x[2])) for x in tilesBySource]
+        self.thumbnailsUsed = len([x for x in jobs if x[1] is not None])
+
+        width = self.tilesInX * self.tileSizeX
+        height = self.tilesInY * self.tileSizeY
+        canvas = numpy.zeros((height, width, 3), dtype=numpy.float32)
+
+        log.info('Resizing %d distinct images (%d from thumbnails) for %d '
+                 'tiles...' % (len(tilesBySource), self.thumbnailsUsed,
+                               len(infiles)))
+
+        pool = multiprocessing.pool.ThreadPool(self.jobs)
+        try:
+            for n, (source, pixels) in enumerate(pool.imap_unordered(self._resizeJob,
+                                                                    jobs)):
+                log.info('Resized image %d of %d' % (n+1, len(tilesBySource)))
+                for i in tilesBySource[source]:
+                    x = (i % self.tilesInX) * self.tileSizeX
+                    y = (i / self.tilesInX) * self.tileSizeY
+                    canvas[y:y+self.tileSizeY, x:x+self.tileSizeX] = pixels
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        log.info('Writing mosaic...')
+        with profiling.timed('mosaic.save'):
+            self.save(canvas, outfile)
+
+    def save(self, canvas, outfile):
+        """Write the (height, width, 3) float canvas to outfile
+        """
+        height, width = canvas.shape[:2]
+        buf = oiio.ImageBuf(oiio.ImageSpec(width, height, 3, oiio.FLOAT))
+        buf.set_pixels(oiio.ROI(0, width, 0, height, 0, 1, 0, 3), canvas)
+        if os.path.splitext(outfile)[-1].lower() in self.floatFormats:
+            fmt = oiio.FLOAT
+        else:
+            fmt = oiio.UINT8
+        if not buf.write(outfile, fmt):
+            raise RuntimeError('%s: %s' % (outfile, buf.geterror()))
+
+
+def composeWithOiiotool(infiles, tilesInX, tilesInY, tileSizeX, tileSizeY,
+                        outfile, jobs=4):
+    """Build the mosaic with oiiotool: resize each distinct one of the infiles
+    to a temp file (with up to jobs oiiotool processes at a time), then put
+    them together with oiiotool --mosaic. The temp files are kept in a
+    private temp directory, removed whatever happens.
+    """
+    sources = list(collections.OrderedDict.fromkeys(infiles))
+    suffix = os.path.splitext(outfile)[-1]
+    tmpDir = tempfile.mkdtemp(prefix='myImgDBMosaic')
+    tfiles = dict([(x, os.path.join(tmpDir, 'tile%06d%s' % (i, suffix))) \
+                   for i, x in enumerate(sources)])
+
+    def resize(infile):
+        cmd = ['oiiotool', infile, '--resize', '%dx%d' % (tileSizeX, tileSizeY),
+               '-o', tfiles[infile]]
+        with profiling.timed('mosaic.resize'):
+            subprocess.check_call(cmd)
+
+    try:
+        log.info('Resizing %d distinct images for %d tiles...' % \
+                 (len(sources), len(infiles)))
+
+        pool = multiprocessing.pool.ThreadPool(max(1, jobs))
+        try:
+            # In order, so is the progress:
+            for n, x in enumerate(pool.imap(resize, sources)):
+                log.info('Resized image %d of %d' % (n+1, len(sources)))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        log.info('Building mosaic...')
+
+        cmd = ['oiiotool'] + \
+               [tfiles[x] for x in infiles] + \
+               ['--mosaic', '%dx%d' % (tilesInX, tilesInY), '-o', outfile]
+        subprocess.check_call(cmd)
+    finally:
+        log.info('Cleaning up...')
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+def composeMosaic(infiles, tilesInX, tilesInY, tileSizeX, tileSizeY, outfile,
+                  jobs=4, tileKeys=None, cache=None, imageIDs=None,
+                  thumbnails=None):
+    """Build the mosaic out of the infiles, one per tile in the raster order
+    of tiles, each resized to tileSizeX by tileSizeY, and save it to outfile.
+    Uses MosaicCompositor (with jobs resizing threads, the TileCache cache with
+    tileKeys and the ThumbnailStore thumbnails with imageIDs, if given) if the
+    OpenImageIO python module is available, oiiotool otherwise (with jobs
+    processes resizing).
+    """
+    if oiio is None:
+        if cache is not None or thumbnails is not None:
+            log.warning('No OpenImageIO python module: the tile cache and '
+                        'thumbnails are not used')
+        composeWithOiiotool(infiles, tilesInX, tilesInY, tileSizeX, tileSizeY,
+                            outfile, jobs)
+        return
+
+    compositor = MosaicCompositor(tilesInX, tilesInY, tileSizeX, tileSizeY, jobs,
+                                  cache, thumbnails)
+    compositor.compose(infiles, outfile, tileKeys, imageIDs)
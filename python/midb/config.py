@@ -8,6 +8,10 @@ FALLBACK_IMG_ROOT = '/run/media/alex/Seagate Expansion Drive/backup.rsync.win/Pi
 class Config(object):
     """Most common config parameters
     """
+    # Storage backend: 'mysql' (the server at DB_HOST) or 'sqlite' (the
+    # database file at DB_PATH)
+    DB_BACKEND = 'mysql'
+    DB_PATH = '/var/tmp/midb.sqlite'
     DB_HOST = '192.168.1.102'
     DB_NAME = 'my_image_db'
     USERNAME = 'my_image_db'
@@ -15,3 +19,10 @@ class Config(object):
     IMG_ROOT = os.environ.get(IMG_ROOT_ENV, FALLBACK_IMG_ROOT)
     LOGFILE = '/var/tmp/midb.log'
     TIMESTAMP_FALLBACK = '2001-01-01 00:00:00.0'
+    TILE_CACHE_DIR = '/var/tmp/midb_tiles'
+    TILE_CACHE_BYTES = 1024 * 1024 * 1024
+    THUMBNAIL_DIR = '/var/tmp/midb_thumbnails'
+    # Checkpoints of the --store runs, see IngestJournal
+    INGEST_JOURNAL = '/var/tmp/midb_ingest.journal'
+    # Memory-mapped snapshot of the mip levels, see IndexSnapshot
+    INDEX_SNAPSHOT_DIR = '/var/tmp/midb_index'
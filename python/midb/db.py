@@ -3,43 +3,95 @@
 """MyImageDB database module
 """
 import os
-import copy
-import MySQLdb
 import pprint
 import math
 import datetime
 import logging
+import threading
 import traceback
+import contextlib
+import numpy
 from config import Config
+from backends import openBackend, SCHEMA_FILE
+from thumbstore import ThumbnailStore
+from fingerprint import fileFingerprint
+import profiling
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 log = logging.getLogger('midb.db')
 
 class Connection(object):
-    """Database connection class, with a couple static methods.
+    """Database connection class, with a couple static methods: a front to
+    the storage backend selected by Config.DB_BACKEND (see backends).
     """
-    connection = None
+    _backend = None
+
+    @classmethod
+    def backend(cls):
+        """Return the storage backend, opened on first use
+        """
+        if cls._backend is None:
+            cls._backend = openBackend()
+            log.debug('Using the %s database backend' % cls._backend.name)
+        return cls._backend
 
     @classmethod
     def cursor(cls):
-        if cls.connection is None:
-            cls.connection = MySQLdb.connect(host=Config.DB_HOST,
-                                             user=Config.USERNAME,
-                                             passwd=Config.PASSWD)
-            cls.connection.autocommit(True)
-        cursor = cls.connection.cursor(MySQLdb.cursors.DictCursor)
-        cursor.execute('USE %s' % Config.DB_NAME)
-        return cursor
+        """Return the dictionary cursor of the calling thread: reused, so
+        fetch the results of a query before running another one
+        """
+        return profiling.cursor(cls.backend().cursor())
+
+    @classmethod
+    @contextlib.contextmanager
+    def transaction(cls):
+        """Context manager running the statements executed with the cursor it
+        returns in one transaction: committed at exit, rolled back if an
+        exception is raised.
+        """
+        with cls.backend().transaction() as cursor:
+            yield profiling.cursor(cursor)
+
+    @classmethod
+    @contextlib.contextmanager
+    def streaming(cls, asDict=True):
+        """Context manager returning a server-side (unbuffered) cursor, on a
+        pooled connection of its own: rows are sent over as they are fetched
+        rather than all at once, and other queries can still be run meanwhile.
+        Rows are dictionaries if asDict is True, tuples otherwise.
+        """
+        with cls.backend().streaming(asDict) as cursor:
+            yield profiling.cursor(cursor)
+
+    @classmethod
+    def describe(cls, table):
+        """Return the description rows of the table columns, as the MySQL
+        DESCRIBE <table> query returns them
+        """
+        return cls.backend().describe(table)
 
     @classmethod
     def disconnect(cls):
-        if cls.connection is not None:
-            cls.connection.close()
-            cls.connection = None
+        if cls._backend is not None:
+            cls._backend.close()
+            cls._backend = None
 
 
 class DBTableBase(object):
-    """Generic database table-related methods and data
+    """Generic database table-related methods and data.
+    Instances are compact table rows: the column values are in the data
+    dictionary, the only instance attribute (subclasses must keep __slots__
+    empty too).
     """
+    __slots__ = ('data',)
+    
     # Cached database table description (contains all tables)
     # 1st level: table names are keys, data dicts are values
     # 2st level (data dicts): column names are keys, their description dictionaries
@@ -50,6 +102,32 @@ class DBTableBase(object):
     # of colums, lost in the _tableSchemaCache dictionary
     _tableColumnsCache = None
 
+    # Cached frozensets of each table's columns, for quick lookups
+    _tableColumnSetCache = {}
+
+    # Cached frozenset of the names of the tables in the database
+    _tablesCache = None
+
+    @classmethod
+    def exists(cls):
+        """Return True if the table is in the database (tables are added and
+        dropped by migrations, see MipVectorsTable.migrate)
+        """
+        if DBTableBase._tablesCache is None:
+            DBTableBase._tablesCache = frozenset(Connection.backend().tables())
+        return cls.table() in DBTableBase._tablesCache
+
+    @classmethod
+    def forgetSchema(cls):
+        """Drop the cached table schemas, after the database schema changed
+        """
+        DBTableBase._tablesCache = None
+        DBTableBase._tableColumnSetCache.clear()
+        for x in [DBTableBase] + _subclasses(DBTableBase):
+            if '_tableSchemaCache' in x.__dict__:
+                x._tableSchemaCache = None
+                x._tableColumnsCache = None
+
     @classmethod
     def _schema(cls, table=None):
         """Return the database table schema as a dictionary:
@@ -70,9 +148,7 @@ class DBTableBase(object):
             cls._tableColumnsCache = {}
 
         if table not in cls._tableSchemaCache:
-            cursor = Connection.cursor()
-            cursor.execute('DESCRIBE %s' % table, ())
-            describeRowList = cursor.fetchall()
+            describeRowList = Connection.describe(table)
             colDict = {}
             colList = []
             for col in describeRowList:
@@ -92,40 +168,69 @@ class DBTableBase(object):
         """
         cls._schema() # seed the cache
         return cls._tableColumnsCache[table if table else cls.table()]
+
+    @classmethod
+    def columnSet(cls):
+        """Return a frozenset of the database column names
+        """
+        table = cls.table()
+        if table not in cls._tableColumnSetCache:
+            cls._tableColumnSetCache[table] = frozenset(cls.columns())
+        return cls._tableColumnSetCache[table]
         
     def __init__(self, **data):
         """Create the instance of the class. Names of arguments it expects
         should correspond to the names of the table columns in the database.
         """
-        badKeys = set([x for x in data.keys() if x not in self._schema()])
-
-        if badKeys:
+        if not self.columnSet().issuperset(data):
+            badKeys = set(data).difference(self.columnSet())
             log.warning('Argument(s): %s do not correspond to the schema of the '
                         'database table %s' % (sorted(badKeys), self.table()))
 
-        self.data = copy.deepcopy(data)
+        # **data is a fresh dictionary already, no need to copy it
+        self.data = data
+
+    @classmethod
+    def fromRow(cls, row):
+        """Return an instance of the class for a row dictionary as fetched
+        from the database table: the row is taken over as is, neither checked
+        against the schema nor copied.
+        """
+        instance = cls.__new__(cls)
+        instance.data = row
+        return instance
+
+    def __getstate__(self):
+        return self.data
+
+    def __setstate__(self, state):
+        self.data = state
 
     @property
     def attributes(self):
         """Return a dictionary of all attributes known to the class.
-        They all can be accessed (read-only) with classInstance.Attribute syntax
+        They all can be accessed (read-only) with classInstance.Attribute syntax.
+        NOTE: this is the instance's own dictionary, not a copy: do not modify it!
         """
-        return copy.deepcopy(self.data)
+        return self.data
 
     def getAttribute(self, attr):
         """Return a attribute value
         """
         return self.attributes[attr]
 
-    def __getattribute__(self, attr):
-        """Do the classInstance.attribute syntax support.
-        NOTE: if there is a table row matching attr, this method would access
-        its value, not a python attribute!
+    def __getattr__(self, attr):
+        """Do the classInstance.attribute syntax support for the table columns.
+        NOTE: this is only called for names that are not regular python
+        attributes of the class, so column names must not clash with them!
         """
-        if attr not in ('_schema', 'data') and attr in self._schema():
-            return self.data[attr]
-
-        return super(DBTableBase, self).__getattribute__(attr)
+        if attr != 'data':
+            try:
+                return self.data[attr]
+            except KeyError:
+                pass
+        raise AttributeError('%s has no attribute or column %s' % \
+                             (type(self).__name__, attr))
 
     @classmethod
     def _notimplemented(cls):
@@ -195,7 +300,7 @@ class DBTableBase(object):
         try:
             cursor.execute('SELECT %s FROM %s %s' % (selWhat, cls.table(), sql), args)
         except Exception, e:
-            log.error('MySQL error: %s.\nQuery was:\n%s' % (e, cursor._last_executed))
+            log.error('Database error: %s.\nQuery was:\n%s' % (e, cursor._last_executed))
             raise
 
         #print cursor._last_executed
@@ -206,10 +311,58 @@ class DBTableBase(object):
             return result[0].values()[0]
 
         if not asDict:
-            result = [cls(**x) for x in result]
+            result = [cls.fromRow(x) for x in result]
 
         return result
 
+    @classmethod
+    def iterAll(cls, sql='', args=None, asDict=False, chunkSize=4096):
+        """Generator version of _findSQL: stream the rows found through a
+        server-side cursor, chunkSize rows at a time, yielding either class
+        instances (asDict=False) or python dictionaries (asDict=True).
+        Without sql (a WHERE clause), all the rows of the table are returned.
+        """
+        with Connection.streaming() as cursor:
+            cursor.execute('SELECT * FROM %s %s' % (cls.table(), sql), args)
+            while True:
+                rows = cursor.fetchmany(chunkSize)
+                if not rows:
+                    break
+                for x in rows:
+                    yield x if asDict else cls.fromRow(x)
+
+    @classmethod
+    def _upsertSQL(cls, columns, updateColumns=None):
+        """Return an INSERT ... ON DUPLICATE KEY UPDATE statement into the
+        table for the given columns, with placeholders for the values to be
+        passed as bound parameters (to execute or executemany).
+        On duplicates, updateColumns (default: all columns) are updated.
+        """
+        if updateColumns is None:
+            updateColumns = columns
+        return 'INSERT INTO %s (%s) VALUES (%s) ON DUPLICATE KEY UPDATE %s' % \
+               (cls.table(),
+                ','.join(columns),
+                ','.join(['%s'] * len(columns)),
+                ','.join(['%s=VALUES(%s)' % (x, x) for x in updateColumns]))
+
+    @classmethod
+    def _cloneSQL(cls, columns, keyColumn, sourceColumn):
+        """Return an INSERT ... SELECT statement copying the given columns
+        of the row where sourceColumn has a given value to the row where
+        keyColumn has a given value (created if it does not exist yet), with
+        placeholders for the (key value, source value) bound parameters.
+        """
+        return 'INSERT INTO %s (%s,%s) SELECT %%s,%s FROM %s WHERE %s = %%s ' \
+               'ON DUPLICATE KEY UPDATE %s' % \
+               (cls.table(),
+                keyColumn,
+                ','.join(columns),
+                ','.join(columns),
+                cls.table(),
+                sourceColumn,
+                ','.join(['%s=VALUES(%s)' % (x, x) for x in columns]))
+
     def reread(self):
         """Force re-reading cached values from the database table
         """
@@ -226,6 +379,16 @@ class DBTableBase(object):
         results = cls._findSQL('WHERE %s = %s' % (cls.idColumn(), id))
         return results[0] if results else None
 
+    @classmethod
+    def findByIDs(cls, ids):
+        """Return a list of this class's instances corresponding to the ID
+        values, in no particular order. IDs not found are silently skipped.
+        """
+        if not ids or not cls.idColumn():
+            return []
+        return cls._findSQL('WHERE %s IN (%s)' % \
+                            (cls.idColumn(), ','.join([str(int(x)) for x in ids])))
+
     @classmethod
     def findByName(cls, name):
         """Return this class's instance corresponding to the name value,
@@ -233,7 +396,7 @@ class DBTableBase(object):
         """
         if not cls.nameColumn():
             return None
-        results = cls._findSQL('WHERE %s = %s' % (cls.nameColumn(), `str(name)`))
+        results = cls._findSQL('WHERE %s = %%s' % cls.nameColumn(), (str(name),))
         return results[0] if results else None
 
     @classmethod
@@ -255,7 +418,15 @@ class DBTableBase(object):
         return eval(typeStr)
 
 
+def _subclasses(cls):
+    return [y for x in cls.__subclasses__() for y in [x] + _subclasses(x)]
+
+
 class ImageFilesTable(DBTableBase):
+    __slots__ = ()
+    # ThumbnailStore of storeImageInfo, see thumbnailStore
+    _thumbnailStore = None
+
     @classmethod
     def table(cls):
         """Return table name in the database.
@@ -290,6 +461,54 @@ class ImageFilesTable(DBTableBase):
         """Return absolute image path
         """
         return os.path.normpath(os.path.join(Config.IMG_ROOT, self.path))
+
+    @classmethod
+    def sampledHashes(cls):
+        """Return a dictionary of the pixel hashes of all the images sampled
+        already (having mip level rows), with one streamed query: hashes are
+        keys, imageIDs (one per hash) values
+        """
+        result = {}
+        with Connection.streaming(asDict=False) as cursor:
+            cursor.execute('''SELECT image_files.hash, image_files.imageID
+FROM image_files
+INNER JOIN
+    %s ON image_files.imageID = %s.imageID
+WHERE LENGTH(image_files.hash) > 0''' % ((MipLevel0Table.table(),) * 2))
+            while True:
+                rows = cursor.fetchmany(4096)
+                if not rows:
+                    break
+                result.update(rows)
+        return result
+
+    @classmethod
+    def findDuplicateIDs(cls, imageHash):
+        """Return a list of the imageIDs of the active images with the given
+        pixel hash (i.e. identical copies of the same image)
+        """
+        if not imageHash:
+            return []
+        cursor = Connection.cursor()
+        cursor.execute('SELECT imageID FROM %s WHERE hash = %%s AND active = 1' % \
+                       cls.table(), (imageHash,))
+        return [x['imageID'] for x in cursor.fetchall()]
+
+    @classmethod
+    def findDuplicateIDsByHashes(cls, imageHashes):
+        """Same as findDuplicateIDs for all the given pixel hashes at once,
+        with a single query: return a dictionary of the lists of imageIDs by
+        hash (empty hashes are skipped)
+        """
+        result = dict([(x, []) for x in imageHashes if x])
+        if not result:
+            return result
+        cursor = Connection.cursor()
+        cursor.execute('SELECT imageID, hash FROM %s WHERE hash IN (%s) AND active = 1' % \
+                       (cls.table(), ','.join(['%s'] * len(result))), result.keys())
+        for row in cursor.fetchall():
+            result[row['hash']].append(row['imageID'])
+        return result
     
     @classmethod
     def storeImagePath(cls, path, resolutions=((1,1), (2,2), (4,4)),
@@ -302,69 +521,278 @@ class ImageFilesTable(DBTableBase):
         if not os.access(path, os.R_OK):
             raise ValueError('%s: cannot be read' % path)
         
+        data = cls.readImageInfo(path, resolutions, thumbSize, thumbFormat)
+        if data is None:
+            return
+
+        return cls.storeImageInfo(path, data)
+
+    @classmethod
+    def readImageInfo(cls, path, resolutions=((1,1), (2,2), (4,4)),
+                      thumbSize=128, thumbFormat='png', knownHashes=None,
+                      knownFingerprints=None):
+        """Return the ImageInfo of the image file at the absolute path, to be
+        stored in the database, or None (the error is logged) if it cannot be
+        read. See ImageInfo for knownHashes.
+        If knownFingerprints (a dictionary of file fingerprints to imageIDs,
+        see fileFingerprint) is not None, the 'fingerprint' of the file is
+        added. If it is one of the knownFingerprints, the file is not even
+        decoded: a dictionary with just 'path', 'fingerprint' and
+        'duplicate_of' is returned, the rest of the info is copied from that
+        image when stored (see ImageBatchWriter).
+        """
         from images import ImageInfo
         
         try:
+            if not os.access(path, os.R_OK):
+                raise ValueError('%s: cannot be read' % path)
+
+            fingerprint = None
+            if knownFingerprints is not None:
+                with profiling.timed('image.fingerprint'):
+                    fingerprint = fileFingerprint(path)
+                if fingerprint in knownFingerprints:
+                    log.info('%s: same file as image %d' % \
+                             (path, knownFingerprints[fingerprint]))
+                    return {'path': os.path.relpath(path, Config.IMG_ROOT),
+                            'fingerprint': fingerprint,
+                            'duplicate_of': knownFingerprints[fingerprint]}
+
             data = ImageInfo(path,
                              thumbSize=thumbSize,
                              thumbFormat=thumbFormat,
-                             resolutions=resolutions)
+                             resolutions=resolutions,
+                             knownHashes=knownHashes)
+            if fingerprint is not None:
+                data['fingerprint'] = fingerprint
+            return data
         except Exception, e:
             log.exception(traceback.format_exc())
-            return
+            return None
 
-        thisTableData = dict([(k, v) for k, v in data.items() if k in cls.columns()])
-        
-        sql = 'INSERT INTO %s (%s) VALUES (%s)' % \
-              (cls.table(),
-               ','.join(thisTableData.keys()),
-               ','.join([`x` for x in thisTableData.values()]))
-        
-        updates = []
-        for k, v in thisTableData.items():
-            updates.append('%s=%s' % (k, `v`))
+    @classmethod
+    def storeImageInfo(cls, path, data):
+        """Add a new row into the table (or update the existing one) given the
+        absolute path to the image file and its ImageInfo, already read.
+        Return the class instance for the record.
+        """
+        writer = ImageBatchWriter(thumbnails=cls.thumbnailStore())
+        writer.add(path, data)
+        imageID = writer.flush()[0]
+        return cls.findByID(imageID) if imageID is not None else None
 
-        sql += ' ON DUPLICATE KEY UPDATE %s' % ','.join(updates)
-        
-        cursor = Connection.cursor()
-        cursor.execute(sql)
-        
-        result = cls.findByImagePath(path)
-        
-        # Now also update the mipmaps and the thumbnail:
-        log.debug('pixel_dumps[(1,1)]: %s' % data['pixel_dumps'][(1,1)])
-        MipLevel0Table.store(result.id, data['pixel_dumps'][(1,1)])
-        MipLevel1Table.store(result.id, data['pixel_dumps'][(2,2)])
-        MipLevel2Table.store(result.id, data['pixel_dumps'][(4,4)])
-        
-        # TODO: for some reason images stored in the BLOB column get truncated
-        # at random sizes, usually around 60% of the actual size.
-        # Looks like a MySQL bug to me...
-        #ThumbnailTable.store(result.id, thumbFormat,
-        #                     data.getThumbnail(), data.getThumbnailSize()])
-        
-        return result
+    @classmethod
+    def thumbnailStore(cls):
+        """Return the ThumbnailStore of Config.THUMBNAIL_DIR shared by the
+        storeImageInfo calls, opened on first use (its index is not read
+        again for each image)
+        """
+        store = ImageFilesTable._thumbnailStore
+        if store is None or store.storeDir != Config.THUMBNAIL_DIR:
+            if store is not None:
+                store.close()
+            store = ImageFilesTable._thumbnailStore = ThumbnailStore()
+        return store
 
     @classmethod
-    def traverseAndStore(cls, rootDir=None, forceUpdateExisting=False):
-        """Walk down the file system tree, adding images to the database table
+    def scanImageDirs(cls, rootDir, exts):
+        """Walk down the file system tree, yielding a (directory, entries)
+        tuple per directory, entries being a list of (absolute path, os.stat
+        result) tuples for its files with the given (lowercase, dotted)
+        extensions, sorted by path. Uses os.scandir (or the scandir module)
+        when available.
         """
-        exts = set(['.' + x.lower() for x in cls.listEnumOptions('format')])
+        if scandir is None:
+            for root, dirs, files in os.walk(rootDir, topdown=False):
+                log.info('Scanning %s...' % root)
+                entries = []
+                for name in sorted(files):
+                    if os.path.splitext(name)[-1].lower() in exts:
+                        fullpath = os.path.join(root, name)
+                        entries.append((fullpath, os.stat(fullpath)))
+                yield root, entries
+            return
         
+        dirs = [rootDir]
+        while dirs:
+            root = dirs.pop()
+            log.info('Scanning %s...' % root)
+            try:
+                found = sorted(scandir(root), key=lambda x: x.name)
+            except OSError, e:
+                log.error('%s: cannot be scanned: %s' % (root, e))
+                continue
+            entries = []
+            for entry in found:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif os.path.splitext(entry.name)[-1].lower() in exts:
+                    entries.append((entry.path, entry.stat()))
+            yield root, entries
+
+    @classmethod
+    def scanImageFiles(cls, rootDir, exts):
+        """Walk down the file system tree, yielding (absolute path, os.stat
+        result) tuples for all files with the given (lowercase, dotted)
+        extensions, see scanImageDirs.
+        """
+        for root, entries in cls.scanImageDirs(rootDir, exts):
+            for entry in entries:
+                yield entry
+
+    @classmethod
+    def imageExts(cls):
+        """Return the set of (lowercase, dotted) extensions of the image files
+        to store
+        """
+        return set(['.' + x.lower() for x in cls.listEnumOptions('format')])
+
+    @classmethod
+    def storeFilter(cls, forceUpdateExisting=False, incremental=False,
+                    storeStats=None):
+        """Return a function of (absolute path, os.stat result) returning True
+        if the image file has to be stored in the database table.
+        If incremental is True, rather than looking up every file in the
+        database, compare it against the manifest of all known files, loaded
+        in one go: only new files and files whose size, mtime or inode changed
+        are to be stored. The files whose stats changed but not their contents
+        get their stats updated with storeStats(imageID, os.stat result,
+        fingerprint): FileStatsTable.store by default, see
+        ImageBatchWriter.addStats.
+        """
+        if storeStats is None:
+            storeStats = FileStatsTable.store
+
+        if forceUpdateExisting:
+            return lambda fullpath, st: True
+
+        if not incremental:
+            def accept(fullpath, st):
+                if cls.findByImagePath(fullpath):
+                    log.info('%s skipped: already in the database' % fullpath)
+                    return False
+                log.info('Storing: %s' % fullpath)
+                return True
+            return accept
+
+        manifest = FileStatsTable.manifest()
+        log.info('Manifest: %d known image files' % len(manifest))
+
+        def acceptIncremental(fullpath, st):
+            known = manifest.get(os.path.relpath(fullpath, Config.IMG_ROOT))
+            if known is None:
+                log.info('Storing: %s (new)' % fullpath)
+                return True
+            elif known[1:4] == (None, None, None):
+                # Stored before its file stats were: take it as unchanged
+                storeStats(known[0], st, cls._fingerprint(fullpath))
+            elif FileStatsTable.changed(known[1:4], st):
+                fingerprint = cls._fingerprint(fullpath)
+                if fingerprint and fingerprint == known[4]:
+                    # Touched, copied over, moved... but the same contents
+                    log.info('%s: stats changed, contents did not' % fullpath)
+                    storeStats(known[0], st, fingerprint)
+                else:
+                    log.info('Storing: %s (changed)' % fullpath)
+                    return True
+            return False
+        return acceptIncremental
+
+    @classmethod
+    def iterImagePaths(cls, rootDir=None, forceUpdateExisting=False,
+                       incremental=False):
+        """Walk down the file system tree, yielding absolute paths of the images
+        that have to be stored in the database table, see storeFilter.
+        """
+        accept = cls.storeFilter(forceUpdateExisting, incremental)
+        for fullpath, st in cls.scanImageFiles(rootDir or Config.IMG_ROOT,
+                                               cls.imageExts()):
+            if accept(fullpath, st):
+                yield fullpath
+
+    @classmethod
+    def _fingerprint(cls, path):
+        """Return the fileFingerprint of path, or None if fingerprints are not
+        recorded (see FileStatsTable.hasFingerprints) or the file cannot be read
+        """
+        if not FileStatsTable.hasFingerprints():
+            return None
+        try:
+            return fileFingerprint(path)
+        except (IOError, OSError), e:
+            log.error('%s: cannot be fingerprinted: %s' % (path, e))
+            return None
+
+    @classmethod
+    def traverseAndStore(cls, rootDir=None, forceUpdateExisting=False, jobs=1,
+                         incremental=False, batchSize=64, dedup=True,
+                         journal=True, resume=False):
+        """Walk down the file system tree, adding images to the database table.
+        Directories are scanned, images read and sampled, and batches written
+        concurrently, with bounded queues in between (see
+        ingest.storePipelined). If jobs > 1, images are read and sampled by a
+        pool of that many worker processes, while this process does all the
+        database work.
+        Images are written in batches of batchSize, see ImageBatchWriter.
+        See storeFilter for incremental.
+        If dedup is True (and not forceUpdateExisting), images whose pixel hash
+        is known already are not sampled again: the mip levels and thumbnail
+        of the known copy are cloned for them. Files whose fingerprint is
+        known already are not even decoded (see readImageInfo).
+        If journal is True, progress is checkpointed to an IngestJournal at
+        Config.INGEST_JOURNAL. If resume is True too, the checkpoints of an
+        interrupted run of the same root directory are resumed from: the
+        directories and images it stored are skipped. If journal is False,
+        any such checkpoints are discarded.
+        """
+        from ingest import IngestJournal, storePipelined
+
         if rootDir is None:
             rootDir = Config.IMG_ROOT
-            
-        for root, dirs, files in os.walk(rootDir, topdown=False):
-            log.info('Traversing %s...' % root)
-            for name in files:
-                nm, ext = os.path.splitext(name)
-                if ext.lower() in exts:
-                    fullpath = os.path.join(root, name)
-                    if forceUpdateExisting or not cls.findByImagePath(fullpath):
-                        log.info('Storing: %s' % name)
-                        cls.storeImagePath(fullpath)
-                    else:
-                        log.info('%s skipped: already in the database' % name)
+        if resume and not journal:
+            raise ValueError('Cannot resume a run without its journal')
+
+        checkpoints = IngestJournal(Config.INGEST_JOURNAL, rootDir, resume)
+        if not journal:
+            checkpoints.discard()
+            checkpoints = None
+
+        knownHashes = None
+        knownFingerprints = {} if FileStatsTable.hasFingerprints() else None
+        if dedup and not forceUpdateExisting:
+            knownHashes = cls.sampledHashes()
+            log.info('%d sampled image hashes known' % len(knownHashes))
+            if knownFingerprints is not None:
+                knownFingerprints = FileStatsTable.sampledFingerprints()
+                log.info('%d sampled file fingerprints known' % \
+                         len(knownFingerprints))
+
+        # The file stats updates of the scanner go through the writer, so the
+        # database is only written to by one thread:
+        writer = ImageBatchWriter(batchSize, knownHashes=knownHashes,
+                                  knownFingerprints=knownFingerprints \
+                                                    if knownHashes is not None \
+                                                    else None)
+        storePipelined(cls.scanImageDirs(rootDir, cls.imageExts()),
+                       cls.storeFilter(forceUpdateExisting, incremental,
+                                       storeStats=writer.addStats),
+                       jobs, knownHashes=knownHashes,
+                       knownFingerprints=knownFingerprints,
+                       journal=checkpoints, writer=writer)
+
+    @classmethod
+    def mipTable(cls, pixels):
+        """Return the mip level table class to compare the given float pixels
+        RGBRGBRGB... against. There can be either 1*3, 4*3, or 16*3 of them.
+        """
+        if len(pixels) == 1*3:
+            return MipLevel0Table
+        elif len(pixels) == 4*3:
+            return MipLevel1Table
+        elif len(pixels) == 16*3:
+            return MipLevel2Table
+
+        raise ValueError('pixels: %d values not expected' % len(pixels))
 
     @classmethod
     def findByClosestColors(cls, pixels, frameAspect, aspectTolerance=0.1, limit=16,
@@ -374,36 +802,40 @@ class ImageFilesTable(DBTableBase):
         There can be either 1*3, 4*3, or 16*3 values to compare against.
         Returned list length is equal or shorter than limit, sorted "closest first"
         """
-        if len(pixels) == 1*3:
-            return MipLevel0Table.findClosest(pixels, frameAspect, aspectTolerance,
-                                              limit, excludeImageIDs)
-        elif len(pixels) == 4*3:
-            return MipLevel1Table.findClosest(pixels, frameAspect, aspectTolerance,
-                                              limit, excludeImageIDs)
-        elif len(pixels) == 16*3:
-            return MipLevel2Table.findClosest(pixels, frameAspect, aspectTolerance,
-                                              limit, excludeImageIDs)
+        return cls.mipTable(pixels).findClosest(pixels, frameAspect, aspectTolerance,
+                                                limit, excludeImageIDs)
 
-        raise ValueError('pixels: %d values not expected' % len(pixels))
+    @classmethod
+    def findClosestWithDistances(cls, pixels, frameAspect, aspectTolerance=0.1,
+                                 limit=16, excludeImageIDs=None):
+        """Same as findByClosestColors, but return a list of (distance, instance)
+        tuples, distance being the one the distance method would return.
+        Takes a single query.
+        """
+        return cls.mipTable(pixels).findClosestWithDistances(pixels, frameAspect,
+                                                             aspectTolerance,
+                                                             limit,
+                                                             excludeImageIDs)
       
     def distance(self, pixels):
         """Return color space distance from the float pixels RGBRGBRGB...
         to mip levels of this image.
         There can be either 1*3, 4*3, or 16*3 values in pixels to compare against.
         """
-        if len(pixels) == 1*3:
-            mipTable = MipLevel0Table.findByImageID(self.id)
-        elif len(pixels) == 4*3:
-            mipTable = MipLevel1Table.findByImageID(self.id)
-        elif len(pixels) == 16*3:
-            mipTable = MipLevel2Table.findByImageID(self.id)
-        else:
-            raise ValueError('pixels: %d values not expected' % len(pixels))
-
+        mipTable = self.mipTable(pixels)
+        if not mipTable.exists():
+            vector = MipVectorsTable.findVector(self.id, mipTable.level)
+            return MipVectorsTable.distance(vector, pixels) \
+                   if vector is not None else 1e+27
+        mipTable = mipTable.findByImageID(self.id)
         return mipTable.distance(pixels) if mipTable else 1e+27
             
         
 class MipLevel0Table(DBTableBase):
+    __slots__ = ()
+    # 2 ** level samples in X and Y
+    level = 0
+
     @classmethod
     def table(cls):
         """Return table name in the database.
@@ -427,36 +859,45 @@ class MipLevel0Table(DBTableBase):
         results = cls._findSQL('WHERE imageID = %s' % imageID)
         return results[0] if results else None
 
+    # Cached lists of each mip table's color columns
+    _colorColumnsCache = {}
+
+    @classmethod
+    def numValues(cls):
+        """Return the number of float pixel values of the mip level
+        """
+        return 3 * 4 ** cls.level
+
     @classmethod
     def colorColumns(cls):
         """Return the list of color columns this class stores in its database
         table
         """
-        return [x for x in cls.columns() if \
-                x.startswith('red') or \
-                x.startswith('green') or \
-                x.startswith('blue')]
+        table = cls.table()
+        if table not in cls._colorColumnsCache:
+            cls._colorColumnsCache[table] = [x for x in cls.columns() if \
+                                             x.startswith('red') or \
+                                             x.startswith('green') or \
+                                             x.startswith('blue')]
+        return cls._colorColumnsCache[table]
         
     @classmethod
     def store(cls, imageID, values):
         """Create/update the record for the given imageID
         """
-        keys = cls.colorColumns()
-        
-        assert(len(keys) == len(values))
-        
-        sql = 'INSERT INTO %s (%s) VALUES (%s)' % \
-              (cls.table(),
-               ','.join(keys + ['imageID']),
-               ','.join([str(x) for x in (values + [imageID])]))
-
-        updates = []
-        for k, v in zip(keys, values):
-            updates.append('%s=%s' % (k, str(v)))
-        sql += ' ON DUPLICATE KEY UPDATE %s' % ','.join(updates)
-        
         cursor = Connection.cursor()
-        cursor.execute(sql)
+        cursor.execute(cls._upsertSQL(cls.colorColumns() + ['imageID'],
+                                      cls.colorColumns()),
+                       cls.storeArgs(imageID, values))
+
+    @classmethod
+    def storeArgs(cls, imageID, values):
+        """Return the bound parameters of the store statement for the given
+        imageID and float pixel values
+        """
+        values = [float(x) for x in values]
+        assert(len(cls.colorColumns()) == len(values))
+        return tuple(values + [int(imageID)])
 
     @classmethod
     def sortOrder(cls, values):
@@ -467,16 +908,23 @@ class MipLevel0Table(DBTableBase):
         return '+'.join(s)
 
     @classmethod
-    def findClosest(cls, pixels, frameAspect, aspectTolerance=0.1, limit=16,
-                    excludeImageIDs=None):
-        """Find a few rows that are the closest to the given rgb pixels
+    def _findClosestSQL(cls, pixels, frameAspect, aspectTolerance=0.1, limit=16,
+                        excludeImageIDs=None):
+        """Run the query selecting the image_files rows that are the closest to
+        the given rgb pixels, joined with their color columns of this table.
+        Return the result rows.
         """
+        if not cls.exists():
+            raise ValueError('%s: the table was migrated to %s, look the images '
+                             'up in a ColorIndex instead' % \
+                             (cls.table(), MipVectorsTable.table()))
+
         if not excludeImageIDs:
             excludeImageIDs = [-1]
             
         table = cls.table()
         
-        sql = '''SELECT image_files.imageID 
+        sql = '''SELECT image_files.*, %s
 FROM image_files
 INNER JOIN 
     %s ON image_files.imageID = %s.imageID
@@ -484,7 +932,8 @@ WHERE ABS(image_files.frame_aspect - %g) < %g
       AND image_files.active = 1
       AND image_files.imageID NOT IN (%s)
 ORDER BY %s ASC
-LIMIT %d''' % (table,
+LIMIT %d''' % (','.join(['%s.%s' % (table, x) for x in cls.colorColumns()]),
+               table,
                table,
                frameAspect,
                aspectTolerance,
@@ -494,24 +943,53 @@ LIMIT %d''' % (table,
         
         cursor = Connection.cursor()
         cursor.execute(sql)
-        imageIDs = [x['imageID'] for x in cursor.fetchall()]
-        return [ImageFilesTable.findByID(x) for x in imageIDs]
+        return cursor.fetchall()
+
+    @classmethod
+    def findClosest(cls, pixels, frameAspect, aspectTolerance=0.1, limit=16,
+                    excludeImageIDs=None):
+        """Find a few rows that are the closest to the given rgb pixels
+        """
+        rows = cls._findClosestSQL(pixels, frameAspect, aspectTolerance, limit,
+                                   excludeImageIDs)
+        imageColumns = ImageFilesTable.columns()
+        return [ImageFilesTable.fromRow(dict([(k, x[k]) for k in imageColumns])) \
+                for x in rows]
+
+    @classmethod
+    def findClosestWithDistances(cls, pixels, frameAspect, aspectTolerance=0.1,
+                                 limit=16, excludeImageIDs=None):
+        """Find a few rows that are the closest to the given rgb pixels.
+        Return a list of (distance, ImageFilesTable instance) tuples, closest
+        first, distance being the one the distance method returns. No follow-up
+        queries are made.
+        """
+        rows = cls._findClosestSQL(pixels, frameAspect, aspectTolerance, limit,
+                                   excludeImageIDs)
+        imageColumns = ImageFilesTable.columns()
+        mipColumns = cls.colorColumns() + ['imageID']
+        result = []
+        for x in rows:
+            mip = cls.fromRow(dict([(k, x[k]) for k in mipColumns]))
+            ift = ImageFilesTable.fromRow(dict([(k, x[k]) for k in imageColumns]))
+            result.append((mip.distance(pixels), ift))
+        return result
 
     def distance(self, pixels):
         """Find the max color space distance between the given pixel(s) and
         the one(s) stored in the table
         """
-        assert(len(pixels) == len(self.colorColumns()))
+        colorColumns = self.colorColumns()
+        assert(len(pixels) == len(colorColumns))
         
-        data = self.attributes
-        result = 0
+        data = self.data
         
         resultVec = [0, 0, 0]
         
         for i in range(0, len(pixels), 3):
-            red = data[self.colorColumns()[i]]
-            green = data[self.colorColumns()[i+1]]
-            blue = data[self.colorColumns()[i+2]]
+            red = data[colorColumns[i]]
+            green = data[colorColumns[i+1]]
+            blue = data[colorColumns[i+2]]
             resultVec[0] += red - pixels[i]
             resultVec[1] += green - pixels[i+1]
             resultVec[2] += blue - pixels[i+2]
@@ -520,6 +998,9 @@ LIMIT %d''' % (table,
                (len(pixels) / 3)
     
 class MipLevel1Table(MipLevel0Table):
+    __slots__ = ()
+    level = 1
+
     @classmethod
     def table(cls):
         """Return table name in the database.
@@ -534,6 +1015,9 @@ class MipLevel1Table(MipLevel0Table):
 
     
 class MipLevel2Table(MipLevel0Table):
+    __slots__ = ()
+    level = 2
+
     @classmethod
     def table(cls):
         """Return table name in the database.
@@ -546,8 +1030,264 @@ class MipLevel2Table(MipLevel0Table):
         """
         return 'mip_level2ID'
 
+
+class MipVectorsTable(DBTableBase):
+    """Mip levels of the images as packed vectors: one row per image and
+    level, holding the 2 ** level by 2 ** level pixels (RGBRGB...) of the
+    level as little endian float32 values in a BLOB. Any number of levels can
+    be stored without a schema change, and a whole level is read with one
+    streamed query (see index.MipLevelIndex.loadVectors).
+    """
+    __slots__ = ()
+    dtype = numpy.dtype('<f4')
+    schemaFile = os.path.join(os.path.dirname(SCHEMA_FILE), 'mip_vectors.sql')
+
+    @classmethod
+    def table(cls):
+        """Return table name in the database.
+        """
+        return 'mip_vectors'
+
+    @classmethod
+    def idColumn(cls):
+        """Return the 'id' column name in the database table.
+        """
+        return 'mip_vectorsID'
+
+    @classmethod
+    def nameColumn(cls):
+        """Return the 'name' column name in the database table.
+        """
+        return None
+
+    @classmethod
+    def encode(cls, values):
+        """Return the float pixel values packed for the vector column
+        """
+        return Connection.backend().binary(numpy.asarray(values, dtype=cls.dtype).tostring())
+
+    @classmethod
+    def decode(cls, vector):
+        """Return the values of the vector column as a read-only float32
+        array over its bytes (not a copy)
+        """
+        return numpy.frombuffer(vector, dtype=cls.dtype)
+
+    @classmethod
+    def storeArgs(cls, imageID, pixelDumps):
+        """Return a list of the (imageID, level, vector) bound parameters of
+        the rows of an image, given its pixel dumps ((w, h) resolutions:
+        values). Only square power of two resolutions are mip levels.
+        """
+        result = []
+        for (w, h), values in sorted(pixelDumps.items()):
+            if w == h and w > 0 and w & (w - 1) == 0:
+                result.append((int(imageID), w.bit_length() - 1, cls.encode(values)))
+        return result
+
+    @classmethod
+    def findVector(cls, imageID, level):
+        """Return the float32 values of the given mip level of the image, or
+        None if they are not stored
+        """
+        cursor = Connection.cursor()
+        cursor.execute('SELECT vector FROM %s WHERE imageID = %%s AND level = %%s' % \
+                       cls.table(), (int(imageID), int(level)))
+        rows = cursor.fetchall()
+        return cls.decode(rows[0]['vector']) if rows else None
+
+    @staticmethod
+    def distance(vector, pixels):
+        """Return MipLevel0Table.distance between the vector values and the
+        float pixels RGBRGBRGB...
+        """
+        n = len(pixels) / 3
+        diff = (numpy.asarray(vector, dtype=numpy.float64) - pixels).reshape(n, 3)
+        return math.sqrt((diff.sum(axis=0) ** 2).sum()) / n
+
+    @classmethod
+    def covers(cls, mipTable):
+        """Return True if the mip level of mipTable (a MipLevel0Table class)
+        should be read from this table: it has been migrated, or at least as
+        many rows are stored here as in mipTable
+        """
+        if not cls.exists():
+            return False
+        if not mipTable.exists():
+            return True
+        cursor = Connection.cursor()
+        cursor.execute('SELECT COUNT(*) AS n FROM %s WHERE level = %%s' % cls.table(),
+                       (mipTable.level,))
+        return cursor.fetchall()[0]['n'] >= mipTable._findSQL(asCount=True)
+
+    @classmethod
+    def migrate(cls, mipTables=None, dropColumns=False, chunkSize=4096):
+        """Create the table if needed, and copy the mip levels of the mip
+        level tables (all of them by default) to it, chunkSize images per
+        transaction. If dropColumns is True, the tables are dropped afterwards,
+        except mip_level0: it is small, and the SQL lookups (and the queries
+        telling sampled images apart) join it.
+        """
+        if mipTables is None:
+            mipTables = ImageBatchWriter.mipTables
+        if not cls.exists():
+            log.info('Creating the %s table' % cls.table())
+            f = file(cls.schemaFile)
+            try:
+                Connection.backend().executeSchema(f.read())
+            finally:
+                f.close()
+            cls.forgetSchema()
+
+        for resolution, mipTable in mipTables:
+            if not mipTable.exists():
+                log.info('%s: no such table, skipped' % mipTable.table())
+                continue
+            columns = mipTable.colorColumns()
+            sql = cls._upsertSQL(['imageID', 'level', 'vector'], ['vector'])
+            copied = 0
+            with Connection.streaming(asDict=False) as reader:
+                reader.execute('SELECT imageID, %s FROM %s' % \
+                               (','.join(columns), mipTable.table()))
+                while True:
+                    rows = reader.fetchmany(chunkSize)
+                    if not rows:
+                        break
+                    values = numpy.asarray([x[1:] for x in rows], dtype=cls.dtype)
+                    with Connection.transaction() as cursor:
+                        cursor.executemany(sql, [(int(x[0]), mipTable.level,
+                                                  cls.encode(v)) \
+                                                 for x, v in zip(rows, values)])
+                    copied += len(rows)
+                    log.info('%s: %d rows copied' % (mipTable.table(), copied))
+
+            if dropColumns and mipTable is not MipLevel0Table:
+                log.info('Dropping the %s table' % mipTable.table())
+                cursor = Connection.cursor()
+                cursor.execute('DROP TABLE %s' % mipTable.table())
+                cls.forgetSchema()
+
+
+class FileStatsTable(DBTableBase):
+    """Size, mtime, inode and fingerprint (see fileFingerprint) of image files
+    as of the last time they were stored: the manifest incremental re-scans
+    compare the file system against
+    """
+    __slots__ = ()
+
+    @classmethod
+    def table(cls):
+        """Return table name in the database.
+        """
+        return 'file_stats'
+
+    @classmethod
+    def idColumn(cls):
+        """Return the 'id' column name in the database table.
+        """
+        return 'file_statsID'
+
+    @classmethod
+    def nameColumn(cls):
+        """Return the 'name' column name in the database table.
+        """
+        return None
+
+    @classmethod
+    def hasFingerprints(cls):
+        """Return True if the table has the fingerprint column (databases
+        created before it was added do not)
+        """
+        return 'fingerprint' in cls.columnSet()
+
+    @classmethod
+    def statsColumns(cls):
+        """Return the list of the columns recorded for a file
+        """
+        if cls.hasFingerprints():
+            return ['size', 'mtime', 'inode', 'fingerprint']
+        return ['size', 'mtime', 'inode']
+
+    @classmethod
+    def store(cls, imageID, st, fingerprint=None):
+        """Create/update the record for the given imageID from the os.stat
+        result st and the file fingerprint
+        """
+        cursor = Connection.cursor()
+        cursor.execute(cls._upsertSQL(['imageID'] + cls.statsColumns(),
+                                      cls.statsColumns()),
+                       cls.storeArgs(imageID, st, fingerprint))
+
+    @classmethod
+    def storeArgs(cls, imageID, st, fingerprint=None):
+        """Return the bound parameters of the store statement for the given
+        imageID, os.stat result and file fingerprint
+        """
+        args = (int(imageID), st.st_size, st.st_mtime, st.st_ino)
+        if cls.hasFingerprints():
+            args += (fingerprint,)
+        return args
+
+    @classmethod
+    def manifest(cls):
+        """Return a dictionary of all the known image files, with a single query:
+        paths (relative to Config.IMG_ROOT) are keys, (imageID, size, mtime,
+        inode, fingerprint) tuples are values. The last four are None for images
+        stored before their file stats were recorded, the fingerprint is None
+        for the ones stored before fingerprints were.
+        """
+        sql = '''SELECT image_files.imageID, image_files.path,
+       %s
+FROM image_files
+LEFT JOIN
+    %s ON image_files.imageID = %s.imageID''' % \
+            (','.join(['%s.%s' % (cls.table(), x) for x in cls.statsColumns()]),
+             cls.table(),
+             cls.table())
+        
+        cursor = Connection.cursor()
+        cursor.execute(sql)
+        return dict([(x['path'], (x['imageID'], x['size'], x['mtime'], x['inode'],
+                                  x.get('fingerprint'))) \
+                     for x in cursor.fetchall()])
+
+    @classmethod
+    def sampledFingerprints(cls):
+        """Return a dictionary of the fingerprints of all the image files
+        sampled already (having mip level rows), with one streamed query:
+        fingerprints are keys, imageIDs (one per fingerprint) values
+        """
+        result = {}
+        if not cls.hasFingerprints():
+            return result
+        with Connection.streaming(asDict=False) as cursor:
+            cursor.execute('''SELECT %s.fingerprint, %s.imageID
+FROM %s
+INNER JOIN
+    %s ON %s.imageID = %s.imageID
+WHERE %s.fingerprint IS NOT NULL''' % \
+                           ((cls.table(),) * 3 + (MipLevel0Table.table(),) + \
+                            (cls.table(), MipLevel0Table.table(), cls.table())))
+            while True:
+                rows = cursor.fetchmany(4096)
+                if not rows:
+                    break
+                result.update(rows)
+        return result
+
+    @classmethod
+    def changed(cls, known, st):
+        """Return True if the (size, mtime, inode) recorded for a file differ
+        from its current os.stat result st
+        """
+        size, mtime, inode = known
+        return size != st.st_size or inode != st.st_ino or \
+               abs(mtime - st.st_mtime) > 1e-6
+
     
 class ThumbnailTable(DBTableBase):
+    __slots__ = ()
+
     @classmethod
     def table(cls):
         """Return table name in the database.
@@ -592,3 +1332,213 @@ class ThumbnailTable(DBTableBase):
 
         cursor = Connection.cursor()
         cursor.execute(sql, tuple(data.values() + data2.values()))
+
+
+class ImageBatchWriter(object):
+    """Buffers the ImageInfo of processed images and writes them to image_files,
+    file_stats and the mip level tables in batches: one transaction per batch,
+    one multi-row statement (executemany) per table, all the values passed as
+    bound parameters. The imageIDs are read back with a single query per batch.
+    Thumbnail pixels go to a ThumbnailStore once the transaction is committed.
+    Mip levels go to the MipVectorsTable too, and only there once the mip
+    level tables are migrated (dropped).
+    Images with a 'duplicate_of' imageID (see ImageInfo knownHashes) are not
+    sampled: the mip level rows and thumbnail of that image are copied.
+    Images with no pixel 'hash' (known by their file fingerprint, see
+    ImageFilesTable.readImageInfo) get their image_files row copied as well.
+    If knownHashes and knownFingerprints dictionaries are given, the pixel
+    hashes and file fingerprints of the images sampled are added to them as
+    they are written.
+    File stats updates of images stored already (see addStats) are queued
+    from any thread, and written with the next batch.
+    """
+    mipTables = (((1,1), MipLevel0Table),
+                 ((2,2), MipLevel1Table),
+                 ((4,4), MipLevel2Table))
+
+    def __init__(self, batchSize=64, thumbnails=None, knownHashes=None,
+                 knownFingerprints=None):
+        self.batchSize = batchSize
+        self.pending = []
+        self.thumbnails = thumbnails if thumbnails is not None else ThumbnailStore()
+        self.knownHashes = knownHashes
+        self.knownFingerprints = knownFingerprints
+        self.stats = []
+        self._statsLock = threading.Lock()
+
+    def addStats(self, imageID, st, fingerprint=None):
+        """Queue a FileStatsTable.store update, written by the next flush
+        (or flushStats). Can be called from any thread.
+        """
+        with self._statsLock:
+            self.stats.append(FileStatsTable.storeArgs(imageID, st, fingerprint))
+
+    def flushStats(self):
+        """Write the queued file stats updates, in one transaction. They are
+        logged and dropped if that fails: the next incremental run finds the
+        stats changed again.
+        """
+        with self._statsLock:
+            stats, self.stats = self.stats, []
+        if not stats:
+            return
+        columns = FileStatsTable.statsColumns()
+        try:
+            with Connection.transaction() as cursor:
+                cursor.executemany(FileStatsTable._upsertSQL(['imageID'] + columns,
+                                                             columns),
+                                   stats)
+        except Exception:
+            log.exception('Failed to update the file stats of %d image(s)' % \
+                          len(stats))
+
+    def add(self, path, data):
+        """Queue the ImageInfo data of the image file at the absolute path for
+        writing. Flush the batch if it is full, returning the flush result;
+        otherwise return [] (or [None] if the file cannot be stat'ed).
+        """
+        try:
+            self.pending.append((path, data, os.stat(path)))
+        except OSError, e:
+            log.error('%s: failed to store the image info: %s' % (path, e))
+            return [None]
+        if len(self.pending) >= self.batchSize:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """Write all the queued images. Return a list of their imageIDs, in the
+        order they were added. If writing the batch fails, its images are
+        written one by one: the ones failing again are logged and get None
+        for imageID. The queued file stats updates are written too.
+        """
+        self.flushStats()
+        pending, self.pending = self.pending, []
+
+        if not pending:
+            return []
+
+        try:
+            return self._write(pending)
+        except Exception, e:
+            if len(pending) == 1:
+                log.exception('%s: failed to store the image info' % pending[0][0])
+                return [None]
+            log.error('Failed to store a batch of %d images (%s), retrying them '
+                      'one by one' % (len(pending), e))
+
+        result = []
+        for item in pending:
+            try:
+                result.extend(self._write([item]))
+            except Exception, e:
+                log.exception('%s: failed to store the image info' % item[0])
+                result.append(None)
+        return result
+
+    def _write(self, pending):
+        """Write the given (path, ImageInfo, os.stat result) tuples in one
+        transaction, return a list of their imageIDs
+        """
+        with profiling.timed('db.write_batch'):
+            return self._writeBatch(pending)
+
+    def _writeBatch(self, pending):
+        columns = ImageFilesTable.columns()
+
+        # Rows may differ in the columns they have values for, e.g. colorspace:
+        rowsByColumns = {}
+        copies = []
+        for path, data, st in pending:
+            if 'hash' not in data:
+                copies.append((data['path'], data['duplicate_of']))
+                continue
+            keys = tuple(sorted([k for k in data.keys() if k in columns]))
+            rowsByColumns.setdefault(keys, []).append(tuple([data[k] for k in keys]))
+
+        paths = [data['path'] for path, data, st in pending]
+
+        with Connection.transaction() as cursor:
+            for keys, rows in rowsByColumns.items():
+                cursor.executemany(ImageFilesTable._upsertSQL(list(keys)), rows)
+
+            if copies:
+                cursor.executemany(ImageFilesTable._cloneSQL(
+                                       [x for x in ImageFilesTable.columns() \
+                                        if x not in ('imageID', 'path',
+                                                     'last_updated')],
+                                       'path', 'imageID'),
+                                   copies)
+
+            cursor.execute('SELECT imageID, path FROM %s WHERE path IN (%s)' % \
+                           (ImageFilesTable.table(), ','.join(['%s'] * len(paths))),
+                           paths)
+            imageIDs = dict([(x['path'], x['imageID']) for x in cursor.fetchall()])
+            imageIDs = [imageIDs[x] for x in paths]
+
+            cursor.executemany(FileStatsTable._upsertSQL(['imageID'] + \
+                                                         FileStatsTable.statsColumns(),
+                                                         FileStatsTable.statsColumns()),
+                               [FileStatsTable.storeArgs(imageID, st,
+                                                         data.get('fingerprint')) \
+                                for imageID, (path, data, st) in zip(imageIDs, pending)])
+
+            sampled = [(imageID, data) for imageID, (path, data, st) in \
+                       zip(imageIDs, pending) if 'duplicate_of' not in data]
+            duplicates = [(imageID, data['duplicate_of']) for imageID, (path, data, st) \
+                          in zip(imageIDs, pending) if 'duplicate_of' in data]
+
+            for resolution, mipTable in self.mipTables:
+                if not mipTable.exists():
+                    continue
+                if sampled:
+                    cursor.executemany(mipTable._upsertSQL(mipTable.colorColumns() + \
+                                                           ['imageID'],
+                                                           mipTable.colorColumns()),
+                                       [mipTable.storeArgs(imageID,
+                                                           data['pixel_dumps'][resolution]) \
+                                        for imageID, data in sampled])
+                if duplicates:
+                    cursor.executemany(mipTable._cloneSQL(mipTable.colorColumns(),
+                                                          'imageID', 'imageID'),
+                                       duplicates)
+
+            if MipVectorsTable.exists():
+                if sampled:
+                    cursor.executemany(MipVectorsTable._upsertSQL(['imageID', 'level',
+                                                                   'vector'],
+                                                                  ['vector']),
+                                       [x for imageID, data in sampled for x in \
+                                        MipVectorsTable.storeArgs(imageID,
+                                                                  data['pixel_dumps'])])
+                if duplicates:
+                    cursor.executemany(MipVectorsTable._cloneSQL(['level', 'vector'],
+                                                                 'imageID', 'imageID'),
+                                       duplicates)
+
+        # Images stored in the thumbnails BLOB column used to get truncated at
+        # random sizes, so thumbnails are kept in the ThumbnailStore instead:
+        try:
+            self.thumbnails.add([(imageID, data['thumbnail_pixels']) \
+                                 for imageID, data in sampled \
+                                 if 'thumbnail_pixels' in data])
+            # Sources may be in this very batch, so copies go second:
+            self.thumbnails.add([(imageID, self.thumbnails.get(sourceID)) \
+                                 for imageID, sourceID in duplicates \
+                                 if imageID != sourceID and sourceID in self.thumbnails])
+        except (IOError, OSError), e:
+            log.error('Failed to store %d thumbnail(s): %s' % (len(pending), e))
+
+        for known, key in ((self.knownHashes, 'hash'),
+                           (self.knownFingerprints, 'fingerprint')):
+            if known is not None:
+                for imageID, data in sampled:
+                    if data.get(key):
+                        known.setdefault(data[key], imageID)
+
+        if duplicates:
+            log.info('%d image(s) stored, %d of them as duplicates' % \
+                     (len(pending), len(duplicates)))
+        else:
+            log.info('%d image(s) stored' % len(pending))
+        return imageIDs
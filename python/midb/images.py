@@ -2,25 +2,71 @@
 
 import os
 import re
+import time
 import subprocess
 import datetime
 import tempfile
 import pprint
 import logging
+import numpy
 from config import Config
+import profiling
+
+try:
+    import OpenImageIO as oiio
+except ImportError:
+    oiio = None
 
 log = logging.getLogger('midb.images')
 
+def readPFM(filename):
+    """Read a PFM (portable float map) file and return its pixels as a float32
+    numpy array of (height, width, channels) shape, top row first.
+    """
+    f = file(filename, 'rb')
+    try:
+        magic = f.readline().strip()
+        if magic not in ('PF', 'Pf'):
+            raise ValueError('%s: not a PFM file' % filename)
+        channels = 3 if magic == 'PF' else 1
+        header = []
+        while len(header) < 3:
+            header.extend(f.readline().split())
+        width, height, scale = int(header[0]), int(header[1]), float(header[2])
+        dtype = '<f4' if scale < 0 else '>f4'
+        pixels = numpy.fromfile(f, dtype=dtype, count=width * height * channels)
+    finally:
+        f.close()
+    # PFM rows go bottom to top:
+    pixels = pixels.astype(numpy.float32).reshape(height, width, channels)
+    return pixels[::-1]
+
 class ImageInfo(dict):
+    """General info, mip level samples and thumbnail of an image file.
+    If knownHashes (a dictionary of pixel hashes to imageIDs) holds the hash
+    of the image, it is not sampled: 'duplicate_of' is set to that imageID
+    instead.
+    """
+
     def __init__(self, filename, resolutions=((1,1), (2,2), (4,4)),
-                 thumbSize=128, thumbFormat='png'):
+                 thumbSize=128, thumbFormat='png', knownHashes=None):
         super(ImageInfo, self).__init__()
+        if oiio is not None:
+            # Decode the file once, in this process:
+            info = self._readInProcess(filename, resolutions,
+                                       thumbSize, thumbFormat, knownHashes)
+            for k, v in info.items():
+                self.setdefault(k, v)
+            return
+            
         info = self._readGeneralInfo(filename)
         for k, v in info.items():
             self.setdefault(k, v)
+        if self._markDuplicate(self, knownHashes):
+            return
         if resolutions:
             imgDumpDict = self._readPixels(filename, resolutions,
-                                           thumbSize, thumbFormat)
+                                           thumbSize, thumbFormat, info=info)
             for k, v in imgDumpDict.items():
                 self.setdefault(k, v)
         
@@ -40,26 +86,181 @@ class ImageInfo(dict):
         if resolution not in self['pixel_dumps']:
             raise ValueError('resolution %dx%d was not sampled' % tuple(resolution))
         
-        floats = self['pixel_dumps'][resolution]
         w, h = resolution
+        floats = numpy.asarray(self['pixel_dumps'][resolution]).reshape(h, w, 3)
         minX = max(0, minX)
         minY = max(0, minY)
         maxX = min(w, maxX)
         maxY = min(h, maxY)
-        result = []
         
-        for y in range(minY, maxY, 1):
-            for x in range(minX, maxX, 1):
-                offset = (y * h + x) * 3
-                result.extend(floats[offset:offset+3])
-                
-        return result
+        return floats[minY:maxY, minX:maxX].flatten().tolist()
+
+    def getTilePixels(self, resolution, tilesInX, tilesInY):
+        """Split the given sampled resolution (w,h) into tilesInX by tilesInY
+        tiles and return a 2D numpy array with a row of floats per tile, rows
+        in the raster order of tiles. Each row holds the same values getPixels
+        would return for the tile's pixel range.
+        """
+        if resolution not in self['pixel_dumps']:
+            raise ValueError('resolution %dx%d was not sampled' % tuple(resolution))
+
+        w, h = resolution
+        scaleX = w / tilesInX
+        scaleY = h / tilesInY
+        floats = numpy.asarray(self['pixel_dumps'][resolution], dtype=numpy.float64)
+        floats = floats.reshape(h, w, 3)[:tilesInY*scaleY, :tilesInX*scaleX]
+        floats = floats.reshape(tilesInY, scaleY, tilesInX, scaleX, 3)
+        return floats.transpose(0, 2, 1, 3, 4).reshape(tilesInX * tilesInY,
+                                                       scaleX * scaleY * 3)
       
     def getThumbnailSize(self):
         return self['thumbnail_size']
 
     def getThumbnailData(self):
         return self['thumbnail']
+
+    @classmethod
+    def _formatName(cls, fmt):
+        """Return the image_files.format name for the OIIO format name
+        """
+        return {'jpeg': 'jpg', 'tiff': 'tif'}.get(fmt, fmt)
+
+    @classmethod
+    def _origTimestamp(cls, exifDateTime):
+        """Return orig_timestamp value for the given Exif:DateTimeOriginal
+        string, or Config.TIMESTAMP_FALLBACK if it is empty or cannot be parsed
+        """
+        if not exifDateTime:
+            return Config.TIMESTAMP_FALLBACK
+        try:
+            dt = datetime.datetime.strptime(exifDateTime, '%Y:%m:%d %H:%M:%S')
+        except:
+            log.warn('Bad Exif:DateTimeOriginal value: %s, skipped' % \
+                     exifDateTime)
+            return Config.TIMESTAMP_FALLBACK
+        return str(dt)
+
+    @classmethod
+    def _resizeSequence(cls, resolutions, thumbW, thumbH):
+        """Return a list of [w, h, i] sizes to resize an image to in sequence,
+        each step resizing the result of the previous one: the thumbnail (i=-1)
+        first, then resolutions from the largest to the smallest, where i is
+        the index in resolutions.
+        """
+        sizes = [[w, h, i] for i, (w, h) in enumerate(resolutions)]
+        sizes.sort(cmp=lambda *arg: cmp(arg[1][0] * arg[1][1],
+                                        arg[0][0] * arg[0][1]))
+        sizes.insert(0, (thumbW, thumbH, -1))
+        return sizes
+
+    @classmethod
+    def _thumbnailSize(cls, width, height, thumbSize):
+        """Return (w, h) of the thumbnail, thumbSize being the largest of them
+        """
+        scale = float(thumbSize) / max(width, height)
+        return int(width * scale + 0.5), int(height * scale + 0.5)
+
+    @classmethod
+    def _markDuplicate(cls, info, knownHashes):
+        """Set 'duplicate_of' in the info dictionary if its hash is one of
+        the knownHashes. Return True if it is.
+        """
+        imageID = knownHashes.get(info.get('hash')) if knownHashes else None
+        if imageID is None:
+            return False
+        log.info('%s: duplicate of image %d' % (info.get('path'), imageID))
+        info['duplicate_of'] = imageID
+        return True
+
+    @classmethod
+    def _readInProcess(cls, filename, resolutions=((1,1), (2,2), (4,4)),
+                       thumbSize=128, thumbFormat='png', knownHashes=None):
+        """Return a dictionary with all the keys of both _readGeneralInfo and
+        _readPixels, using the OpenImageIO python module: the file is read
+        and decoded once, the thumbnail and all the resolutions are resized
+        from that one buffer, no external processes are run.
+        """
+        buf = oiio.ImageBuf(filename)
+        with profiling.timed('image.decode'):
+            if not buf.read(0, 0, True):
+                raise RuntimeError('%s: %s' % (filename, buf.geterror()))
+        spec = buf.spec()
+        with profiling.timed('image.pixel_hash'):
+            pixelHash = oiio.ImageBufAlgo.computePixelHashSHA1(buf)
+        
+        result = {
+            'path': os.path.relpath(filename, Config.IMG_ROOT),
+            'format': cls._formatName(buf.file_format_name),
+            'num_channels': spec.nchannels,
+            'pixel_type': str(spec.format),
+            'width': spec.width,
+            'height': spec.height,
+            'frame_aspect': float(spec.width) / spec.height,
+            'hash': pixelHash,
+            'orig_timestamp': cls._origTimestamp(
+                spec.get_string_attribute('Exif:DateTimeOriginal')),
+        }
+        
+        colorspace = spec.get_string_attribute('oiio:ColorSpace')
+        if colorspace:
+            result['colorspace'] = colorspace
+
+        if not resolutions or cls._markDuplicate(result, knownHashes):
+            return result
+
+        thumbW, thumbH = cls._thumbnailSize(spec.width, spec.height, thumbSize)
+        result['thumbnail_size'] = (thumbW, thumbH)
+        result['pixel_dumps'] = {}
+
+        for w, h, i in cls._resizeSequence(resolutions, thumbW, thumbH):
+            with profiling.timed('image.resize'):
+                buf = oiio.ImageBufAlgo.resize(buf, roi=oiio.ROI(0, w, 0, h, 0, 1,
+                                                                 0, spec.nchannels))
+            if buf.has_error:
+                raise RuntimeError('%s: %s' % (filename, buf.geterror()))
+            
+            if i == -1:
+                # thumbnail!
+                with profiling.timed('image.encode_thumbnail'):
+                    result['thumbnail'] = cls._encode(buf, thumbFormat)
+                pixels = buf.get_pixels(oiio.UINT8).reshape(h, w, spec.nchannels)
+                result['thumbnail_pixels'] = cls._rgb(pixels)
+                continue
+
+            pixels = buf.get_pixels(oiio.FLOAT).reshape(h * w, spec.nchannels)
+            if spec.nchannels < 3:
+                # grayscale (possibly with alpha): replicate the first channel
+                pixels = pixels[:, [0, 0, 0]]
+            result['pixel_dumps'][(w,h)] = pixels[:, :3].flatten()
+
+        return result
+
+    @classmethod
+    def _rgb(cls, pixels):
+        """Return the (height, width, channels) pixels array as a (height,
+        width, 3) one: grayscale is replicated, alpha dropped
+        """
+        if pixels.shape[-1] < 3:
+            pixels = pixels[:, :, [0, 0, 0]]
+        return numpy.ascontiguousarray(pixels[:, :, :3])
+
+    @classmethod
+    def _encode(cls, buf, imageFormat):
+        """Return a binary string with the OIIO ImageBuf encoded in the given
+        image file format
+        """
+        fd, tfile = tempfile.mkstemp(prefix='myImgDBThumb',
+                                     suffix='.' + imageFormat)
+        os.close(fd)
+        try:
+            if not buf.write(tfile):
+                raise RuntimeError('%s: %s' % (tfile, buf.geterror()))
+            f = file(tfile, 'rb')
+            data = f.read()
+            f.close()
+        finally:
+            os.unlink(tfile)
+        return data
         
     @classmethod
     def _readGeneralInfo(cls, filename):
@@ -77,8 +278,11 @@ class ImageInfo(dict):
             frame_aspect
         """
         cmd = ['iinfo', '--hash', '-v', filename]
-        pipe = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = pipe.communicate()
+        with profiling.timed('image.iinfo'):
+            pipe = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            stdout, stderr = pipe.communicate()
+        parseStart = time.time()
         
         resRegex = re.compile(r'^(\d+)\s*x\s*(\d+)$')
         nchanRegex = re.compile(r'^(\d+)\s+channel$')
@@ -127,99 +331,100 @@ class ImageInfo(dict):
             elif parts[0] == 'oiio:ColorSpace':
                 result['colorspace'] = parts[1][1:-1]
             elif parts[0] == 'Exif:DateTimeOriginal':
-                try:
-                    dt = datetime.datetime.strptime(parts[1][1:-1],
-                                                    '%Y:%m:%d %H:%M:%S')
-                except:
-                    log.warn('Bad Exif:DateTimeOriginal value: %s, skipped' % \
-                             parts[1][1:-1])
-                    pass
-                else:
-                    result['orig_timestamp'] = str(dt)
+                result['orig_timestamp'] = cls._origTimestamp(parts[1][1:-1])
             
-        if result['format'] == 'jpeg':
-            result['format'] = 'jpg'
-        elif result['format'] == 'tiff':
-            result['format'] = 'tif'
-        
+        result['format'] = cls._formatName(result['format'])
+
+        profiling.record('image.iinfo_parse', time.time() - parseStart)
         return result
     
     @classmethod
     def _readPixels(cls, filename, resolutions=((1,1), (2,2), (4,4)),
-                    thumbSize=128, thumbFormat='png'):
+                    thumbSize=128, thumbFormat='png', info=None):
         """Return a dictionary with keys:
         'pixel_dumps': a dictionary, where resolutions tuples (x,y) are keys
-        and lists of float pixel values are values
+        and flat float32 numpy arrays of pixel values (RGBRGBRGB...) are values
         'thumbnail': binary string with the thumbnail image in the requested format
+        'thumbnail_pixels': (height, width, 3) uint8 numpy array of the thumbnail
         'thumbnail_size': (width, height)
+        info is the _readGeneralInfo result, if already known.
         """
-        info = cls._readGeneralInfo(filename)
-        scale = float(thumbSize) / max(info['width'], info['height'])
-        thumbW = int(info['width'] * scale + 0.5)
-        thumbH = int(info['height'] * scale + 0.5)
+        if info is None:
+            info = cls._readGeneralInfo(filename)
+        thumbW, thumbH = cls._thumbnailSize(info['width'], info['height'],
+                                            thumbSize)
 
         result = {'thumbnail_size': (thumbW, thumbH)}
         
-        rgbRegex = re.compile(r'^\s*Pixel \(\d+,\s+\d+\)\s*:\s*' \
-                               '([0-9\.\-\+e]+)\s+([0-9\.\-\+e]+)\s+([0-9\.\-\+e]+)\s*$')
-        floatRegex = re.compile(r'^\s*Pixel \(\d+,\s+\d+\)\s*:\s*' \
-                               '([0-9\.\-\+e]+)\s*$')
-
-        sizes = list(resolutions)
-        # Append order indices to widths, heights list to restore the original
-        # order later on. For now we have to sort the sized from the largest
-        # to the smallest, since this is what oiiotool is expecting to execute
-        # multiple resizes in one command:
-        sizes = [[w, h, i] for i, (w, h) in enumerate(sizes)]
-        sizes.sort(cmp=lambda *arg: cmp(arg[1][0] * arg[1][1],
-                                        arg[0][0] * arg[0][1]))
-        # thumbnail is expected to be the largest, so it should come first:
-        sizes.insert(0, (thumbW, thumbH, -1))
-        
+        # Sizes come with their order indices, to restore the original order
+        # later on. They are sorted from the largest to the smallest, since
+        # this is what oiiotool is expecting to execute multiple resizes in
+        # one command; thumbnail is expected to be the largest, so it comes first:
+        sizes = cls._resizeSequence(resolutions, thumbW, thumbH)
+
         tfiles = []
+        thumbPixelsFile = None
         cmd = ['oiiotool', filename]
 
         for w, h, i in sizes:
-            tfile = tempfile.mktemp(prefix='myImgDBResamp',
-                                    suffix=os.path.splitext(filename)[-1])
-    
-            if os.path.exists(tfile):
-                os.unlink(tfile)
-        
-            cmd.extend(['--resize', '%dx%d' % (w,h), '-o', tfile])
+            if i == -1:
+                suffix = os.path.splitext(filename)[-1]
+            else:
+                # Mip levels are saved as raw float32 PFM files and read back
+                # with numpy:
+                suffix = '.pfm'
+
+            fd, tfile = tempfile.mkstemp(prefix='myImgDBResamp', suffix=suffix)
+            os.close(fd)
             tfiles.append(tfile)
-            
-        subprocess.check_call(cmd)
-        
-        result['pixel_dumps'] = {}
-        
-        for (w, h, i), tfile in zip(sizes, tfiles):
-            if not os.path.exists(tfile):
-                raise RumtimeError('%s not found after being saved' % tfile)
-            
+
+            cmd.extend(['--resize', '%dx%d' % (w,h), '-o', tfile])
+
             if i == -1:
-                # thumbnail!
-                f = file(tfile, 'rb')
-                result['thumbnail'] = f.read(os.path.getsize(tfile))
-                f.close()
-                continue
-            
-            cmd = ['oiiotool', '--dumpdata', tfile]
-            pipe = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdout, stderr = pipe.communicate()
-            pixels = []
-            for line in stdout.splitlines():
-                if rgbRegex.match(line):
-                    found = rgbRegex.findall(line)
-                    rgb = [float(x) for x in found[0]]
-                    pixels.extend(rgb)
-                elif floatRegex.match(line):
-                    found = floatRegex.findall(line)
-                    rgb = [float(found[0])] * 3
-                    pixels.extend(rgb)
-            result['pixel_dumps'][(w,h)] = pixels
-                
-            os.unlink(tfile)
-        
+                # From here on: PFM only holds 1 or 3 channels. The thumbnail
+                # pixels are saved as PFM as well:
+                nchannels = info.get('num_channels', 3)
+                if nchannels >= 3:
+                    cmd.extend(['--ch', '0,1,2'])
+                elif nchannels == 2:
+                    cmd.extend(['--ch', '0'])
+                fd, thumbPixelsFile = tempfile.mkstemp(prefix='myImgDBResamp',
+                                                       suffix='.pfm')
+                os.close(fd)
+                cmd.extend(['-d', 'float', '-o', thumbPixelsFile])
+
+        result['pixel_dumps'] = {}
+
+        try:
+            with profiling.timed('image.oiiotool'):
+                subprocess.check_call(cmd)
+            readStart = time.time()
+
+            for (w, h, i), tfile in zip(sizes, tfiles):
+                if i == -1:
+                    # thumbnail!
+                    f = file(tfile, 'rb')
+                    result['thumbnail'] = f.read(os.path.getsize(tfile))
+                    f.close()
+                    pixels = numpy.clip(readPFM(thumbPixelsFile), 0.0, 1.0)
+                    pixels = (pixels * 255 + 0.5).astype(numpy.uint8)
+                    result['thumbnail_pixels'] = cls._rgb(pixels)
+                    continue
+
+                pixels = readPFM(tfile)
+                if pixels.shape[:2] != (h, w):
+                    raise RuntimeError('%s: %dx%d pixels expected, got %s' % \
+                                       (tfile, w, h, pixels.shape))
+                if pixels.shape[-1] == 1:
+                    # grayscale: replicate the only channel
+                    pixels = pixels[:, :, [0, 0, 0]]
+                result['pixel_dumps'][(w,h)] = pixels.flatten()
+
+            profiling.record('image.pfm_read', time.time() - readStart)
+        finally:
+            for tfile in tfiles + [thumbPixelsFile]:
+                if tfile and os.path.exists(tfile):
+                    os.unlink(tfile)
+
         return result
     
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+
+"""In-memory nearest neighbour search over the mip level tables: an opt-in
+replacement for the "ORDER BY distance" queries of MipLevel0Table.findClosest
+"""
+import logging
+import collections
+import numpy
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+from db import Connection, ImageFilesTable, MipVectorsTable, \
+               MipLevel0Table, MipLevel1Table, MipLevel2Table
+
+log = logging.getLogger('midb.index')
+
+
+def mipDistance(vectors, pixels):
+    """Vectorized MipLevel0Table.distance: return an array of color space
+    distances between the float pixels RGBRGBRGB... and each row of vectors
+    (a 2D array, or a single 1D vector, with len(pixels) columns).
+    """
+    pixels = numpy.asarray(pixels, dtype=numpy.float64)
+    n = len(pixels) / 3
+    diff = (numpy.asarray(vectors) - pixels).reshape(-1, n, 3).sum(axis=1)
+    return numpy.sqrt((diff ** 2).sum(axis=1)) / n
+
+
+class MipLevelIndex(object):
+    """Nearest neighbour index over one mip level table (active images only).
+    Rows are kept sorted by frame aspect, so the aspect tolerance window of
+    a query is a contiguous slice of them. A KD-tree is built for each window
+    the first time it is queried and cached after that: a mosaic run queries
+    the same window over and over again. Only the maxTrees most recently
+    used trees are kept.
+    If presorted is True, the rows are sorted already and the arrays are
+    used as they are, with no copy (e.g. the memory maps of an IndexSnapshot).
+    """
+    # Windows smaller than this are searched by brute force
+    minTreeSize = 256
+    # KD-trees kept (least recently used ones are dropped first)
+    maxTrees = 8
+
+    def __init__(self, mipTable, imageIDs, frameAspects, vectors,
+                 presorted=False):
+        self.mipTable = mipTable
+        if presorted:
+            self.imageIDs = numpy.asarray(imageIDs)
+            self.frameAspects = numpy.asarray(frameAspects)
+            self.vectors = numpy.asarray(vectors)
+        else:
+            order = numpy.argsort(numpy.asarray(frameAspects), kind='mergesort')
+            self.imageIDs = numpy.asarray(imageIDs, dtype=numpy.int64)[order]
+            self.frameAspects = numpy.asarray(frameAspects, dtype=numpy.float64)[order]
+            self.vectors = numpy.asarray(vectors, dtype=numpy.float64)[order]
+        self.vectors.shape = (len(self.imageIDs), mipTable.numValues())
+        self.rowByID = dict((x, i) for i, x in enumerate(self.imageIDs.tolist()))
+        self._trees = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.imageIDs)
+
+    @classmethod
+    def load(cls, mipTable):
+        """Read all the mip vectors of active images from mipTable (one query)
+        and return a new instance of the class indexing them.
+        """
+        table = mipTable.table()
+        colorColumns = mipTable.colorColumns()
+
+        sql = '''SELECT %s.imageID, image_files.frame_aspect, %s
+FROM image_files
+INNER JOIN
+    %s ON image_files.imageID = %s.imageID
+WHERE image_files.active = 1''' % (table,
+                                   ','.join(['%s.%s' % (table, x) for x in colorColumns]),
+                                   table,
+                                   table)
+
+        imageIDs = []
+        frameAspects = []
+        vectors = []
+
+        # Stream plain tuples rather than fetching a dictionary per row:
+        with Connection.streaming(asDict=False) as cursor:
+            cursor.execute(sql)
+            while True:
+                rows = cursor.fetchmany(4096)
+                if not rows:
+                    break
+                for x in rows:
+                    imageIDs.append(x[0])
+                    frameAspects.append(x[1])
+                    vectors.append(x[2:])
+
+        log.info('%s: %d vectors loaded' % (table, len(imageIDs)))
+        return cls(mipTable, imageIDs, frameAspects, vectors)
+
+    @classmethod
+    def loadVectors(cls, mipTable):
+        """Same as load, but read the mip level of mipTable from the
+        MipVectorsTable: the values of each image are decoded straight from
+        its packed vector.
+        """
+        sql = '''SELECT %s.imageID, image_files.frame_aspect, %s.vector
+FROM image_files
+INNER JOIN
+    %s ON image_files.imageID = %s.imageID
+WHERE image_files.active = 1 AND %s.level = %d''' % \
+            ((MipVectorsTable.table(),) * 5 + (mipTable.level,))
+
+        imageIDs = []
+        frameAspects = []
+        vectors = []
+
+        with Connection.streaming(asDict=False) as cursor:
+            cursor.execute(sql)
+            while True:
+                rows = cursor.fetchmany(4096)
+                if not rows:
+                    break
+                for x in rows:
+                    imageIDs.append(x[0])
+                    frameAspects.append(x[1])
+                    vectors.append(MipVectorsTable.decode(x[2]))
+
+        log.info('%s: %d level %d vectors loaded' % \
+                 (MipVectorsTable.table(), len(imageIDs), mipTable.level))
+        return cls(mipTable, imageIDs, frameAspects,
+                   numpy.vstack(vectors) if vectors \
+                   else numpy.zeros((0, mipTable.numValues())))
+
+    def window(self, frameAspect, aspectTolerance):
+        """Return (begin, end) row range for the images whose frame aspect
+        is strictly within aspectTolerance of frameAspect
+        """
+        begin = numpy.searchsorted(self.frameAspects, frameAspect - aspectTolerance,
+                                   side='right')
+        end = numpy.searchsorted(self.frameAspects, frameAspect + aspectTolerance,
+                                 side='left')
+        return int(begin), int(max(begin, end))
+
+    def _tree(self, begin, end):
+        """Return the (cached) KD-tree over rows begin:end, or None if brute
+        force search should be used for them.
+        """
+        if cKDTree is None or end - begin < self.minTreeSize:
+            return None
+        tree = self._trees.pop((begin, end), None)
+        if tree is None:
+            log.debug('%s: building KD-tree over %d rows' % \
+                      (self.mipTable.table(), end - begin))
+            tree = cKDTree(self.vectors[begin:end])
+            while len(self._trees) >= self.maxTrees:
+                self._trees.popitem(last=False)
+        self._trees[(begin, end)] = tree
+        return tree
+
+    def findClosest(self, pixels, frameAspect, aspectTolerance=0.1, limit=16,
+                    excludeImageIDs=None):
+        """Return a list of up to limit imageIDs, closest to the given rgb
+        pixels first. Same semantics as MipLevel0Table.findClosest.
+        """
+        rows = self.closestRows(pixels, frameAspect, aspectTolerance, limit,
+                                excludeImageIDs)
+        return self.imageIDs[rows].tolist()
+
+    def closestRows(self, pixels, frameAspect, aspectTolerance=0.1, limit=16,
+                    excludeImageIDs=None):
+        """Same as findClosest, but return an array of the rows of the images
+        rather than their imageIDs
+        """
+        begin, end = self.window(frameAspect, aspectTolerance)
+        exclude = set(excludeImageIDs) if excludeImageIDs else set()
+        # Excluded images can hide at most len(exclude) of the nearest rows:
+        k = min(end - begin, limit + len(exclude))
+
+        if k <= 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+
+        pixels = numpy.asarray(pixels, dtype=numpy.float64)
+        tree = self._tree(begin, end)
+
+        if tree is None:
+            dists = ((self.vectors[begin:end] - pixels) ** 2).sum(axis=1)
+            rows = numpy.argsort(dists, kind='mergesort')[:k]
+        else:
+            dists, rows = tree.query(pixels, k=k)
+            rows = numpy.atleast_1d(rows)
+
+        rows = rows + begin
+        if exclude:
+            rows = rows[~numpy.in1d(self.imageIDs[rows], list(exclude))]
+        return rows[:limit]
+
+    def distance(self, imageID, pixels):
+        """Return MipLevel0Table.distance for the given image, or 1e+27 if
+        the image is not in the index
+        """
+        row = self.rowByID.get(imageID)
+        if row is None:
+            return 1e+27
+        return float(mipDistance(self.vectors[row], pixels)[0])
+
+
+class ColorIndex(object):
+    """In-memory equivalent of ImageFilesTable.findByClosestColors and
+    ImageFilesTable.distance. Holds a MipLevelIndex for each mip level table,
+    and caches the image_files rows it returns.
+    """
+    mipTables = (MipLevel0Table, MipLevel1Table, MipLevel2Table)
+    # Candidates kept by the coarse stages of findCascade: the ones closest
+    # by mip_level0, then the ones of them closest by mip_level1
+    cascadePrune = 256
+    cascadeRefine = 64
+
+    def __init__(self, levels):
+        self.levels = dict([(x.mipTable.numValues(), x) for x in levels])
+        self._images = {}
+        # Pixel hash: imageIDs of the identical copies of the images read
+        self._copies = {}
+        # Number of values of a level: its rows matching the coarsest ones
+        self._cascadeRows = {}
+
+    @classmethod
+    def load(cls):
+        """Read all the mip level tables and return a new instance of the class
+        """
+        log.info('Loading the color index...')
+        return cls([MipLevelIndex.loadVectors(x) if MipVectorsTable.covers(x) \
+                    else MipLevelIndex.load(x) for x in cls.mipTables])
+
+    def level(self, pixels):
+        """Return the MipLevelIndex matching the number of pixel values
+        """
+        if len(pixels) not in self.levels:
+            raise ValueError('pixels: %d values not expected' % len(pixels))
+        return self.levels[len(pixels)]
+
+    def imagesByIDs(self, imageIDs):
+        """Return a list of ImageFilesTable instances for the given imageIDs,
+        in the same order. Only the ones not seen before are read from the
+        database, with a single query (and one more for their identical
+        copies, see duplicateIDs).
+        """
+        missing = [x for x in imageIDs if x not in self._images]
+        found = ImageFilesTable.findByIDs(missing)
+        for ift in found:
+            self._images[ift.id] = ift
+        self.duplicateIDs([x.hash for x in found])
+        return [self._images[x] for x in imageIDs if x in self._images]
+
+    def duplicateIDs(self, imageHashes):
+        """Return a dictionary of the imageIDs of the active images with
+        each of the given pixel hashes (see findDuplicateIDs), only the ones
+        not seen before being read from the database, with a single query.
+        """
+        missing = set([x for x in imageHashes if x and x not in self._copies])
+        if missing:
+            self._copies.update(ImageFilesTable.findDuplicateIDsByHashes(missing))
+        return dict([(x, self._copies[x]) for x in imageHashes if x in self._copies])
+
+    def findByClosestColors(self, pixels, frameAspect, aspectTolerance=0.1,
+                            limit=16, excludeImageIDs=None):
+        """Return a list of ImageFilesTable instances, closest to the given
+        pixel (rgb) value(s) first. Same semantics as
+        ImageFilesTable.findByClosestColors.
+        """
+        imageIDs = self.level(pixels).findClosest(pixels, frameAspect,
+                                                  aspectTolerance, limit,
+                                                  excludeImageIDs)
+        return self.imagesByIDs(imageIDs)
+
+    def findClosestWithDistances(self, pixels, frameAspect, aspectTolerance=0.1,
+                                 limit=16, excludeImageIDs=None):
+        """Same as findByClosestColors, but return a list of (distance,
+        ImageFilesTable instance) tuples, like
+        ImageFilesTable.findClosestWithDistances
+        """
+        level = self.level(pixels)
+        return [(level.distance(x.id, pixels), x) for x in \
+                self.findByClosestColors(pixels, frameAspect, aspectTolerance,
+                                         limit, excludeImageIDs)]
+
+    def distance(self, imageID, pixels):
+        """Return color space distance from the float pixels RGBRGBRGB...
+        to the mip level of the given image, like ImageFilesTable.distance
+        """
+        return self.level(pixels).distance(imageID, pixels)
+
+    def cascadeRows(self, numValues):
+        """Return an array of the rows of the MipLevelIndex with numValues
+        values for each row of the coarsest one (-1 for the images it does
+        not have)
+        """
+        if numValues not in self._cascadeRows:
+            coarse = self.levels[min(self.levels)]
+            level = self.levels[numValues]
+            order = numpy.argsort(level.imageIDs, kind='mergesort')
+            sortedIDs = level.imageIDs[order]
+            rows = numpy.empty(len(coarse), dtype=numpy.int64)
+            rows.fill(-1)
+            if len(sortedIDs):
+                pos = numpy.minimum(numpy.searchsorted(sortedIDs, coarse.imageIDs),
+                                    len(sortedIDs) - 1)
+                found = sortedIDs[pos] == coarse.imageIDs
+                rows[found] = order[pos[found]]
+            self._cascadeRows[numValues] = rows
+        return self._cascadeRows[numValues]
+
+    def findCascade(self, pixelsByLevel, frameAspect, aspectTolerance=0.1,
+                    limit=16, excludeImageIDs=None, prune=None, refine=None):
+        """Coarse to fine search, given the pixel values of the query at each
+        mip level, coarsest first: the prune images closest by the first
+        level are ranked by the next one, the refine closest of them by the
+        last one. Return a list of up to limit (distance, ImageFilesTable)
+        tuples, closest first, distances being the ones of the last level
+        (see findClosestWithDistances). The results are those of the full
+        search at the last level, as long as its matches are among the prune
+        closest by the first (see benchmark.Benchmark.runCascade).
+        """
+        prune = max(limit, prune or self.cascadePrune)
+        refine = max(limit, refine or self.cascadeRefine)
+        keep = [refine] * (len(pixelsByLevel) - 2) + [limit]
+
+        coarse = self.level(pixelsByLevel[0])
+        rows = coarse.closestRows(pixelsByLevel[0], frameAspect,
+                                  aspectTolerance, prune, excludeImageIDs)
+
+        levelRows = rows
+        level = coarse
+        for pixels, count in zip(pixelsByLevel[1:], keep):
+            level = self.level(pixels)
+            levelRows = self.cascadeRows(len(pixels))[rows]
+            rows = rows[levelRows >= 0]
+            levelRows = levelRows[levelRows >= 0]
+            pixels = numpy.asarray(pixels, dtype=numpy.float64)
+            dists = ((level.vectors[levelRows] - pixels) ** 2).sum(axis=1)
+            order = numpy.argsort(dists, kind='mergesort')[:count]
+            rows = rows[order]
+            levelRows = levelRows[order]
+        rows = rows[:limit]
+        levelRows = levelRows[:limit]
+
+        distances = mipDistance(level.vectors[levelRows],
+                                pixelsByLevel[-1]).tolist()
+        images = dict([(x.id, x) for x in \
+                       self.imagesByIDs(coarse.imageIDs[rows].tolist())])
+        return [(d, images[x]) for d, x in \
+                zip(distances, coarse.imageIDs[rows].tolist()) if x in images]
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+
+"""Parallel image ingest: directories are scanned, images read and sampled
+(by a pool of worker processes, if asked) and stored in the database in
+concurrent stages, with bounded queues in between. Progress can be
+checkpointed to an IngestJournal, for an interrupted run to be resumed.
+"""
+import os
+import sys
+import Queue
+import logging
+import threading
+import multiprocessing
+
+from db import ImageFilesTable, ImageBatchWriter
+import profiling
+
+log = logging.getLogger('midb.ingest')
+
+
+class _RecordCollector(logging.Handler):
+    """Log handler of the pool worker processes: instead of writing records
+    out, collect them, so they can be sent back to the parent process and
+    handled (i.e. written to the rotating log file) there.
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        # Make the record picklable: format the message and the traceback,
+        # drop the arguments
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.msg = record.getMessage()
+        record.args = None
+        self.records.append(record)
+
+    def pop(self):
+        records, self.records = self.records, []
+        return records
+
+
+_collector = None
+_knownHashes = None
+_knownFingerprints = None
+
+
+def _initWorker(knownHashes=None, knownFingerprints=None):
+    """Pool worker initializer: route all the 'midb' log records to the
+    collector instead of the handlers inherited from the parent process.
+    knownHashes and knownFingerprints (see ImageFilesTable.readImageInfo) are
+    kept for all the jobs of the worker.
+    """
+    global _collector, _knownHashes, _knownFingerprints
+    _knownHashes = knownHashes
+    _knownFingerprints = knownFingerprints
+    _collector = _RecordCollector()
+    logger = logging.getLogger('midb')
+    for h in list(logger.handlers):
+        logger.removeHandler(h)
+    logger.addHandler(_collector)
+
+
+def readImageInfo(path, resolutions=((1,1), (2,2), (4,4)),
+                  thumbSize=128, thumbFormat='png'):
+    """Pool worker job: read the image info and pixels of the image file at path.
+    Return a (path, ImageInfo, log records, profiling records) tuple; the
+    ImageInfo is None if the image could not be read.
+    """
+    data = ImageFilesTable.readImageInfo(path, resolutions, thumbSize,
+                                         thumbFormat, _knownHashes,
+                                         _knownFingerprints)
+    records = _collector.pop() if _collector else []
+    return path, data, records, profiling.pop()
+
+
+def _handleRecords(records):
+    """Handle log records sent back by a pool worker
+    """
+    for record in records:
+        logging.getLogger(record.name).handle(record)
+
+
+class IngestJournal(object):
+    """Checkpoints of a --store run of a root directory, in a small local
+    file of text lines appended (and synced) as batches are written:
+    'R <root>' first, then 'D <directory>' once all the images of a
+    directory are stored, 'F <path>' for each image stored in a directory
+    that is not (yet). Images that failed are not checkpointed: their
+    directory is scanned again, and they are retried.
+    A new run of the same root resuming it (if resume is True) skips the
+    directories and images done; the journal is removed once a run
+    completes. Other runs start over: directories may have changed since.
+    """
+    def __init__(self, path, rootDir, resume=False):
+        self.path = path
+        self.rootDir = os.path.abspath(rootDir)
+        self.doneDirs = set()
+        self.doneFiles = set()
+        self._file = None
+        self._load(resume)
+
+    @staticmethod
+    def _line(kind, path):
+        return '%s %s\n' % (kind, path.encode('string_escape'))
+
+    def _load(self, resume):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            records = [(x[0], x[2:].rstrip('\n').decode('string_escape')) \
+                       for x in f if x[1:2] == ' ']
+        if not records or records[0] != ('R', self.rootDir):
+            log.info('%s: checkpoints of another run, starting over' % self.path)
+            return
+        if not resume:
+            log.info('%s: checkpoints of an interrupted run of %s, not resumed: '
+                     'starting over' % (self.path, self.rootDir))
+            return
+        for kind, path in records[1:]:
+            if kind == 'D':
+                self.doneDirs.add(path)
+            elif kind == 'F':
+                self.doneFiles.add(path)
+        self.doneFiles = set([x for x in self.doneFiles \
+                              if os.path.dirname(x) not in self.doneDirs])
+        log.info('Resuming from %s: %d directories and %d more images done '
+                 'with' % (self.path, len(self.doneDirs), len(self.doneFiles)))
+
+    def open(self):
+        """Start appending checkpoints, to a compacted copy of the journal
+        """
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self._line('R', self.rootDir))
+            f.writelines([self._line('D', x) for x in sorted(self.doneDirs)])
+            f.writelines([self._line('F', x) for x in sorted(self.doneFiles)])
+        os.rename(tmp, self.path)
+        self._file = open(self.path, 'a')
+
+    def add(self, files=(), dirs=(), sync=True):
+        """Checkpoint the given image paths and directories as done with,
+        synced to disk unless sync is False
+        """
+        self.doneFiles.update(files)
+        self.doneDirs.update(dirs)
+        self._file.writelines([self._line('F', x) for x in files] + \
+                              [self._line('D', x) for x in dirs])
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def discard(self):
+        """Close and remove the journal: the run is complete
+        """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# End of the items of a stage
+_END = object()
+
+
+class _DirEnd(object):
+    """Pipeline item following the images of a directory: count of them"""
+    __slots__ = ('path', 'count')
+
+    def __init__(self, path, count):
+        self.path = path
+        self.count = count
+
+
+class _Failure(object):
+    """Pipeline item: exception info of a failed stage"""
+    __slots__ = ('excInfo',)
+
+    def __init__(self, excInfo):
+        self.excInfo = excInfo
+
+
+def storePipelined(dirs, accept=None, jobs=1, resolutions=((1,1), (2,2), (4,4)),
+                   thumbSize=128, thumbFormat='png', batchSize=64,
+                   knownHashes=None, knownFingerprints=None, journal=None,
+                   queueSize=128, writer=None):
+    """Store the images of the given directories in the database, in three
+    concurrent stages:
+    - a scanner thread consumes dirs, an iterable of (directory, entries)
+      tuples (see ImageFilesTable.scanImageDirs), entries being (absolute
+      path, os.stat result) tuples, and queues the paths of the images for
+      which accept(path, os.stat result) is True (all if accept is None);
+    - decoder threads read and sample them (see
+      ImageFilesTable.readImageInfo): jobs worker processes of a pool if
+      jobs > 1, else one thread of this process;
+    - this thread writes them in batches of batchSize, see ImageBatchWriter
+      (writer, if given, is used and flushed instead of a new one; its
+      queued file stats updates are written at directory ends too).
+    The queues hold at most queueSize items each: stages wait for the next
+    ones to catch up, so memory use does not grow with the directories.
+    If journal (an IngestJournal) is given, the directories and images it has
+    as done are skipped (not even passed to accept), and the ones written are
+    checkpointed to it after each batch (a directory once all of its images
+    are); it is discarded once all are done.
+    See ImageFilesTable.traverseAndStore for knownHashes and knownFingerprints.
+    A failure to read or store one image is logged and does not stop the rest.
+    Return the (stored, failed) counts.
+    """
+    pool = multiprocessing.Pool(jobs, _initWorker, (knownHashes,
+                                                    knownFingerprints)) \
+           if jobs > 1 else None
+    decoders = max(1, jobs)
+    decodeQueue = Queue.Queue(queueSize)
+    writeQueue = Queue.Queue(queueSize)
+    stop = threading.Event()
+
+    def put(queue, item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def get(queue):
+        while not stop.is_set():
+            try:
+                return queue.get(timeout=0.5)
+            except Queue.Empty:
+                pass
+        return _END
+
+    def scan():
+        try:
+            for path, entries in dirs:
+                if journal is not None and path in journal.doneDirs:
+                    continue
+                count = 0
+                for fullpath, st in entries:
+                    if journal is not None and fullpath in journal.doneFiles:
+                        continue
+                    with profiling.timed('ingest.scan'):
+                        accepted = accept is None or accept(fullpath, st)
+                    if accepted:
+                        if not put(decodeQueue, (path, fullpath)):
+                            return
+                        count += 1
+                if not put(decodeQueue, _DirEnd(path, count)):
+                    return
+        except Exception:
+            put(writeQueue, _Failure(sys.exc_info()))
+        finally:
+            for i in range(decoders):
+                put(decodeQueue, _END)
+
+    def decode():
+        try:
+            while True:
+                item = get(decodeQueue)
+                if item is _END:
+                    break
+                if not isinstance(item, _DirEnd):
+                    path, fullpath = item
+                    if pool is not None:
+                        result = pool.apply_async(readImageInfo,
+                                                  (fullpath, resolutions,
+                                                   thumbSize, thumbFormat))
+                        while not result.ready():
+                            if stop.is_set():
+                                return
+                            result.wait(0.5)
+                        fullpath, data, records, timings = result.get()
+                        _handleRecords(records)
+                        profiling.merge(timings)
+                    else:
+                        data = ImageFilesTable.readImageInfo(fullpath,
+                                                             resolutions,
+                                                             thumbSize,
+                                                             thumbFormat,
+                                                             knownHashes,
+                                                             knownFingerprints)
+                    item = (path, fullpath, data)
+                if not put(writeQueue, item):
+                    break
+        except Exception:
+            put(writeQueue, _Failure(sys.exc_info()))
+        finally:
+            put(writeQueue, _END)
+
+    if writer is None:
+        writer = ImageBatchWriter(batchSize, knownHashes=knownHashes,
+                                  knownFingerprints=knownFingerprints \
+                                                    if knownHashes is not None \
+                                                    else None)
+    counts = [0, 0]
+    # Per directory: images done with, and expected (once scanned)
+    done = {}
+    expected = {}
+    # Directories with images that failed: not checkpointed as done
+    failedDirs = set()
+    batch = []
+
+    def checkpoint(items, imageIDs):
+        stored = []
+        dirsDone = []
+        for (path, fullpath), imageID in zip(items, imageIDs):
+            counts[imageID is None] += 1
+            if imageID is None:
+                failedDirs.add(path)
+            else:
+                stored.append((path, fullpath))
+            done[path] = done.get(path, 0) + 1
+            if done[path] == expected.get(path) and path not in failedDirs:
+                dirsDone.append(path)
+        if journal is not None:
+            journal.add([x for p, x in stored if p not in dirsDone],
+                        dirsDone)
+
+    def dirEnd(path, count):
+        expected[path] = count
+        if done.get(path, 0) == count and path not in failedDirs and \
+           journal is not None:
+            # Nothing written since the last batch: losing this checkpoint
+            # only means scanning the directory again
+            journal.add(dirs=[path], sync=False)
+
+    threads = [threading.Thread(target=scan, name='midb-scan')] + \
+              [threading.Thread(target=decode, name='midb-decode-%d' % i) \
+               for i in range(decoders)]
+    for t in threads:
+        t.daemon = True
+
+    if journal is not None:
+        journal.open()
+    log.info('Reading images with %s' % ('%d worker processes' % jobs \
+                                         if pool is not None else 'one thread'))
+    try:
+        for t in threads:
+            t.start()
+
+        ended = 0
+        while ended < decoders:
+            item = get(writeQueue)
+            if item is _END:
+                ended += 1
+            elif isinstance(item, _Failure):
+                raise item.excInfo[0], item.excInfo[1], item.excInfo[2]
+            elif isinstance(item, _DirEnd):
+                dirEnd(item.path, item.count)
+                if len(writer.stats) >= writer.batchSize:
+                    writer.flushStats()
+            else:
+                path, fullpath, data = item
+                if data is None:
+                    checkpoint([(path, fullpath)], [None])
+                    continue
+                queued = len(writer.pending)
+                imageIDs = writer.add(fullpath, data)
+                if len(writer.pending) > queued:
+                    batch.append((path, fullpath))
+                elif writer.pending:
+                    # Not queued: the file could not be stat'ed
+                    checkpoint([(path, fullpath)], imageIDs)
+                else:
+                    items, batch = batch + [(path, fullpath)], []
+                    checkpoint(items, imageIDs)
+
+        imageIDs = writer.flush()
+        checkpoint(batch, imageIDs)
+        if pool is not None:
+            pool.close()
+    except:
+        stop.set()
+        if pool is not None:
+            pool.terminate()
+        if journal is not None:
+            journal.close()
+        raise
+    finally:
+        stop.set()
+        if pool is not None:
+            pool.join()
+        for t in threads:
+            t.join()
+
+    if journal is not None:
+        journal.discard()
+    log.info('%d image(s) stored, %d failed' % tuple(counts))
+    return tuple(counts)
+
+
+def storeInParallel(paths, jobs, resolutions=((1,1), (2,2), (4,4)),
+                    thumbSize=128, thumbFormat='png', batchSize=64,
+                    knownHashes=None, knownFingerprints=None):
+    """Read the images at the given absolute paths with a pool of jobs worker
+    processes, and store them in the database (in batches of batchSize, see
+    ImageBatchWriter) as they come back, see storePipelined.
+    All the database work is done in this process. paths can be a generator:
+    it is consumed here too, no further ahead than the queues of the
+    pipeline.
+    Images with one of the knownHashes or knownFingerprints are not sampled,
+    see ImageFilesTable.readImageInfo. The workers get them as they are when
+    the pool starts.
+    A failure to read or store one image is logged and does not stop the rest.
+    Return the (stored, failed) counts.
+    """
+    return storePipelined([(None, ((x, None) for x in paths))], None, jobs,
+                          resolutions, thumbSize, thumbFormat, batchSize,
+                          knownHashes, knownFingerprints)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""Batched mosaic tile matching: rank the candidate images of all the tiles
+of a mosaic at once, with a few array operations per mip level instead of
+a database query (or an index lookup) per tile.
+"""
+import logging
+import collections
+import numpy
+
+log = logging.getLogger('midb.matcher')
+
+
+class TileCandidates(object):
+    """Ranked candidate images for every tile of a mosaic and every mip level,
+    as returned by BatchMatcher.rank
+    """
+    def __init__(self, index, tileVectors, frameAspect, aspectTolerance,
+                 imageIDs, distances, complete):
+        self.index = index
+        self.tileVectors = tileVectors
+        self.frameAspect = frameAspect
+        self.aspectTolerance = aspectTolerance
+        # Per mip level: (tiles x depth) arrays, closest first
+        self.imageIDs = imageIDs
+        self.distances = distances
+        # Per mip level: True if the ranked lists hold the whole library
+        self.complete = complete
+
+    def closest(self, tile, level, limit=16, excludeImageIDs=None):
+        """Return a list of up to limit (distance, ImageFilesTable) tuples for
+        the given tile index and mip level, closest first, skipping the
+        excludeImageIDs. Equivalent of ColorIndex.findByClosestColors followed
+        by ColorIndex.distance on each image found.
+        If the exclusions use up the pre-ranked candidates, the index is
+        queried for this tile directly.
+        """
+        exclude = set(excludeImageIDs) if excludeImageIDs else set()
+        found = []
+
+        for imageID, dist in zip(self.imageIDs[level][tile].tolist(),
+                                 self.distances[level][tile].tolist()):
+            if imageID not in exclude:
+                found.append((dist, imageID))
+                if len(found) == limit:
+                    break
+        else:
+            if not self.complete[level]:
+                pixels = self.tileVectors[level][tile]
+                mipIndex = self.index.level(pixels)
+                imageIDs = mipIndex.findClosest(pixels, self.frameAspect,
+                                                self.aspectTolerance, limit,
+                                                exclude)
+                found = [(mipIndex.distance(x, pixels), x) for x in imageIDs]
+
+        images = dict([(x.id, x) for x in \
+                       self.index.imagesByIDs([x for d, x in found])])
+        return [(d, images[x]) for d, x in found if x in images]
+
+
+class LookupCache(object):
+    """Memoizes the findClosestWithDistances lookups of a finder (e.g. the
+    ImageFilesTable class or a ColorIndex): tiles whose samples quantize to
+    the same values (flat areas: sky, walls...) share one ranked candidate
+    list, looked up once without exclusions and filtered by them afterwards.
+    Samples are quantized to steps of 1 / quantum, frame aspects to steps of
+    1 / aspectQuantum; the distances returned are the ones of the first tile
+    looked up with a key. At most maxEntries lists are kept, the least
+    recently used ones are dropped first.
+    """
+    def __init__(self, finder, maxEntries=4096, quantum=64, aspectQuantum=100,
+                 depth=32):
+        self.finder = finder
+        self.maxEntries = maxEntries
+        self.quantum = quantum
+        self.aspectQuantum = aspectQuantum
+        self.depth = depth
+        # key: (ranked (distance, ImageFilesTable) list, complete)
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, pixels, frameAspect, aspectTolerance):
+        return (tuple([int(x * self.quantum + 0.5) for x in pixels]),
+                int(frameAspect * self.aspectQuantum + 0.5),
+                aspectTolerance)
+
+    def findClosestWithDistances(self, pixels, frameAspect, aspectTolerance=0.1,
+                                 limit=16, excludeImageIDs=None):
+        """Same as the findClosestWithDistances method of the finder
+        """
+        exclude = set(excludeImageIDs) if excludeImageIDs else set()
+        key = self.key(pixels, frameAspect, aspectTolerance)
+        entry = self._entries.pop(key, None)
+
+        if entry is not None:
+            found = [x for x in entry[0] if x[1].id not in exclude][:limit]
+            # The exclusions used up a list that does not hold the whole
+            # aspect window: look up deeper
+            if len(found) < limit and not entry[1]:
+                entry = None
+
+        if entry is None:
+            self.misses += 1
+            depth = max(self.depth, limit + len(exclude))
+            ranked = self.finder.findClosestWithDistances(pixels, frameAspect,
+                                                          aspectTolerance, depth)
+            entry = (ranked, len(ranked) < depth)
+            found = [x for x in ranked if x[1].id not in exclude][:limit]
+        else:
+            self.hits += 1
+
+        self._entries[key] = entry
+        while len(self._entries) > self.maxEntries:
+            self._entries.popitem(last=False)
+        return found
+
+    def logStats(self):
+        log.info('Lookup cache: %d hit(s), %d miss(es), %d list(s)' % \
+                 (self.hits, self.misses, len(self._entries)))
+
+
+class BatchMatcher(object):
+    """Ranks the closest images of a ColorIndex for all the mosaic tiles in one
+    pass: the squared distances of a chunk of tiles to the whole library are a
+    single matrix product, the closest depth of them are selected with
+    argpartition.
+    """
+    def __init__(self, index, depth=32, chunkSize=256):
+        self.index = index
+        self.depth = depth
+        self.chunkSize = chunkSize
+
+    def rankLevel(self, vectors, frameAspect, aspectTolerance=0.1):
+        """Return (imageIDs, distances, complete) for one mip level, given the
+        (tiles x values) array of the tile vectors. imageIDs are ordered by the
+        euclidean distance (same as the ORDER BY of MipLevel0Table.findClosest),
+        distances are the ones of MipLevel0Table.distance.
+        """
+        vectors = numpy.asarray(vectors, dtype=numpy.float64)
+        numTiles = len(vectors)
+        mipIndex = self.index.level(vectors[0])
+        begin, end = mipIndex.window(frameAspect, aspectTolerance)
+        library = mipIndex.vectors[begin:end]
+        libraryIDs = mipIndex.imageIDs[begin:end]
+        depth = min(self.depth, len(library))
+
+        imageIDs = numpy.zeros((numTiles, depth), dtype=numpy.int64)
+        distances = numpy.zeros((numTiles, depth), dtype=numpy.float64)
+
+        if depth == 0:
+            return imageIDs, distances, True
+
+        libraryNorms = (library ** 2).sum(axis=1)
+
+        for start in range(0, numTiles, self.chunkSize):
+            chunk = vectors[start:start + self.chunkSize]
+            tiles = numpy.arange(len(chunk))[:, numpy.newaxis]
+
+            squared = (chunk ** 2).sum(axis=1)[:, numpy.newaxis] + libraryNorms - \
+                      2 * numpy.dot(chunk, library.T)
+
+            if depth < len(library):
+                rows = numpy.argpartition(squared, depth - 1, axis=1)[:, :depth]
+            else:
+                rows = numpy.tile(numpy.arange(depth), (len(chunk), 1))
+
+            rows = rows[tiles, numpy.argsort(squared[tiles, rows], axis=1,
+                                             kind='mergesort')]
+
+            imageIDs[start:start + len(chunk)] = libraryIDs[rows]
+            distances[start:start + len(chunk)] = self._distances(library[rows],
+                                                                  chunk)
+
+        return imageIDs, distances, depth == len(library)
+
+    @staticmethod
+    def _distances(candidates, chunk):
+        """Return (tiles x depth) MipLevel0Table.distance values between each
+        tile of chunk (tiles x values) and its candidates (tiles x depth x values)
+        """
+        numTiles, depth, numValues = candidates.shape
+        n = numValues / 3
+        diff = (candidates - chunk[:, numpy.newaxis, :]).reshape(numTiles, depth,
+                                                                 n, 3).sum(axis=2)
+        return numpy.sqrt((diff ** 2).sum(axis=2)) / n
+
+    def rank(self, tileVectors, frameAspect, aspectTolerance=0.1):
+        """Rank the candidates of every tile for every mip level, given a list
+        of (tiles x values) arrays, one per mip level. Return a TileCandidates
+        instance.
+        """
+        imageIDs = []
+        distances = []
+        complete = []
+
+        for vectors in tileVectors:
+            log.info('Ranking %d tiles by %d sample(s)...' % \
+                     (len(vectors), len(vectors[0]) / 3))
+            i, d, c = self.rankLevel(vectors, frameAspect, aspectTolerance)
+            imageIDs.append(i)
+            distances.append(d)
+            complete.append(c)
+
+        return TileCandidates(self.index, tileVectors, frameAspect,
+                              aspectTolerance, imageIDs, distances, complete)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+"""Lightweight timing instrumentation of the hot paths: stages (and SQL
+statements, by shape) are timed with the timed context manager, and their
+counts, total and percentile durations summarized.
+Disabled by default: timed then returns a shared no-op context manager, so
+the instrumentation costs next to nothing.
+"""
+import re
+import time
+import json
+import random
+import logging
+import threading
+import numpy
+
+log = logging.getLogger('midb.profiling')
+
+# Durations kept per stage for the percentiles (a uniform sample of them
+# beyond that)
+MAX_SAMPLES = 4096
+
+_enabled = False
+_snapshotInterval = 0
+_lastSnapshot = 0.0
+_lock = threading.Lock()
+_stages = {}
+
+
+def durationStats(samples):
+    """Return a dictionary of count, mean, min, max and 50th, 90th, 99th
+    percentiles of the durations (in seconds) given, all in milliseconds
+    """
+    if not samples:
+        return {'count': 0}
+    ms = numpy.asarray(samples, dtype=numpy.float64) * 1000.0
+    return {'count': len(ms),
+            'mean_ms': float(ms.mean()),
+            'min_ms': float(ms.min()),
+            'max_ms': float(ms.max()),
+            'p50_ms': float(numpy.percentile(ms, 50)),
+            'p90_ms': float(numpy.percentile(ms, 90)),
+            'p99_ms': float(numpy.percentile(ms, 99))}
+
+
+_literalRegex = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|"
+                           r"\b-?\d+(?:\.\d+)?(?:e[-+]?\d+)?\b|%s", re.I)
+_listRegex = re.compile(r'\((?:\s*\?\s*,)+\s*\?\s*\)')
+_spaceRegex = re.compile(r'\s+')
+
+
+def sqlShape(sql, maxLength=160):
+    """Return the shape of the SQL statement: literal values and placeholders
+    replaced by ?, lists of them by (...), whitespace collapsed
+    """
+    shape = _literalRegex.sub('?', sql)
+    shape = _listRegex.sub('(...)', shape)
+    shape = _spaceRegex.sub(' ', shape).strip()
+    if len(shape) > maxLength:
+        shape = shape[:maxLength - 3] + '...'
+    return shape
+
+
+class _Stage(object):
+    __slots__ = ('count', 'total', 'max', 'samples')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = []
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(seconds)
+        else:
+            i = random.randrange(self.count)
+            if i < MAX_SAMPLES:
+                self.samples[i] = seconds
+
+    def merge(self, count, total, maxSeconds, samples):
+        self.count += count
+        self.total += total
+        self.max = max(self.max, maxSeconds)
+        self.samples.extend(samples)
+        if len(self.samples) > MAX_SAMPLES:
+            self.samples = random.sample(self.samples, MAX_SAMPLES)
+
+    def stats(self):
+        result = durationStats(self.samples)
+        result.update({'count': self.count,
+                       'total_s': self.total,
+                       'mean_ms': self.total * 1000.0 / self.count,
+                       'max_ms': self.max * 1000.0})
+        return result
+
+
+class _Timer(object):
+    __slots__ = ('name', 'sql', 'start')
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.time() - self.start, self.sql)
+        return False
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_nullTimer = _NullTimer()
+
+
+class _ProfiledCursor(object):
+    """Database cursor wrapper timing every statement executed as 'sql',
+    by shape
+    """
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, args=None):
+        with timed('sql', sql):
+            return self._cursor.execute(sql, args)
+
+    def executemany(self, sql, args):
+        with timed('sql', sql):
+            return self._cursor.executemany(sql, args)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def cursor(c):
+    """Return the database cursor c wrapped to time its statements, or c
+    itself if profiling is disabled
+    """
+    return _ProfiledCursor(c) if _enabled else c
+
+
+def timed(name, sql=None):
+    """Return a context manager timing the code it wraps as the stage name,
+    or as the statement shape of sql under the name, if given.
+    """
+    if not _enabled:
+        return _nullTimer
+    return _Timer(name, sql)
+
+
+def record(name, seconds, sql=None):
+    """Record a duration of the stage name (see timed)
+    """
+    if not _enabled:
+        return
+    if sql is not None:
+        name = '%s: %s' % (name, sqlShape(sql))
+
+    global _lastSnapshot
+    snapshot = False
+    with _lock:
+        stage = _stages.get(name)
+        if stage is None:
+            stage = _stages[name] = _Stage()
+        stage.add(seconds)
+        if _snapshotInterval:
+            now = time.time()
+            if now - _lastSnapshot >= _snapshotInterval:
+                _lastSnapshot = now
+                snapshot = True
+    if snapshot:
+        logSnapshot()
+
+
+def enable(snapshotInterval=0):
+    """Start recording. If snapshotInterval (seconds) is not 0, a snapshot of
+    the busiest stages is logged that often.
+    """
+    global _enabled, _snapshotInterval, _lastSnapshot
+    _enabled = True
+    _snapshotInterval = snapshotInterval
+    _lastSnapshot = time.time()
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+
+
+def summary():
+    """Return a dictionary of the stats (see durationStats, plus total_s) of
+    every stage recorded
+    """
+    with _lock:
+        return dict([(k, v.stats()) for k, v in _stages.items()])
+
+
+def logSnapshot(top=10):
+    """Log the stats of the top stages by total time
+    """
+    stats = summary()
+    ranked = sorted(stats.items(), key=lambda x: -x[1]['total_s'])[:top]
+    log.info('Profile snapshot, top %d of %d stages:' % (len(ranked), len(stats)))
+    for name, s in ranked:
+        log.info('  %9.3fs %8d x %8.3fms (p90 %8.3fms)  %s' % \
+                 (s['total_s'], s['count'], s['mean_ms'], s['p90_ms'], name))
+
+
+def pop():
+    """Return the raw records (to be merged in another process, see merge)
+    and reset them
+    """
+    with _lock:
+        raw = dict([(k, (v.count, v.total, v.max, v.samples)) \
+                    for k, v in _stages.items()])
+        _stages.clear()
+    return raw
+
+
+def merge(raw):
+    """Merge the raw records of pop, e.g. sent back by a worker process
+    """
+    if not raw:
+        return
+    with _lock:
+        for name, (count, total, maxSeconds, samples) in raw.items():
+            stage = _stages.get(name)
+            if stage is None:
+                stage = _stages[name] = _Stage()
+            stage.merge(count, total, maxSeconds, samples)
+
+
+def writeSummary(f):
+    """Write the summary to the file object f as JSON
+    """
+    json.dump(summary(), f, indent=2, sort_keys=True)
+    f.write('\n')
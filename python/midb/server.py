@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+"""Mosaic server: keeps the color index, tile cache and thumbnail store of
+the library loaded (and its database connection open), and makes the
+mosaics asked by clients over a local Unix socket.
+The protocol is JSON, one object per line: the client sends a request, the
+server answers with events until the last one ('done' or 'error').
+"""
+import os
+import json
+import stat
+import time
+import Queue
+import socket
+import logging
+import threading
+import traceback
+import SocketServer
+
+log = logging.getLogger('midb.server')
+
+# makeMosaicImage arguments a 'mosaic' request may give
+MOSAIC_ARGS = ('filename', 'tilesInXorY', 'outputResInX', 'outfile',
+               'noRepeatCount', 'imageQueryLimit', 'batch', 'cascade',
+               'assign', 'noRepeatRadius', 'resizeJobs', 'tileCache',
+               'useThumbnails', 'dedup', 'lookupCache')
+
+
+class _Job(object):
+    """A request queued for the job thread of the server: send(event) streams
+    events back to the client.
+    """
+    def __init__(self, request, send):
+        self.request = request
+        self.send = send
+        self.done = threading.Event()
+
+
+class _JobLogHandler(logging.Handler):
+    """Forwards the log records of the running job to its client as 'log'
+    events: only the ones of the thread creating the handler (the job
+    thread), not the ones of the connection threads meanwhile.
+    """
+    def __init__(self, job):
+        logging.Handler.__init__(self, logging.INFO)
+        self.job = job
+        self.thread = threading.current_thread().ident
+
+    def filter(self, record):
+        return record.thread == self.thread and \
+               logging.Handler.filter(self, record)
+
+    def emit(self, record):
+        message = record.getMessage()
+        if isinstance(message, str):
+            # Paths may not be UTF-8
+            message = message.decode('utf-8', 'replace')
+        self.job.send({'event': 'log', 'level': record.levelname,
+                       'name': record.name, 'message': message})
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    """Reads one request from the client, queues it and streams its events
+    back until it is done
+    """
+    def handle(self):
+        lock = threading.Lock()
+        connected = [True]
+
+        def send(event):
+            if not connected[0]:
+                return
+            try:
+                with lock:
+                    self.wfile.write(json.dumps(event) + '\n')
+                    self.wfile.flush()
+            except (IOError, socket.error), e:
+                # The job goes on: the mosaic is written all the same
+                log.warning('Client gone: %s' % e)
+                connected[0] = False
+
+        line = self.rfile.readline()
+        if not line.strip():
+            # e.g. probed by another server, see MosaicServer._listening
+            return
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('not an object')
+        except ValueError, e:
+            send({'event': 'error', 'message': 'Bad request: %s' % e})
+            return
+
+        if request.get('op') == 'status':
+            send(dict(self.server.status(), event='done'))
+            return
+
+        job = _Job(request, send)
+        send({'event': 'queued', 'position': self.server.submit(job)})
+        job.done.wait()
+
+
+class MosaicServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Serves mosaic requests on the Unix socket at socketPath (readable and
+    writable by the user only). Connections are handled by threads; jobs are
+    queued and run one at a time by a single job thread, which owns the
+    ColorIndex, TileCache, ThumbnailStore and database connection. If
+    snapshot is True, the ColorIndex is mapped from the IndexSnapshot.
+    Requests:
+    - {"op": "mosaic", "args": {...}}: make a mosaic, see makeMosaicImage
+      and MOSAIC_ARGS (paths must be absolute). Events: 'queued',
+      'started', 'log' (the log records of the job), then 'done' (with
+      'outfile' and 'seconds') or 'error' (with 'message');
+    - {"op": "reload"}: load the color index again, e.g. after images were
+      stored (only the updated rows are read with snapshot). Events: 'queued', 'started', 'done' or 'error';
+    - {"op": "status"}: 'done', with the server stats.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, socketPath, snapshot=False):
+        self.socketPath = socketPath
+        self.snapshot = snapshot
+        if os.path.exists(socketPath):
+            if not stat.S_ISSOCK(os.stat(socketPath).st_mode):
+                raise ValueError('%s: exists and is not a socket' % socketPath)
+            if self._listening(socketPath):
+                raise ValueError('%s: a server is running already' % socketPath)
+            os.remove(socketPath)
+
+        # Created with the right mode rather than chmod-ed after the bind:
+        # no other user can connect in between
+        umask = os.umask(0077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, socketPath, _RequestHandler)
+        finally:
+            os.umask(umask)
+
+        self.jobs = Queue.Queue()
+        self.index = None
+        self.cache = None
+        self.thumbnails = None
+        self.copies = None
+        self.started = time.time()
+        self.served = 0
+        self.failed = 0
+        self._worker = threading.Thread(target=self._work, name='midb-jobs')
+        self._worker.daemon = True
+
+    @staticmethod
+    def _listening(socketPath):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(socketPath)
+            return True
+        except socket.error:
+            return False
+        finally:
+            s.close()
+
+    def load(self):
+        """Load the color index, tile cache and thumbnail store, and forget
+        the schema and the identical copies of images known so far
+        """
+        from db import DBTableBase
+        from index import ColorIndex
+        from snapshot import IndexSnapshot
+        from tilecache import TileCache
+        from thumbstore import ThumbnailStore
+
+        start = time.time()
+        # e.g. the mip level tables were migrated since the last load
+        DBTableBase.forgetSchema()
+        self.index = IndexSnapshot().load() if self.snapshot else ColorIndex.load()
+        self.cache = TileCache()
+        self.thumbnails = ThumbnailStore()
+        self.copies = {}
+        log.info('Library loaded in %.2fs' % (time.time() - start))
+
+    def submit(self, job):
+        """Queue the job, return the number of jobs ahead of it
+        """
+        position = self.jobs.qsize()
+        self.jobs.put(job)
+        return position
+
+    def status(self):
+        return {'uptime': time.time() - self.started,
+                'queued': self.jobs.qsize(),
+                'served': self.served,
+                'failed': self.failed,
+                'images': len(self.index.levels.values()[0]) if self.index else 0}
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                self._run(job)
+            finally:
+                job.done.set()
+
+    def _run(self, job):
+        import midb
+
+        op = job.request.get('op')
+        handler = _JobLogHandler(job)
+        logger = logging.getLogger('midb')
+        logger.addHandler(handler)
+        start = time.time()
+        job.send({'event': 'started'})
+        try:
+            if op == 'mosaic':
+                args = job.request.get('args') or {}
+                unknown = [x for x in args if x not in MOSAIC_ARGS]
+                if unknown:
+                    raise ValueError('Unknown mosaic argument(s): %s' % \
+                                     ', '.join(sorted(unknown)))
+                args = dict([(str(k), v.encode('utf-8') \
+                                          if isinstance(v, unicode) else v) \
+                             for k, v in args.items()])
+                midb.makeMosaicImage(index=self.index, cache=self.cache,
+                                     thumbnails=self.thumbnails,
+                                     copies=self.copies, **args)
+                result = {'outfile': args.get('outfile')}
+            elif op == 'reload':
+                self.load()
+                result = {}
+            else:
+                raise ValueError('Unknown op: %r' % op)
+        except Exception, e:
+            self.failed += 1
+            log.error('Job failed: %s' % traceback.format_exc())
+            job.send({'event': 'error', 'message': '%s: %s' % \
+                      (e.__class__.__name__, e)})
+        else:
+            self.served += 1
+            result.update({'event': 'done', 'seconds': time.time() - start})
+            job.send(result)
+        finally:
+            logger.removeHandler(handler)
+
+    def serve(self):
+        """Load the library and serve requests until interrupted
+        """
+        self.load()
+        self._worker.start()
+        log.info('Serving mosaics on %s' % self.socketPath)
+        try:
+            self.serve_forever()
+        finally:
+            self.server_close()
+            if os.path.exists(self.socketPath):
+                os.remove(self.socketPath)
+            log.info('Server stopped')
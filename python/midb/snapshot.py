@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+"""Index snapshot: the mip levels of the library exported to plain arrays on
+disk, and memory-mapped back as a ColorIndex with no parsing at all.
+"""
+import os
+import glob
+import json
+import time
+import fcntl
+import logging
+import numpy
+
+from config import Config
+from db import Connection, ImageFilesTable, MipVectorsTable
+from index import MipLevelIndex, ColorIndex
+
+log = logging.getLogger('midb.snapshot')
+
+
+class IndexSnapshot(object):
+    """Snapshot of the mip level tables, in snapshotDir (Config.INDEX_SNAPSHOT_DIR
+    by default). Each mip level is a set of .npy files, rows sorted by frame
+    aspect (the order of MipLevelIndex): imageIDs (int64), frameAspects
+    (float64), active (uint8) and vectors (float32, one row per image).
+    snapshot.json names the current generation of the files and holds the
+    watermark: the latest image_files.last_updated exported, and whether
+    that second was over already (settled) when it was read.
+    refresh() reads only the rows updated since the watermark (through the
+    timestamp_idx index) and writes them over the previous generation into
+    a new one; snapshot.json is replaced last, so readers always see a
+    complete generation, and the files of the previous one stay readable
+    through the memory maps still open on them. Writers hold snapshot.lock
+    exclusively, load() holds it shared while it opens the files.
+    Images deleted from image_files (rather than deactivated) are only
+    dropped by a full export().
+    """
+    metaName = 'snapshot.json'
+    lockName = 'snapshot.lock'
+    fileName = 'level%d-%s.%06d.npy'
+    columns = (('imageIDs', numpy.int64),
+               ('frameAspects', numpy.float64),
+               ('active', numpy.uint8),
+               ('vectors', MipVectorsTable.dtype))
+
+    def __init__(self, snapshotDir=None):
+        self.snapshotDir = snapshotDir or Config.INDEX_SNAPSHOT_DIR
+        if not os.path.isdir(self.snapshotDir):
+            os.makedirs(self.snapshotDir)
+
+    def _path(self, name):
+        return os.path.join(self.snapshotDir, name)
+
+    def meta(self):
+        """Return the contents of snapshot.json, or None if there is no
+        snapshot yet
+        """
+        path = self._path(self.metaName)
+        if not os.path.exists(path):
+            return None
+        f = file(path, 'rb')
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    def _arrays(self, meta, level):
+        """Return a dictionary of the memory-mapped arrays of a mip level of
+        the generation in meta
+        """
+        return dict([(name, numpy.load(self._path(self.fileName % \
+                                                  (level, name, meta['generation'])),
+                                       mmap_mode='r')) \
+                     for name, dtype in self.columns])
+
+    @staticmethod
+    def _watermark():
+        """Return the latest image_files.last_updated as a string, and True
+        if it is older than the current time of the database: rows updated
+        later can not have the same timestamp then
+        """
+        cursor = Connection.cursor()
+        cursor.execute('SELECT MAX(last_updated) AS watermark, '
+                       'CURRENT_TIMESTAMP AS now FROM %s' % ImageFilesTable.table())
+        row = cursor.fetchall()[0]
+        if row['watermark'] is None:
+            return None, False
+        return str(row['watermark']), str(row['watermark']) < str(row['now'])
+
+    @staticmethod
+    def _readLevel(mipTable, since=None, settled=False):
+        """Read the rows of a mip level (the ones of the images updated at
+        or after since, if given, or after it if settled) and return a
+        dictionary of their arrays
+        """
+        args = ()
+        where = []
+        if MipVectorsTable.covers(mipTable):
+            table = MipVectorsTable.table()
+            values = '%s.vector' % table
+            where.append('%s.level = %d' % (table, mipTable.level))
+        else:
+            table = mipTable.table()
+            values = ','.join(['%s.%s' % (table, x) for x in mipTable.colorColumns()])
+        if since is not None:
+            where.append('image_files.last_updated %s %%s' % \
+                         ('>' if settled else '>='))
+            args = (since,)
+
+        sql = '''SELECT %s.imageID, image_files.frame_aspect, image_files.active, %s
+FROM image_files
+INNER JOIN
+    %s ON image_files.imageID = %s.imageID''' % (table, values, table, table)
+        if where:
+            sql += '\nWHERE %s' % ' AND '.join(where)
+
+        imageIDs = []
+        frameAspects = []
+        active = []
+        vectors = []
+
+        with Connection.streaming(asDict=False) as cursor:
+            cursor.execute(sql, args)
+            while True:
+                rows = cursor.fetchmany(4096)
+                if not rows:
+                    break
+                for x in rows:
+                    imageIDs.append(x[0])
+                    frameAspects.append(x[1])
+                    active.append(x[2])
+                    if table == MipVectorsTable.table():
+                        vectors.append(MipVectorsTable.decode(x[3]))
+                    else:
+                        vectors.append(x[3:])
+
+        numValues = mipTable.numValues()
+        return {'imageIDs': numpy.asarray(imageIDs, dtype=numpy.int64),
+                'frameAspects': numpy.asarray(frameAspects, dtype=numpy.float64),
+                'active': numpy.asarray(active, dtype=numpy.uint8),
+                'vectors': numpy.asarray(vectors, dtype=MipVectorsTable.dtype).reshape(
+                               len(imageIDs), numValues)}
+
+    @staticmethod
+    def _unchanged(old, changed):
+        """Return a boolean array telling which rows of changed are in old
+        with the same values: the rows updated in the same second as the
+        watermark are read again until it is settled
+        """
+        if not len(old['imageIDs']):
+            return numpy.zeros(len(changed['imageIDs']), dtype=bool)
+        order = numpy.argsort(old['imageIDs'], kind='mergesort')
+        imageIDs = old['imageIDs'][order]
+        pos = numpy.minimum(numpy.searchsorted(imageIDs, changed['imageIDs']),
+                            len(imageIDs) - 1)
+        rows = order[pos]
+        result = imageIDs[pos] == changed['imageIDs']
+        for name in ('frameAspects', 'active'):
+            result &= old[name][rows] == changed[name]
+        result &= (old['vectors'][rows] == changed['vectors']).all(axis=1)
+        return result
+
+    def _write(self, generation, level, arrays):
+        """Write the arrays of a mip level for the given generation, rows
+        sorted by frame aspect
+        """
+        order = numpy.argsort(arrays['frameAspects'], kind='mergesort')
+        for name, dtype in self.columns:
+            numpy.save(self._path(self.fileName % (level, name, generation)),
+                       numpy.ascontiguousarray(arrays[name][order], dtype=dtype))
+
+    def _commit(self, meta):
+        """Make meta the current snapshot.json and remove the files of the
+        other generations
+        """
+        tmp = self._path(self.metaName + '.tmp')
+        f = file(tmp, 'wb')
+        try:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, self._path(self.metaName))
+
+        current = set([self.fileName % (x.level, name, meta['generation']) \
+                       for x in ColorIndex.mipTables for name, dtype in self.columns])
+        for path in glob.glob(self._path('level*.npy')):
+            if os.path.basename(path) not in current:
+                os.remove(path)
+
+    def _locked(self, shared=False):
+        """Return the lock file, locked exclusively (or shared): close it to
+        release the lock
+        """
+        f = file(self._path(self.lockName), 'ab')
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        return f
+
+    def export(self):
+        """Export all the mip levels to a new snapshot generation
+        """
+        start = time.time()
+        lock = self._locked()
+        try:
+            meta = self.meta()
+            generation = meta['generation'] + 1 if meta else 1
+            # Read before the rows: rows updated meanwhile are read again
+            # by the next refresh
+            watermark, settled = self._watermark()
+            rows = {}
+            for mipTable in ColorIndex.mipTables:
+                arrays = self._readLevel(mipTable)
+                self._write(generation, mipTable.level, arrays)
+                rows[str(mipTable.level)] = len(arrays['imageIDs'])
+            self._commit({'generation': generation, 'watermark': watermark,
+                          'settled': settled, 'rows': rows})
+        finally:
+            lock.close()
+        log.info('Index snapshot %d exported in %.2fs: %s rows' % \
+                 (generation, time.time() - start, max(rows.values())))
+
+    def refresh(self):
+        """Bring the snapshot up to date with the rows updated since its
+        watermark (export it all if there is no snapshot yet). Return the
+        number of rows changed.
+        """
+        meta = self.meta()
+        if meta is None or meta['watermark'] is None:
+            self.export()
+            return sum(self.meta()['rows'].values())
+
+        start = time.time()
+        lock = self._locked()
+        try:
+            # Refreshed by another process meanwhile?
+            meta = self.meta()
+            watermark, settled = self._watermark()
+            changes = {}
+            for mipTable in ColorIndex.mipTables:
+                old = self._arrays(meta, mipTable.level)
+                changed = self._readLevel(mipTable, since=meta['watermark'],
+                                          settled=meta.get('settled', False))
+                new = ~self._unchanged(old, changed)
+                changes[mipTable.level] = (old, dict([(name, x[new]) \
+                                                      for name, x in changed.items()]))
+            count = sum([len(x['imageIDs']) for old, x in changes.values()])
+            if not count:
+                # Same generation, but rows re-stored unchanged are not
+                # read again next time:
+                if (watermark, settled) != (meta['watermark'],
+                                            meta.get('settled', False)):
+                    self._commit(dict(meta, watermark=watermark, settled=settled))
+                return 0
+
+            generation = meta['generation'] + 1
+            rows = {}
+            for level, (old, changed) in changes.items():
+                keep = ~numpy.in1d(old['imageIDs'], changed['imageIDs'])
+                arrays = dict([(name, numpy.concatenate([old[name][keep], changed[name]])) \
+                               for name, dtype in self.columns])
+                self._write(generation, level, arrays)
+                rows[str(level)] = len(arrays['imageIDs'])
+            self._commit({'generation': generation, 'watermark': watermark,
+                          'settled': settled, 'rows': rows})
+        finally:
+            lock.close()
+        log.info('Index snapshot %d: %d updated rows merged in %.2fs' % \
+                 (generation, count, time.time() - start))
+        return count
+
+    def load(self, refresh=True):
+        """Return a ColorIndex over memory maps of the snapshot (refreshed
+        first if refresh is True). Only inactive images, if any, are copied
+        out of the maps.
+        """
+        if refresh:
+            self.refresh()
+
+        # Open the files of the current generation before a writer removes
+        # them (they stay readable through the maps afterwards):
+        lock = self._locked(shared=True)
+        try:
+            meta = self.meta()
+            if meta is None:
+                raise ValueError('%s: no index snapshot' % self.snapshotDir)
+            levelArrays = [self._arrays(meta, x.level) for x in ColorIndex.mipTables]
+        finally:
+            lock.close()
+
+        levels = []
+        for mipTable, arrays in zip(ColorIndex.mipTables, levelArrays):
+            active = arrays['active'] != 0
+            if not active.all():
+                arrays = dict([(name, x[active]) for name, x in arrays.items()])
+            levels.append(MipLevelIndex(mipTable, arrays['imageIDs'],
+                                        arrays['frameAspects'], arrays['vectors'],
+                                        presorted=True))
+        log.info('Index snapshot %d mapped: %d images' % \
+                 (meta['generation'], len(levels[0])))
+        return ColorIndex(levels)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+"""Thumbnail store: thumbnails kept as raw pixels in append-only pack files,
+outside of the database (see ThumbnailTable for the BLOB issue), and read
+back through memory maps.
+"""
+import os
+import mmap
+import fcntl
+import struct
+import logging
+import numpy
+
+from config import Config
+
+log = logging.getLogger('midb.thumbstore')
+
+
+class ThumbnailStore(object):
+    """Append-only store of 8 bit RGB thumbnails, keyed by imageID.
+    Pixels are appended to pack files (pack-NNNN.dat, a new one is started
+    when the current one gets over packBytes) and an index record is appended
+    to index.dat for each of them; the last record of an imageID wins, so
+    storing a thumbnail again simply shadows the previous one.
+    get() returns numpy arrays straight over memory maps of the pack files:
+    no copy, no decoding.
+    """
+    indexName = 'index.dat'
+    packName = 'pack-%04d.dat'
+    # imageID, pack number, offset, width, height
+    record = struct.Struct('<IHQHH')
+
+    def __init__(self, storeDir=None, packBytes=256 * 1024 * 1024):
+        self.storeDir = storeDir or Config.THUMBNAIL_DIR
+        self.packBytes = packBytes
+        # imageID: (pack number, offset, width, height)
+        self._index = {}
+        self._indexSize = 0
+        self._maps = {}
+        # Maps replaced by larger ones: arrays returned by get() may still
+        # point into them, so they are only closed by close()
+        self._oldMaps = []
+
+        if not os.path.isdir(self.storeDir):
+            os.makedirs(self.storeDir)
+
+        self._refresh()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, imageID):
+        return imageID in self._index
+
+    def _path(self, name):
+        return os.path.join(self.storeDir, name)
+
+    def _refresh(self):
+        """Read the index records appended since the last call
+        """
+        path = self._path(self.indexName)
+        if not os.path.exists(path) or os.path.getsize(path) == self._indexSize:
+            return
+
+        f = file(path, 'rb')
+        try:
+            f.seek(self._indexSize)
+            data = f.read()
+        finally:
+            f.close()
+
+        # Ignore a partly written record at the end, if any:
+        size = self.record.size
+        end = len(data) - len(data) % size
+        for offset in range(0, end, size):
+            imageID, pack, pos, w, h = self.record.unpack_from(data, offset)
+            self._index[imageID] = (pack, pos, w, h)
+        self._indexSize += end
+
+    def _map(self, pack, end):
+        """Return a memory map of the given pack file covering at least end bytes
+        """
+        m = self._maps.get(pack)
+        if m is None or len(m) < end:
+            if m is not None:
+                self._oldMaps.append(m)
+            f = file(self._path(self.packName % pack), 'rb')
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+            self._maps[pack] = m
+        return m
+
+    def size(self, imageID):
+        """Return (width, height) of the thumbnail of imageID, or None if it
+        is not in the store
+        """
+        if imageID not in self._index:
+            self._refresh()
+        if imageID not in self._index:
+            return None
+        return self._index[imageID][2:]
+
+    def get(self, imageID):
+        """Return the thumbnail of imageID as a read-only (height, width, 3)
+        uint8 array, or None if it is not in the store
+        """
+        if imageID not in self._index:
+            self._refresh()
+        if imageID not in self._index:
+            return None
+
+        pack, pos, w, h = self._index[imageID]
+        m = self._map(pack, pos + w * h * 3)
+        return numpy.frombuffer(m, dtype=numpy.uint8, count=w * h * 3,
+                                offset=pos).reshape(h, w, 3)
+
+    def add(self, items):
+        """Append the thumbnails of the given (imageID, pixels) pairs, pixels
+        being (height, width, 3) arrays of 8 bit values (or floats in the
+        0-1 range). The index file is locked while writing, so concurrent
+        writers do not interleave.
+        """
+        if not items:
+            return
+
+        indexFile = file(self._path(self.indexName), 'ab')
+        try:
+            fcntl.flock(indexFile.fileno(), fcntl.LOCK_EX)
+
+            pack = self._lastPack()
+            path = self._path(self.packName % pack)
+            if os.path.exists(path) and os.path.getsize(path) >= self.packBytes:
+                pack += 1
+                path = self._path(self.packName % pack)
+
+            packFile = file(path, 'ab')
+            try:
+                records = []
+                for imageID, pixels in items:
+                    pixels = self.rgb8(pixels)
+                    h, w = pixels.shape[:2]
+                    pos = packFile.tell()
+                    packFile.write(pixels.tostring())
+                    records.append(self.record.pack(imageID, pack, pos, w, h))
+                packFile.flush()
+                os.fsync(packFile.fileno())
+            finally:
+                packFile.close()
+
+            # The index records go last: a reader never finds a record for
+            # pixels that are not fully written.
+            indexFile.write(''.join(records))
+            indexFile.flush()
+        finally:
+            indexFile.close()
+
+        self._refresh()
+        log.debug('%d thumbnail(s) stored' % len(items))
+
+    def _lastPack(self):
+        """Return the number of the newest pack file (0 if there is none yet)
+        """
+        packs = [int(x[5:9]) for x in os.listdir(self.storeDir) \
+                 if x.startswith('pack-') and x.endswith('.dat')]
+        return max(packs) if packs else 0
+
+    @staticmethod
+    def rgb8(pixels):
+        """Return the pixels array as a contiguous (height, width, 3) uint8 one
+        """
+        pixels = numpy.asarray(pixels)
+        if pixels.ndim == 2:
+            pixels = pixels[:, :, numpy.newaxis]
+        if pixels.shape[-1] < 3:
+            pixels = pixels[:, :, [0, 0, 0]]
+        pixels = pixels[:, :, :3]
+        if pixels.dtype != numpy.uint8:
+            pixels = (numpy.clip(pixels, 0.0, 1.0) * 255 + 0.5).astype(numpy.uint8)
+        return numpy.ascontiguousarray(pixels)
+
+    def close(self):
+        """Close the memory maps: the arrays returned by get() must not be
+        used afterwards
+        """
+        for m in self._maps.values() + self._oldMaps:
+            m.close()
+        self._maps = {}
+        self._oldMaps = []
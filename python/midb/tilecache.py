@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""Persistent cache of resized mosaic tiles, so mosaic runs do not have to
+read the same original images over and over again.
+"""
+import os
+import logging
+import hashlib
+import tempfile
+import threading
+import numpy
+
+from config import Config
+
+log = logging.getLogger('midb.tilecache')
+
+
+class TileCache(object):
+    """On-disk cache of resized tile pixels, as (height, width, 3) float32
+    arrays saved in .npy files. Tiles are content addressed: the key is made
+    of the pixel hash of the source image, the tile size, the colorspace and
+    what the tile was resized from (the image or its thumbnail), so a tile
+    stays valid whatever the path of its image.
+    Least recently used tiles (by file modification time, touched on each hit)
+    are evicted to keep the cache within maxBytes.
+    Safe to use from several threads.
+    """
+    suffix = '.npy'
+
+    def __init__(self, cacheDir=None, maxBytes=None):
+        self.cacheDir = cacheDir or Config.TILE_CACHE_DIR
+        self.maxBytes = Config.TILE_CACHE_BYTES if maxBytes is None else maxBytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key: [size in bytes, last used time]
+        self._entries = {}
+        self._totalBytes = 0
+
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir)
+
+        for name in os.listdir(self.cacheDir):
+            if not name.endswith(self.suffix):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cacheDir, name))
+            except OSError:
+                continue
+            self._entries[name[:-len(self.suffix)]] = [st.st_size, st.st_mtime]
+            self._totalBytes += st.st_size
+
+    @staticmethod
+    def key(imageHash, width, height, colorspace, source='original'):
+        """Return the cache key of the tile of the given size made from the
+        image with the given pixel hash and colorspace, or None if the image
+        has no hash (then it cannot be cached). source is 'original' for a
+        tile resized from the image file, 'thumbnail' for one resized from
+        its stored thumbnail: they do not have the same pixels.
+        """
+        if not imageHash:
+            return None
+        return hashlib.sha1('%s:%dx%d:%s:%s' % (imageHash, width, height,
+                                                colorspace, source)).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cacheDir, key + self.suffix)
+
+    def get(self, key):
+        """Return the pixels of the cached tile, or None if it is not cached
+        """
+        with self._lock:
+            cached = key in self._entries
+            if not cached:
+                self.misses += 1
+                return None
+
+        try:
+            pixels = numpy.load(self._path(key))
+            os.utime(self._path(key), None)
+        except (IOError, OSError, ValueError), e:
+            log.warning('%s: cannot read cached tile: %s' % (self._path(key), e))
+            with self._lock:
+                self.misses += 1
+                self._forget(key)
+            return None
+
+        with self._lock:
+            self.hits += 1
+            if key in self._entries:
+                self._entries[key][1] = os.path.getmtime(self._path(key))
+        return pixels
+
+    def put(self, key, pixels):
+        """Store the tile pixels, evicting the least recently used tiles if
+        the cache gets over budget
+        """
+        fd, tfile = tempfile.mkstemp(prefix='.tile', suffix=self.suffix,
+                                     dir=self.cacheDir)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                numpy.save(f, numpy.asarray(pixels, dtype=numpy.float32))
+            finally:
+                f.close()
+            # Atomic, so other threads (or runs) never see a partial file:
+            os.rename(tfile, self._path(key))
+        except:
+            if os.path.exists(tfile):
+                os.unlink(tfile)
+            raise
+
+        st = os.stat(self._path(key))
+        with self._lock:
+            self._forget(key, unlink=False)
+            self._entries[key] = [st.st_size, st.st_mtime]
+            self._totalBytes += st.st_size
+            self._evict()
+
+    def _forget(self, key, unlink=True):
+        """Drop the key from the bookkeeping (and its file). Call with the
+        lock held.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._totalBytes -= entry[0]
+        if unlink and os.path.exists(self._path(key)):
+            os.unlink(self._path(key))
+
+    def _evict(self):
+        """Remove the least recently used tiles until the cache fits within
+        maxBytes. Call with the lock held.
+        """
+        if self._totalBytes <= self.maxBytes:
+            return
+        byAge = sorted(self._entries.items(), key=lambda x: x[1][1])
+        evicted = 0
+        for key, entry in byAge:
+            if self._totalBytes <= self.maxBytes:
+                break
+            try:
+                self._forget(key)
+            except OSError, e:
+                log.warning('%s: cannot evict: %s' % (self._path(key), e))
+            evicted += 1
+        log.debug('%d tile(s) evicted from the cache' % evicted)
+
+    def logStats(self):
+        log.info('Tile cache: %d hit(s), %d miss(es), %d tile(s), %d bytes' % \
+                 (self.hits, self.misses, len(self._entries), self._totalBytes))
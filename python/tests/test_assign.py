@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""Tests of the global assignment of images to mosaic tiles (midb.assign).
+Run from the python directory: python -m unittest discover tests
+"""
+import os
+import sys
+import itertools
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from midb.assign import auction, TileAssigner
+
+
+def bruteForce(objects, benefits, numBidders):
+    """Return the best total benefit of an assignment of distinct objects to
+    all the bidders, trying them all
+    """
+    best = -numpy.inf
+    choices = [range(len(x)) for x in objects]
+    for picked in itertools.product(*choices):
+        objs = [objects[i][x] for i, x in enumerate(picked)]
+        if len(set(objs)) < numBidders:
+            continue
+        total = sum([benefits[i][x] for i, x in enumerate(picked)])
+        best = max(best, total)
+    return best
+
+
+class AuctionTest(unittest.TestCase):
+
+    def check(self, objects, benefits, numObjects, epsilon=1e-3):
+        numBidders = len(objects)
+        assigned, bids = auction(objects, benefits, numObjects, epsilon)
+        self.assertTrue(-1 not in assigned)
+        picked = [objects[i][x] for i, x in enumerate(assigned)]
+        self.assertEqual(len(set(picked)), numBidders)
+
+        allBenefits = numpy.concatenate(benefits)
+        tolerance = numBidders * epsilon * (allBenefits.max() - allBenefits.min())
+        total = sum([benefits[i][x] for i, x in enumerate(assigned)])
+        self.assertTrue(total >= bruteForce(objects, benefits, numBidders) - \
+                        tolerance - 1e-9)
+
+    def testDense(self):
+        random = numpy.random.RandomState(1)
+        for n in range(10):
+            numBidders = random.randint(2, 6)
+            numObjects = numBidders + random.randint(0, 3)
+            objects = [numpy.arange(numObjects)] * numBidders
+            benefits = [random.rand(numObjects) for i in range(numBidders)]
+            self.check(objects, benefits, numObjects)
+
+    def testSparse(self):
+        random = numpy.random.RandomState(2)
+        for n in range(10):
+            numBidders = random.randint(2, 6)
+            numObjects = numBidders + 2
+            objects = []
+            benefits = []
+            for i in range(numBidders):
+                # Bidder i can always get object i: a full assignment exists
+                others = random.permutation(numObjects)[:3]
+                objects.append(numpy.unique(numpy.append(others, i)))
+                benefits.append(random.rand(len(objects[-1])))
+            self.check(objects, benefits, numObjects)
+
+    def testConflict(self):
+        # Both bidders prefer object 0: the second best total is 1 + 0.8
+        objects = [numpy.array([0, 1]), numpy.array([0, 1])]
+        benefits = [numpy.array([1.0, 0.1]), numpy.array([0.9, 0.8])]
+        assigned, bids = auction(objects, benefits, 2, 1e-6)
+        self.assertEqual(assigned, [0, 1])
+
+    def testLeftOut(self):
+        objects = [numpy.array([0]), numpy.array([0])]
+        benefits = [numpy.array([1.0]), numpy.array([2.0])]
+        assigned, bids = auction(objects, benefits, 1)
+        self.assertEqual(assigned, [-1, 0])
+
+
+class TileAssignerTest(unittest.TestCase):
+
+    def assertNoRepeats(self, assigner, placed):
+        tiles = assigner.tilesInX * assigner.tilesInY
+        for a in range(tiles):
+            for b in range(a + 1, tiles):
+                dx = abs(a % assigner.tilesInX - b % assigner.tilesInX)
+                dy = abs(a / assigner.tilesInX - b / assigner.tilesInX)
+                if dx <= assigner.radius and dy <= assigner.radius:
+                    self.assertNotEqual(placed[a], placed[b],
+                                        'key %s on tiles %d and %d' % \
+                                        (placed[a], a, b))
+
+    def testNoRepeatWithinRadius(self):
+        random = numpy.random.RandomState(3)
+        for radius in (1, 2, 3):
+            assigner = TileAssigner(9, 7, radius)
+            numKeys = 3 * (2 * radius + 1) ** 2
+            candidates = [random.permutation(numKeys)[:assigner.depth(8)] \
+                          for i in range(9 * 7)]
+            costs = [random.rand(len(x)) for x in candidates]
+            placed = assigner.assign(candidates, costs)
+            self.assertTrue(None not in placed)
+            self.assertEqual(assigner.stats['repeats'], 0)
+            self.assertNoRepeats(assigner, placed)
+            for tile, key in enumerate(placed):
+                self.assertTrue(key in candidates[tile])
+
+    def testSameBestCandidate(self):
+        # Every tile prefers key 0, then key 1...: a greedy pick would use
+        # key 0 over and over again
+        assigner = TileAssigner(6, 6, 2)
+        numKeys = 40
+        candidates = [numpy.arange(numKeys)] * 36
+        costs = [numpy.linspace(0, 1, numKeys) + 0.001 * i for i in range(36)]
+        placed = assigner.assign(candidates, costs)
+        self.assertNoRepeats(assigner, placed)
+
+    def testOptimalSingleBlock(self):
+        # All the tiles are within radius of each other: one auction, which
+        # must be as good as the best assignment there is
+        random = numpy.random.RandomState(4)
+        assigner = TileAssigner(2, 2, 1)
+        candidates = [numpy.arange(6)] * 4
+        costs = [random.rand(6) for i in range(4)]
+        placed = assigner.assign(candidates, costs)
+        self.assertNoRepeats(assigner, placed)
+        total = sum([costs[i][placed[i]] for i in range(4)])
+        best = -bruteForce(candidates, [-x for x in costs], 4)
+        self.assertTrue(total <= best + 4 * assigner.epsilon + 1e-9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""Tests of the index snapshot refresh (midb.snapshot) against an SQLite
+database.
+Run from the python directory: python -m unittest discover tests
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from midb.config import Config
+from midb.db import Connection, DBTableBase, MipVectorsTable
+from midb.index import ColorIndex
+from midb.snapshot import IndexSnapshot
+
+# Long over, and not over yet: rows updated "now" would have the same
+# timestamp as the latter
+PAST = '2020-01-01 10:00:00'
+LATER = '2020-01-01 10:00:05'
+NOW = '2999-01-01 00:00:00'
+
+
+class IndexSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='midb_test')
+        self.config = (Config.DB_BACKEND, Config.DB_PATH)
+        Config.DB_BACKEND = 'sqlite'
+        Config.DB_PATH = os.path.join(self.tmpDir, 'db.sqlite')
+        Connection._backend = None
+        DBTableBase.forgetSchema()
+        self.snapshot = IndexSnapshot(os.path.join(self.tmpDir, 'snapshot'))
+        self.random = numpy.random.RandomState(5)
+
+    def tearDown(self):
+        Connection.backend().close()
+        Connection._backend = None
+        DBTableBase.forgetSchema()
+        Config.DB_BACKEND, Config.DB_PATH = self.config
+        shutil.rmtree(self.tmpDir)
+
+    def addImage(self, imageID, lastUpdated, frameAspect=1.5):
+        with Connection.transaction() as cursor:
+            cursor.execute('''INSERT INTO image_files (imageID, path, format,
+num_channels, pixel_type, orig_timestamp, last_updated, hash, width, height,
+frame_aspect, active)
+VALUES (%s, %s, 'jpg', 3, 'uint8', %s, %s, %s, 300, 200, %s, 1)''',
+                           (imageID, 'img%d.jpg' % imageID, PAST, lastUpdated,
+                            'hash%d' % imageID, frameAspect))
+            cursor.execute('INSERT INTO mip_level0 (imageID, red, green, blue) '
+                           'VALUES (%s, %s, %s, %s)',
+                           [imageID] + self.random.rand(3).tolist())
+            for mipTable in ColorIndex.mipTables[1:]:
+                cursor.execute('INSERT INTO mip_vectors (imageID, level, vector) '
+                               'VALUES (%s, %s, %s)',
+                               (imageID, mipTable.level, MipVectorsTable.encode(
+                                   self.random.rand(mipTable.numValues()))))
+
+    def execute(self, sql, args=()):
+        with Connection.transaction() as cursor:
+            cursor.execute(sql, args)
+
+    def levels(self, snapshot):
+        """Return the arrays of each mip level of the current generation of
+        snapshot, rows sorted by imageID
+        """
+        meta = snapshot.meta()
+        result = []
+        for mipTable in ColorIndex.mipTables:
+            arrays = snapshot._arrays(meta, mipTable.level)
+            order = numpy.argsort(arrays['imageIDs'])
+            result.append(dict([(name, x[order]) for name, x in arrays.items()]))
+        return result
+
+    def assertSameAsExport(self):
+        exported = IndexSnapshot(os.path.join(self.tmpDir, 'exported'))
+        exported.export()
+        for refreshed, expected in zip(self.levels(self.snapshot),
+                                       self.levels(exported)):
+            for name, dtype in IndexSnapshot.columns:
+                numpy.testing.assert_array_equal(refreshed[name], expected[name])
+
+    def testSameSecond(self):
+        for imageID in range(1, 5):
+            self.addImage(imageID, NOW)
+        self.snapshot.export()
+        self.assertFalse(self.snapshot.meta()['settled'])
+
+        # Stored in the second of the watermark, after the export: a new
+        # image and a new mip level 0 of image 2
+        self.addImage(5, NOW)
+        self.execute('UPDATE mip_level0 SET red = 2.0 WHERE imageID = 2')
+        self.assertEqual(self.snapshot.refresh(), len(ColorIndex.mipTables) + 1)
+        self.assertEqual(self.snapshot.meta()['generation'], 2)
+        self.assertSameAsExport()
+
+        # Read again, but nothing changed:
+        self.assertEqual(self.snapshot.refresh(), 0)
+        self.assertEqual(self.snapshot.meta()['generation'], 2)
+
+    def testSettled(self):
+        for imageID in range(1, 5):
+            self.addImage(imageID, PAST)
+        self.snapshot.export()
+        self.assertTrue(self.snapshot.meta()['settled'])
+
+        self.addImage(5, LATER)
+        self.assertEqual(self.snapshot.refresh(), len(ColorIndex.mipTables))
+        self.assertEqual(self.snapshot.meta()['watermark'], LATER)
+        self.assertEqual(self.snapshot.refresh(), 0)
+        self.assertSameAsExport()
+
+    def testDeactivated(self):
+        for imageID in range(1, 6):
+            self.addImage(imageID, PAST)
+        self.snapshot.export()
+
+        self.execute('UPDATE image_files SET active = 0, last_updated = %s '
+                     'WHERE imageID = 3', (LATER,))
+        self.assertEqual(self.snapshot.refresh(), len(ColorIndex.mipTables))
+        self.assertSameAsExport()
+
+        index = self.snapshot.load(refresh=False)
+        for level in index.levels.values():
+            self.assertEqual(sorted(level.imageIDs.tolist()), [1, 2, 4, 5])
+
+        # Active again:
+        self.execute('UPDATE image_files SET active = 1, last_updated = %s '
+                     'WHERE imageID = 3', (NOW,))
+        index = self.snapshot.load()
+        for level in index.levels.values():
+            self.assertEqual(sorted(level.imageIDs.tolist()), [1, 2, 3, 4, 5])
+
+    def testRefreshMatchesExport(self):
+        for imageID in range(1, 41):
+            self.addImage(imageID, PAST, frameAspect=self.random.choice([0.75, 1.5]))
+        self.snapshot.export()
+
+        for imageID in range(41, 51):
+            self.addImage(imageID, LATER, frameAspect=1.5)
+        self.execute('UPDATE image_files SET active = 0, last_updated = %s '
+                     'WHERE imageID IN (2, 7, 43)', (LATER,))
+        self.execute('UPDATE image_files SET frame_aspect = 1.0, last_updated = %s '
+                     'WHERE imageID = 11', (LATER,))
+        self.execute('UPDATE mip_vectors SET vector = %s WHERE imageID = 12 '
+                     'AND level = 2', (MipVectorsTable.encode(numpy.zeros(48)),))
+        self.execute('UPDATE image_files SET last_updated = %s WHERE imageID = 12',
+                     (NOW,))
+        self.snapshot.refresh()
+        self.assertSameAsExport()
+
+        self.addImage(51, NOW)
+        self.snapshot.refresh()
+        self.assertSameAsExport()
+
+
+if __name__ == '__main__':
+    unittest.main()